@@ -0,0 +1,262 @@
+"""
+Streaming reader for per-system AC power time series, keeping hourly data
+only around the weather events.
+
+The file is read in chunks with only the AC power columns. Each chunk is
+folded into hourly means and daily energy sums, so memory depends on the
+event windows and the number of days, not the raw sampling rate.
+"""
+
+import numpy as np
+import pandas as pd
+from pv_performance import DailyEnergyTable, _wallClockDays
+
+
+def eventWindows(weather_events, day_window=14):
+    """
+    Get the periods of data needed around a system's weather events: from
+    day_window days before the day each event starts to day_window days
+    after the day it ends, merged where they overlap or touch.
+
+    Parameters
+    ----------
+    weather_events: Pandas DataFrame
+        Weather events containing the 'weather_event_started_on' and
+        'weather_event_ended_on' columns.
+    day_window: int, default 14
+        Number of days before and after each event.
+
+    Returns
+    -------
+    window_start: Numpy array
+        Window start times (datetime64, wall clock), sorted.
+    window_end: Numpy array
+        Window end times (exclusive).
+    """
+    if len(weather_events) == 0:
+        empty = np.array([], dtype='datetime64[ns]')
+        return empty, empty
+    start_day = _wallClockDays(pd.to_datetime(
+        weather_events['weather_event_started_on'])) - day_window
+    end_day = _wallClockDays(pd.to_datetime(
+        weather_events['weather_event_ended_on'])) + day_window + 1
+    order = np.argsort(start_day, kind='stable')
+    start_day = start_day[order]
+    end_day = np.maximum.accumulate(end_day[order])
+    new_window = np.ones(len(start_day), dtype=bool)
+    new_window[1:] = start_day[1:] > end_day[:-1]
+    window_number = np.cumsum(new_window) - 1
+    window_end = np.zeros(window_number[-1] + 1, dtype=np.int64)
+    np.maximum.at(window_end, window_number, end_day)
+    return (start_day[new_window].astype('datetime64[D]').astype(
+                'datetime64[ns]'),
+            window_end.astype('datetime64[D]').astype('datetime64[ns]'))
+
+
+class SystemPowerData():
+    """
+    Reduced AC power data of a system.
+
+    Parameters
+    ----------
+    hourly: Pandas DataFrame
+        Resampled AC power streams inside the event windows. Resampling
+        bins without data are NaN, and the bin after each window is NaN,
+        so plotted lines break between windows.
+    energy_table: pv_performance.DailyEnergyTable
+        Daily energy sums (of the resampled means) for the whole data
+        period.
+    """
+
+    def __init__(self, hourly, energy_table):
+        self.hourly = hourly
+        self.energy_table = energy_table
+
+
+class EventWindowAccumulator():
+    """
+    Fold time-ordered chunks of AC power data into resampled means, daily
+    energy sums, and the resampled data inside the event windows.
+
+    Bins that are complete are folded into the daily sums (and kept if they
+    fall inside a window) as soon as the next chunk starts after them, so
+    only the last bin of a chunk is carried over.
+
+    Parameters
+    ----------
+    window_start: Numpy array, default None
+        Event window start times, sorted (see eventWindows). None keeps
+        no resampled data.
+    window_end: Numpy array, default None
+        Event window end times (exclusive).
+    frequency: str, default '60min'
+        Resampling frequency.
+    """
+
+    def __init__(self, window_start=None, window_end=None,
+                 frequency='60min'):
+        if window_start is None:
+            window_start = np.array([], dtype='datetime64[ns]')
+            window_end = np.array([], dtype='datetime64[ns]')
+        self.window_start = pd.DatetimeIndex(window_start)
+        self.window_end = pd.DatetimeIndex(window_end)
+        self.frequency = frequency
+        self.columns = None
+        self.pending_sums = None
+        self.pending_counts = None
+        self.first_bin = None
+        self.daily_parts = list()
+        self.window_parts = list()
+
+    def _finalize(self, sums, counts):
+        """
+        Fold complete bins into the daily sums and the window data.
+        """
+        if len(sums) == 0:
+            return
+        means = sums / counts.where(counts > 0)
+        day_number = _wallClockDays(means.index)
+        self.daily_parts.append(pd.DataFrame(
+            np.nan_to_num(means.to_numpy(dtype=float)),
+            index=day_number).groupby(level=0).sum())
+        # Bins inside an event window are kept
+        window = self.window_start.searchsorted(means.index,
+                                                side='right') - 1
+        in_window = window >= 0
+        in_window[in_window] = means.index[in_window] < self.window_end[
+            window[in_window]]
+        if np.any(in_window):
+            self.window_parts.append(means[in_window])
+        return
+
+    def add(self, chunk):
+        """
+        Add a chunk of AC power data.
+
+        Parameters
+        ----------
+        chunk: Pandas DataFrame
+            AC power streams with a datetime index. Chunks must be added
+            in time order.
+
+        Returns
+        -------
+        None.
+
+        """
+        if len(chunk) == 0:
+            return
+        chunk = chunk.set_axis(pd.DatetimeIndex(pd.to_datetime(chunk.index)))
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+            index_tz = chunk.index.tz
+            if index_tz is not None:
+                self.window_start = self.window_start.tz_localize(index_tz)
+                self.window_end = self.window_end.tz_localize(index_tz)
+        bins = chunk.index.floor(self.frequency)
+        values = chunk[self.columns].astype(float)
+        sums = values.groupby(bins).sum()
+        counts = values.notna().groupby(bins).sum()
+        if self.pending_sums is not None:
+            if bins.min() < self.pending_sums.index[0]:
+                raise ValueError("AC power data must be in time order to "
+                                 "be streamed.")
+            sums = pd.concat([self.pending_sums, sums]).groupby(
+                level=0).sum()
+            counts = pd.concat([self.pending_counts, counts]).groupby(
+                level=0).sum()
+        if self.first_bin is None:
+            self.first_bin = sums.index[0]
+        # The last bin can continue in the next chunk
+        self.pending_sums = sums.iloc[-1:]
+        self.pending_counts = counts.iloc[-1:]
+        self._finalize(sums.iloc[:-1], counts.iloc[:-1])
+        return
+
+    def finish(self):
+        """
+        Fold in the last bin and build the reduced data.
+
+        Returns
+        -------
+        system_power_data: SystemPowerData
+            Resampled data inside the event windows and the daily energy
+            table. The daily table covers every day from the first to the
+            last bin (days without data have zero energy), as a resample of
+            the full series does.
+        """
+        columns = self.columns or list()
+        if self.pending_sums is None:
+            return SystemPowerData(
+                pd.DataFrame(columns=columns, dtype=float),
+                DailyEnergyTable(days=[], energy=np.zeros((0, len(columns))),
+                                 streams=columns))
+        last_bin = self.pending_sums.index[0]
+        self._finalize(self.pending_sums, self.pending_counts)
+        self.pending_sums = None
+        self.pending_counts = None
+        # Daily energy for every day of the data period
+        first_day, last_day = _wallClockDays(
+            pd.DatetimeIndex([self.first_bin, last_bin]))
+        days = np.arange(first_day, last_day + 1)
+        daily = pd.concat(self.daily_parts).groupby(level=0).sum()
+        energy = np.zeros((len(days), len(columns)))
+        energy[daily.index.values - first_day] = daily.to_numpy()
+        energy_table = DailyEnergyTable(days=days, energy=energy,
+                                        streams=columns)
+        # Every bin of each window within the data period, plus the bin
+        # after it, with NaN where there is no data
+        step = pd.tseries.frequencies.to_offset(self.frequency)
+        bins = [pd.date_range(max(start, self.first_bin).ceil(step),
+                              min(end, last_bin + step), freq=step)
+                for start, end in zip(self.window_start, self.window_end)
+                if start <= last_bin and end > self.first_bin]
+        if len(self.window_parts):
+            hourly = pd.concat(self.window_parts)
+        else:
+            hourly = pd.DataFrame(columns=columns, dtype=float)
+        if len(bins):
+            hourly = hourly.reindex(bins[0].append(bins[1:]))
+        return SystemPowerData(hourly, energy_table)
+
+
+def readEventWindows(path, weather_events, day_window=14, frequency='60min',
+                     chunksize=100000, storage_options=None):
+    """
+    Stream a system's AC power CSV file in chunks, reading only the AC
+    power columns, and reduce it to the resampled data around the weather
+    events plus daily energy sums.
+
+    Parameters
+    ----------
+    path: str
+        CSV file path or URL, with the timestamps in the first column.
+    weather_events: Pandas DataFrame
+        The system's weather events, with 'weather_event_started_on' and
+        'weather_event_ended_on' columns.
+    day_window: int, default 14
+        Number of days of data kept before and after each event (the plot
+        window; the performance scoring only needs the daily sums).
+    frequency: str, default '60min'
+        Resampling frequency.
+    chunksize: int, default 100000
+        Number of rows read per chunk.
+    storage_options: dict, default None
+        Extra options passed through to pd.read_csv for remote paths.
+
+    Returns
+    -------
+    system_power_data: SystemPowerData
+        Reduced AC power data.
+    """
+    header = pd.read_csv(path, nrows=0, storage_options=storage_options)
+    ac_power_streams = [x for x in list(header.columns[1:])
+                        if 'ac_power' in x]
+    accumulator = EventWindowAccumulator(
+        *eventWindows(weather_events, day_window), frequency=frequency)
+    for chunk in pd.read_csv(path, index_col=0, parse_dates=True,
+                             usecols=[header.columns[0]] + ac_power_streams,
+                             chunksize=chunksize,
+                             storage_options=storage_options):
+        accumulator.add(chunk)
+    return accumulator.finish()
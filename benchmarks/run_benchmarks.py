@@ -0,0 +1,388 @@
+"""
+Benchmark the linking and analysis stages on synthetic fleets.
+
+Each (scale, stage) pair runs in a fresh subprocess, so wall time, CPU
+time, and peak RSS are not polluted by earlier runs. Within it, the peak
+RSS is reset once the fleet is set up (on Linux), so it only covers the
+stage itself. Results are written as JSON, for tracking regressions over
+time.
+
+Example
+-------
+python benchmarks/run_benchmarks.py --systems 10 100 1000 \
+    --output bench_results.json
+
+The fetchSystemData stage serves the system files from a local directory,
+or from an S3 stand-in, e.g. with 'moto_server -p 5000' running:
+
+python benchmarks/run_benchmarks.py --stages fetchSystemData \
+    --fetch-url s3://bench/systems --fetch-endpoint http://127.0.0.1:5000
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, BENCHMARK_DIR)
+# The linker reads master-weather-category.csv relative to the repo root
+os.chdir(REPO_ROOT)
+
+import numpy as np
+import pandas as pd
+import weather_event_system_linker as we
+from system_data_fetch import CachedCSVSystemDataSource
+from weather_distance_config import weather_distance_config
+from synthetic import (generateSystemMetadata, generateWeatherEvents,
+                       generateACPowerData, SyntheticDB)
+
+
+STAGES = ['pullWeatherData', 'linkData', 'cleanUpWeatherData',
+          'fetchSystemData', 'examinePVPerformance', 'generatePlotlyGraphic']
+DEFAULT_SCALES = [10, 100, 1000, 10000, 100000]
+
+
+def currentRSSMB():
+    """
+    Current resident set size of this process in MB (Linux), falling back
+    to the peak RSS elsewhere.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        return peakRSSMB()
+
+
+def resetPeakRSS():
+    """
+    Reset the peak resident set size of this process to its current RSS
+    (Linux).
+
+    Returns
+    -------
+    reset: bool
+        False if the peak could not be reset, in which case peakRSSMB() is
+        the peak of the whole process.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peakRSSMB():
+    """
+    Peak resident set size of this process in MB, since the last
+    resetPeakRSS() on Linux.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1e3
+    except (OSError, ValueError, IndexError):
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, KB on Linux
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+def buildFleet(n_systems, events_per_system, min_events, seed):
+    system_metadata = generateSystemMetadata(n_systems, seed=seed)
+    n_events = max(min_events, events_per_system * n_systems)
+    weather_events = generateWeatherEvents(
+        n_events, system_metadata=system_metadata, seed=seed)
+    return system_metadata, weather_events
+
+
+def writeSystemFiles(system_metadata, source_dir, fetch_url=None,
+                     storage_options=None, seed=0):
+    """
+    Write a synthetic AC power CSV file per system to source_dir and, if
+    fetch_url is given, upload them there.
+
+    Returns
+    -------
+    base_path: str
+        Directory or URL holding the '<system_id>.csv' files.
+    """
+    os.makedirs(source_dir, exist_ok=True)
+    for _, system in system_metadata.iterrows():
+        generateACPowerData(
+            pd.to_datetime(system['started_on'], format="%m/%d/%Y %H:%M"),
+            pd.to_datetime(system['ended_on'], format="%m/%d/%Y %H:%M"),
+            seed=seed + int(system['system_id'])).to_csv(
+                os.path.join(source_dir, f"{system['system_id']}.csv"))
+    if fetch_url is None:
+        return source_dir
+    # Optional dependency, only needed for remote benchmarks
+    import fsspec
+    fs, _ = fsspec.core.url_to_fs(fetch_url, **(storage_options or {}))
+    bucket = fetch_url.split("://", 1)[-1].split("/", 1)[0]
+    if not fs.exists(bucket):
+        fs.mkdir(bucket)
+    for file_name in os.listdir(source_dir):
+        fs.put_file(os.path.join(source_dir, file_name),
+                    fetch_url.rstrip('/') + '/' + file_name)
+    return fetch_url
+
+
+def runStage(stage, n_systems, events_per_system=20, min_events=1000,
+             perf_systems=10, seed=0, fetch_url=None, fetch_endpoint=None):
+    """
+    Set up a synthetic fleet and time a single stage.
+
+    Parameters
+    ----------
+    stage: str
+        One of STAGES.
+    n_systems: int
+        Number of systems in the fleet.
+    events_per_system: int, default 20
+        Number of weather events generated per system.
+    min_events: int, default 1000
+        Minimum number of weather events.
+    perf_systems: int, default 10
+        Number of linked systems run through examinePVPerformance and
+        generatePlotlyGraphic (these stages are per system).
+    seed: int, default 0
+        Random seed.
+    fetch_url: str, default None
+        URL the fetchSystemData stage serves the system files from. None
+        uses a local directory.
+    fetch_endpoint: str, default None
+        S3 endpoint for fetch_url, e.g. a moto server.
+
+    Returns
+    -------
+    result: dict
+        Stage timing record. 'rows' is the number of input rows the stage
+        processed: events pulled (pullWeatherData), systems (linkData),
+        candidate pairs (cleanUpWeatherData), system files fetched and
+        parsed (fetchSystemData), AC power samples (examinePVPerformance),
+        and linked events (generatePlotlyGraphic). linkData records also
+        hold the row counts of the linking funnel, and fetchSystemData
+        records the time of a second pass served from the local cache.
+        'peak_rss_mb' is the peak RSS during the stage, and
+        'peak_rss_delta_mb' its increase over the RSS before the stage
+        ('peak_rss_reset' is False where the peak can't be reset, and both
+        then include the setup).
+    """
+    # Files written by the stage are removed with the directory
+    with tempfile.TemporaryDirectory(prefix="bench_") as work_dir:
+        return timeStage(stage, n_systems, work_dir,
+                         events_per_system=events_per_system,
+                         min_events=min_events, perf_systems=perf_systems,
+                         seed=seed, fetch_url=fetch_url,
+                         fetch_endpoint=fetch_endpoint)
+
+
+def timeStage(stage, n_systems, work_dir, events_per_system=20,
+              min_events=1000, perf_systems=10, seed=0, fetch_url=None,
+              fetch_endpoint=None):
+    """
+    Set up a synthetic fleet and time a single stage, see runStage().
+    Stage files are written to work_dir.
+    """
+    system_metadata, weather_events = buildFleet(
+        n_systems, events_per_system, min_events, seed)
+    db = SyntheticDB(weather_events)
+    sys_linker = we.SystemLinker(db, system_metadata,
+                                 weather_distance_config)
+    call = None
+    rows = 0
+    if stage == 'pullWeatherData':
+        call = sys_linker.pullWeatherData
+        rows = len(weather_events)
+    elif stage == 'linkData':
+        call = sys_linker.linkData
+        rows = n_systems
+    elif stage == 'cleanUpWeatherData':
+        weather_candidates = sys_linker.getLinkCandidates()
+
+        def call():
+            return sys_linker.cleanUpWeatherData(
+                weather_candidates, by=['system_position'])
+        rows = len(weather_candidates)
+    elif stage == 'fetchSystemData':
+        storage_options = None
+        if fetch_endpoint is not None:
+            storage_options = {'client_kwargs': {
+                'endpoint_url': fetch_endpoint}}
+        base_path = writeSystemFiles(system_metadata.iloc[:perf_systems],
+                                     os.path.join(work_dir, "systems"),
+                                     fetch_url=fetch_url,
+                                     storage_options=storage_options,
+                                     seed=seed)
+        cache_dir = os.path.join(work_dir, "cache")
+        system_ids = system_metadata['system_id'].values[:perf_systems]
+
+        def call():
+            data_source = CachedCSVSystemDataSource(
+                base_path, storage_options=storage_options,
+                cache_dir=cache_dir)
+            data_source.prefetch(system_ids)
+            for system_id in system_ids:
+                data_source.read(system_id)
+            data_source.close()
+        rows = len(system_ids)
+    else:
+        system_weather_event_master = sys_linker.linkData()
+        system_ids = system_weather_event_master[
+            'system_id'].drop_duplicates().values[:perf_systems]
+        system_data = list()
+        for system_id in system_ids:
+            weather_df_sub = system_weather_event_master[
+                system_weather_event_master['system_id'] == system_id]
+            ac_power_data = generateACPowerData(
+                pd.to_datetime(weather_df_sub[
+                    'system_data_started_on'].iloc[0]),
+                pd.to_datetime(weather_df_sub[
+                    'system_data_ended_on'].iloc[0]),
+                seed=int(system_id))
+            system_data.append((system_id, ac_power_data, weather_df_sub))
+        if stage == 'examinePVPerformance':
+            def call():
+                for system_id, ac_power_data, weather_df_sub in system_data:
+                    sys_linker.examinePVPerformance(ac_power_data,
+                                                    weather_df_sub)
+            rows = sum(len(x[1]) for x in system_data)
+        elif stage == 'generatePlotlyGraphic':
+            plot_dir = os.path.join(work_dir, "plots")
+            os.makedirs(plot_dir)
+
+            def call():
+                for system_id, ac_power_data, weather_df_sub in system_data:
+                    sys_linker.generatePlotlyGraphic(
+                        'PV', ac_power_data, weather_df_sub, 'kW',
+                        str(system_id), output_dir=plot_dir)
+            rows = sum(len(x[2]) for x in system_data)
+        else:
+            raise ValueError(f"Unknown stage '{stage}', expected one of "
+                             f"{STAGES}.")
+    # The peak only covers the stage, not the fleet set up above
+    gc.collect()
+    rss_before = currentRSSMB()
+    peak_reset = resetPeakRSS()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    call()
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.process_time() - cpu_start
+    peak_rss = max(peakRSSMB(), currentRSSMB())
+    result = {'stage': stage,
+              'n_systems': n_systems,
+              'n_events': len(weather_events),
+              'rows': rows,
+              'wall_time_s': wall_time,
+              'cpu_time_s': cpu_time,
+              'rows_per_s': rows / wall_time if wall_time > 0 else None,
+              'rss_before_mb': rss_before,
+              'peak_rss_mb': peak_rss,
+              'peak_rss_delta_mb': peak_rss - rss_before,
+              'peak_rss_reset': peak_reset}
+    if stage == 'linkData':
+        # Row counts at each step of the linking funnel
+        result['funnel'] = dict(sys_linker.instrumentation.funnel)
+    elif stage == 'fetchSystemData':
+        # Unchanged files are only checked against their ETag
+        wall_start = time.perf_counter()
+        call()
+        result['cached_wall_time_s'] = time.perf_counter() - wall_start
+    return result
+
+
+def runIsolated(stage, n_systems, args):
+    """
+    Run one stage in a fresh Python process and return its record.
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--single',
+               '--stages', stage, '--systems', str(n_systems),
+               '--events-per-system', str(args.events_per_system),
+               '--min-events', str(args.min_events),
+               '--perf-systems', str(args.perf_systems),
+               '--seed', str(args.seed)]
+    if args.fetch_url is not None:
+        command += ['--fetch-url', args.fetch_url]
+    if args.fetch_endpoint is not None:
+        command += ['--fetch-endpoint', args.fetch_endpoint]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        return {'stage': stage, 'n_systems': n_systems,
+                'error': completed.stderr.strip().splitlines()[-1:]}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--systems', type=int, nargs='+',
+                        default=DEFAULT_SCALES,
+                        help="Fleet sizes to benchmark.")
+    parser.add_argument('--stages', nargs='+', default=STAGES,
+                        choices=STAGES, help="Stages to benchmark.")
+    parser.add_argument('--events-per-system', type=int, default=20)
+    parser.add_argument('--min-events', type=int, default=1000)
+    parser.add_argument('--perf-systems', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fetch-url', default=None,
+                        help="URL serving the system files for "
+                             "fetchSystemData (default: a local directory).")
+    parser.add_argument('--fetch-endpoint', default=None,
+                        help="S3 endpoint for --fetch-url, e.g. a moto "
+                             "server.")
+    parser.add_argument('--output', default=None,
+                        help="JSON output file (default: stdout).")
+    parser.add_argument('--single', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.single:
+        result = runStage(args.stages[0], args.systems[0],
+                          events_per_system=args.events_per_system,
+                          min_events=args.min_events,
+                          perf_systems=args.perf_systems, seed=args.seed,
+                          fetch_url=args.fetch_url,
+                          fetch_endpoint=args.fetch_endpoint)
+        print(json.dumps(result))
+        return
+    results = list()
+    for n_systems in args.systems:
+        for stage in args.stages:
+            result = runIsolated(stage, n_systems, args)
+            print(f"{n_systems:>7} systems  {stage:<22} "
+                  f"{result.get('wall_time_s', float('nan')):9.3f} s",
+                  file=sys.stderr)
+            results.append(result)
+    report = {'meta': {'timestamp': pd.Timestamp.now(tz='UTC').isoformat(),
+                       'python': platform.python_version(),
+                       'pandas': pd.__version__,
+                       'numpy': np.__version__,
+                       'platform': platform.platform(),
+                       'cpu_count': os.cpu_count(),
+                       'events_per_system': args.events_per_system,
+                       'min_events': args.min_events,
+                       'perf_systems': args.perf_systems,
+                       'seed': args.seed},
+              'results': results}
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Synthetic fleet, storm event, and AC power generators for benchmarking the
+linking and analysis pipeline without PVDRDB or S3 access.
+"""
+
+import sqlite3
+import numpy as np
+import pandas as pd
+from weather_distance_config import weather_distance_config
+from weather_event_store import WEATHER_EVENT_COLUMNS
+
+
+# Rough bounding box of the contiguous US
+LATITUDE_RANGE = (25.0, 49.0)
+LONGITUDE_RANGE = (-124.0, -67.0)
+
+
+def _formatMetadataTimestamp(timestamp):
+    # Same "%m/%d/%Y %H:%M" layout as pv_system_metadata.csv (no zero
+    # padding on month, day, or hour)
+    return (f"{timestamp.month}/{timestamp.day}/{timestamp.year} "
+            f"{timestamp.hour}:{timestamp.minute:02d}")
+
+
+def generateSystemMetadata(n_systems, start_year=2010, end_year=2023,
+                           seed=0):
+    """
+    Generate synthetic PV system metadata.
+
+    Parameters
+    ----------
+    n_systems: int
+        Number of systems.
+    start_year: int, default 2010
+        Earliest year a system can start reporting data.
+    end_year: int, default 2023
+        Latest year a system can stop reporting data.
+    seed: int, default 0
+        Random seed.
+
+    Returns
+    -------
+    system_metadata: Pandas DataFrame
+        Metadata with the columns of pv_system_metadata.csv: 'system_id',
+        'latitude', 'longitude', 'grouping', 'power', 'started_on', and
+        'ended_on'.
+    """
+    rng = np.random.default_rng(seed)
+    period_start = pd.Timestamp(f"{start_year}-01-01")
+    period_minutes = int((pd.Timestamp(f"{end_year}-01-01") -
+                          period_start).total_seconds() // 60)
+    started_on = period_start + pd.to_timedelta(
+        rng.integers(0, period_minutes // 2, n_systems) // 5 * 5, unit='min')
+    ended_on = started_on + pd.to_timedelta(
+        rng.integers(period_minutes // 4, period_minutes // 2, n_systems)
+        // 5 * 5, unit='min')
+    return pd.DataFrame({
+        'system_id': np.arange(n_systems) + 10000,
+        'latitude': rng.uniform(*LATITUDE_RANGE, n_systems),
+        'longitude': rng.uniform(*LONGITUDE_RANGE, n_systems),
+        'grouping': 'Synthetic',
+        'power': np.round(rng.uniform(2, 20, n_systems), 3),
+        'started_on': [_formatMetadataTimestamp(x) for x in started_on],
+        'ended_on': [_formatMetadataTimestamp(x) for x in ended_on]})
+
+
+def generateWeatherEvents(n_events, system_metadata=None, near_fraction=0.5,
+                          start_year=2010, end_year=2023, seed=0):
+    """
+    Generate a synthetic weather_events table.
+
+    Parameters
+    ----------
+    n_events: int
+        Number of events.
+    system_metadata: Pandas DataFrame, default None
+        If given, near_fraction of the events are placed around randomly
+        chosen systems (within a couple hundred km), so they link.
+    near_fraction: float, default 0.5
+        Fraction of events placed near systems.
+    start_year: int, default 2010
+        Earliest event year.
+    end_year: int, default 2023
+        Latest event year.
+    seed: int, default 0
+        Random seed.
+
+    Returns
+    -------
+    weather_events: Pandas DataFrame
+        Events with the WEATHER_EVENT_COLUMNS schema. Timestamps are
+        tz-aware UTC. About 5% of events have types outside the weather
+        distance config.
+    """
+    rng = np.random.default_rng(seed)
+    event_types = np.array(list(weather_distance_config.keys()))
+    event_type = rng.choice(event_types, n_events)
+    other = rng.random(n_events) < 0.05
+    event_type[other] = rng.choice(['Drought', 'Rip Current',
+                                    'Astronomical Low Tide'], other.sum())
+    latitude = rng.uniform(*LATITUDE_RANGE, n_events)
+    longitude = rng.uniform(*LONGITUDE_RANGE, n_events)
+    if system_metadata is not None and len(system_metadata):
+        near = rng.random(n_events) < near_fraction
+        anchor = rng.integers(0, len(system_metadata), near.sum())
+        latitude[near] = system_metadata['latitude'].values[anchor] + \
+            rng.normal(0, 0.6, near.sum())
+        longitude[near] = system_metadata['longitude'].values[anchor] + \
+            rng.normal(0, 0.8, near.sum())
+    # Most events are short, some last several days (floods, heat)
+    period_start = pd.Timestamp(f"{start_year}-01-01", tz='UTC')
+    period_minutes = int((pd.Timestamp(f"{end_year}-01-01", tz='UTC') -
+                          period_start).total_seconds() // 60)
+    start_timestamp = period_start + pd.to_timedelta(
+        rng.integers(0, period_minutes, n_events), unit='min')
+    duration = rng.choice([0, 30, 240, 1440, 1440 * 5], n_events,
+                          p=[0.3, 0.3, 0.2, 0.15, 0.05]) + \
+        rng.integers(0, 120, n_events)
+    end_timestamp = start_timestamp + pd.to_timedelta(duration, unit='min')
+    has_magnitude = rng.random(n_events) < 0.4
+    weather_events = pd.DataFrame({
+        'weather_event_id': np.arange(n_events) + 100000,
+        'state': rng.choice(['MINNESOTA', 'MARYLAND', 'OHIO', 'TEXAS',
+                             'NEW JERSEY', 'COLORADO'], n_events),
+        'location': rng.choice(['County A, United States',
+                                'County B, United States',
+                                'County C, United States'], n_events),
+        'event_type': event_type,
+        'begin_latitude': latitude,
+        'begin_longitude': longitude,
+        'end_latitude': latitude + rng.normal(0, 0.05, n_events),
+        'end_longitude': longitude + rng.normal(0, 0.05, n_events),
+        'start_timestamp': start_timestamp,
+        'end_timestamp': end_timestamp,
+        'magnitude': np.where(has_magnitude,
+                              np.round(rng.uniform(0.5, 80, n_events), 1),
+                              np.nan),
+        'magnitude_type': np.where(has_magnitude, 'EG', None),
+        'damage_property': np.round(rng.exponential(5000, n_events), -2),
+        'damage_crops': np.where(rng.random(n_events) < 0.1,
+                                 np.round(rng.exponential(1000, n_events),
+                                          -2), 0.0),
+        'episode_narrative': rng.choice(
+            ['Thunderstorms moved across the area during the afternoon.',
+             'A strong low pressure system brought heavy precipitation.',
+             'Hot and humid conditions persisted for several days.'],
+            n_events),
+        'comments': None})
+    return weather_events[WEATHER_EVENT_COLUMNS]
+
+
+def generateACPowerData(started_on, ended_on, n_streams=2, freq='60min',
+                        peak_power=5.0, seed=0):
+    """
+    Generate synthetic AC power time series with a daily solar shape and
+    random cloud cover.
+
+    Parameters
+    ----------
+    started_on: str or datetime
+        First timestamp.
+    ended_on: str or datetime
+        Last timestamp.
+    n_streams: int, default 2
+        Number of AC power streams (columns 'ac_power_inv_<n>').
+    freq: str, default '60min'
+        Sampling frequency.
+    peak_power: float, default 5.0
+        Peak clear-sky power of each stream.
+    seed: int, default 0
+        Random seed.
+
+    Returns
+    -------
+    system_ac_power_data: Pandas DataFrame
+        AC power with a naive datetime index.
+    """
+    rng = np.random.default_rng(seed)
+    index = pd.date_range(pd.Timestamp(started_on).floor(freq),
+                          pd.Timestamp(ended_on), freq=freq)
+    hour = (index.hour + index.minute / 60).values
+    day_of_year = index.dayofyear.values
+    day_length = 12 + 3 * np.sin(2 * np.pi * (day_of_year - 80) / 365)
+    solar_shape = np.clip(np.sin(np.pi * (hour - (12 - day_length / 2)) /
+                                 day_length), 0, None)
+    # Cloudiness varies day to day
+    day_number = (index.normalize() - index[0].normalize()).days.values
+    cloudiness = rng.uniform(0.2, 1.0, day_number.max() + 1)[day_number]
+    data = dict()
+    for stream in range(n_streams):
+        noise = rng.normal(1, 0.05, len(index))
+        data[f"ac_power_inv_{stream + 1}"] = np.clip(
+            peak_power * solar_shape * cloudiness * noise, 0, None)
+    return pd.DataFrame(data, index=index)
+
+
+class SyntheticDB():
+    """
+    In-memory SQLite stand-in for the PVDRDB connection object, holding a
+    pvdrdb.weather_events table. Exposes the 'dbconn' and 'dbops'
+    attributes that SystemLinker.pullWeatherData() uses.
+
+    Parameters
+    ----------
+    weather_events: Pandas DataFrame
+        Weather events to load into pvdrdb.weather_events.
+    """
+
+    def __init__(self, weather_events):
+        self.dbconn = sqlite3.connect(':memory:')
+        self.dbconn.execute("attach database ':memory:' as pvdrdb")
+        weather_events = weather_events.copy()
+        for column in ['start_timestamp', 'end_timestamp']:
+            weather_events[column] = weather_events[column].astype(str)
+        weather_events.to_sql('weather_events_load', self.dbconn,
+                              index=False)
+        self.dbconn.execute("create table pvdrdb.weather_events as "
+                            "select * from main.weather_events_load")
+        self.dbconn.execute("drop table main.weather_events_load")
+        self.dbconn.commit()
+        self.dbops = self.dbconn.cursor()
+
+    def insertWeatherEvents(self, weather_events):
+        """
+        Append events to pvdrdb.weather_events (e.g. to test incremental
+        refreshes).
+
+        Returns
+        -------
+        None.
+
+        """
+        weather_events = weather_events.copy()
+        for column in ['start_timestamp', 'end_timestamp']:
+            weather_events[column] = weather_events[column].astype(str)
+        weather_events.to_sql('weather_events_load', self.dbconn,
+                              index=False)
+        self.dbconn.execute("insert into pvdrdb.weather_events "
+                            "select * from main.weather_events_load")
+        self.dbconn.execute("drop table main.weather_events_load")
+        self.dbconn.commit()
+        return
@@ -0,0 +1,464 @@
+"""
+Persistent, memory-mapped daily energy store for a fleet of systems, for
+re-scoring PV performance without reloading any time series.
+"""
+
+import os
+import json
+import time
+import shutil
+import numpy as np
+import pandas as pd
+from pv_performance import DailyEnergyTable, _wallClockDays
+
+
+# Ordered list of the segments of a cube
+CUBE_FILE = "cube.json"
+# Raw little-endian arrays of a segment, memory-mapped by DailyEnergyCube
+ARRAY_FILES = {'energy': ('energy.f8', '<f8'),
+               'cumulative_energy': ('cumulative_energy.f8', '<f8'),
+               'present': ('present.u1', 'u1')}
+
+
+class EnergyCubeWriter():
+    """
+    Add systems' daily energy to a DailyEnergyCube one system at a time.
+    Each system's daily energy is appended to the array files as it is
+    added, so memory does not grow with the fleet.
+
+    The cube holds one series per (system, stream), covering every day from
+    the system's first to last day of data, plus a cumulative sum of each
+    series and its median daily energy per month (over the days with data).
+
+    A cube is a list of segments, and a system is read from the latest
+    segment holding it. Each writer adds one segment with only the systems
+    added to it, so a run costs I/O and disk in proportion to the systems
+    it fetches rather than the fleet. Once the superseded copies outweigh
+    the live data (see compact_ratio), the writer also carries the live
+    systems of the older segments into its own and drops them, a full copy
+    that happens once per fleet's worth of updates.
+
+    The segment is built in a temporary directory inside path, and only
+    becomes part of the cube when close() swaps in the new segment list.
+    abort() (or an exception inside a with block) discards it, leaving the
+    existing cube untouched.
+
+    Parameters
+    ----------
+    path: str
+        Directory of the cube.
+    update: bool, default True
+        If True, the new segment is added to the existing cube at path, so
+        a run only needs to add new or changed systems. If False, the cube
+        is replaced by the added systems only.
+    compact_ratio: float, default 2.0
+        The cube is compacted when it would store more than compact_ratio
+        times the (stream, day) values of its live systems.
+    """
+
+    def __init__(self, path, update=True, compact_ratio=2.0):
+        self.path = os.path.normpath(path)
+        self.update = update
+        self.compact_ratio = compact_ratio
+        self.segment_name = f"segment-{time.time_ns()}-{os.getpid()}"
+        self.build_path = os.path.join(self.path,
+                                       self.segment_name + ".build")
+        os.makedirs(self.build_path)
+        self.files = {name: open(os.path.join(self.build_path, file_name),
+                                 'wb')
+                      for name, (file_name, _) in ARRAY_FILES.items()}
+        self.streams = dict()
+        self.system_ids = list()
+        self.system_first_day = list()
+        self.system_n_days = list()
+        self.system_n_series = list()
+        self.series_stream = list()
+        self.month_median = list()
+
+    def add(self, system_id, energy_table):
+        """
+        Add a system's daily energy.
+
+        Parameters
+        ----------
+        system_id: int
+            System ID.
+        energy_table: pv_performance.DailyEnergyTable
+            The system's daily energy table.
+
+        Returns
+        -------
+        None.
+
+        """
+        if len(energy_table.days):
+            first_day = int(energy_table.days[0])
+            n_days = int(energy_table.days[-1]) - first_day + 1
+        else:
+            first_day, n_days = 0, 0
+        # Days without data hold zero energy, and are marked as missing
+        # so they are left out of the monthly medians
+        day_position = energy_table.days - first_day
+        present = np.zeros(n_days, dtype='u1')
+        present[day_position] = 1
+        energy = np.zeros((len(energy_table.streams), n_days))
+        energy[:, day_position] = energy_table.energy.T
+        cumulative_energy = np.zeros((len(energy_table.streams), n_days + 1))
+        np.cumsum(energy, axis=1, out=cumulative_energy[:, 1:])
+        self.files['energy'].write(energy.astype('<f8').tobytes())
+        self.files['cumulative_energy'].write(
+            cumulative_energy.astype('<f8').tobytes())
+        self.files['present'].write(present.tobytes())
+        self.system_ids.append(system_id)
+        self.system_first_day.append(first_day)
+        self.system_n_days.append(n_days)
+        self.system_n_series.append(len(energy_table.streams))
+        self.series_stream.extend(
+            self.streams.setdefault(stream, len(self.streams))
+            for stream in energy_table.streams)
+        self.month_median.append(energy_table.month_median.T)
+        return
+
+    def _carryOver(self, existing_cube):
+        # Live systems of the existing cube that were not added in this run
+        added = set(self.system_ids)
+        for system_id in existing_cube.systemIds().tolist():
+            if system_id not in added:
+                self.add(system_id, existing_cube.energyTable(system_id))
+        return
+
+    def _segments(self):
+        """
+        Get the segments the new one is added to, carrying the live systems
+        over (and starting a new list) when the cube needs compacting.
+        """
+        if not self.update or not os.path.exists(
+                os.path.join(self.path, CUBE_FILE)):
+            return list()
+        existing_cube = DailyEnergyCube(self.path)
+        added_series_days = int(np.dot(self.system_n_days,
+                                       self.system_n_series))
+        kept = ~np.isin(existing_cube.systemIds(), self.system_ids)
+        live_series_days = int(existing_cube.seriesDays()[kept].sum()) + \
+            added_series_days
+        stored_series_days = existing_cube.n_stored_series_days + \
+            added_series_days
+        if stored_series_days > self.compact_ratio * live_series_days:
+            self._carryOver(existing_cube)
+            return list()
+        return list(existing_cube.segment_names)
+
+    def abort(self):
+        """
+        Discard the cube being built. The existing cube at path is kept.
+
+        Returns
+        -------
+        None.
+
+        """
+        for f in self.files.values():
+            f.close()
+        shutil.rmtree(self.build_path, ignore_errors=True)
+        return
+
+    def close(self):
+        """
+        Write the system and series tables, completing the segment, and
+        add it to the cube at path.
+
+        Returns
+        -------
+        None.
+
+        """
+        if len(set(self.system_ids)) != len(self.system_ids):
+            self.abort()
+            raise ValueError("Each system can only be added to the energy "
+                             "cube once.")
+        segments = self._segments()
+        for f in self.files.values():
+            f.close()
+        system_ids = np.asarray(self.system_ids, dtype=np.int64)
+        system_n_days = np.asarray(self.system_n_days, dtype=np.int64)
+        system_n_series = np.asarray(self.system_n_series, dtype=np.int64)
+        series_n_days = np.repeat(system_n_days, system_n_series)
+        tables = {
+            'system_id': system_ids,
+            'system_first_day': np.asarray(self.system_first_day,
+                                           dtype=np.int64),
+            'system_n_days': system_n_days,
+            'system_day_offset': np.concatenate(
+                [[0], np.cumsum(system_n_days)[:-1]]).astype(np.int64),
+            'system_n_series': system_n_series,
+            'system_series_start': np.concatenate(
+                [[0], np.cumsum(system_n_series)[:-1]]).astype(np.int64),
+            'series_stream': np.asarray(self.series_stream, dtype=np.int64),
+            'series_offset': np.concatenate(
+                [[0], np.cumsum(series_n_days)[:-1]]).astype(np.int64),
+            'month_median': np.vstack(self.month_median) if
+            len(self.month_median) else np.zeros((0, 12))}
+        # Each series' cumulative sums have one extra (leading zero) entry
+        tables['series_cumulative_offset'] = tables['series_offset'] + \
+            np.arange(len(series_n_days))
+        for name, values in tables.items():
+            np.save(os.path.join(self.build_path, name + ".npy"), values)
+        with open(os.path.join(self.build_path, "manifest.json"), 'w') as f:
+            json.dump({'streams': list(self.streams),
+                       'n_days': int(system_n_days.sum()),
+                       'n_series_days': int(series_n_days.sum()),
+                       'n_series': int(len(series_n_days))}, f, indent=2)
+        os.replace(self.build_path, os.path.join(self.path,
+                                                 self.segment_name))
+        # Swap in the new segment list in one step, then remove the
+        # segments it no longer lists
+        segments.append(self.segment_name)
+        with open(os.path.join(self.path, CUBE_FILE + ".tmp"), 'w') as f:
+            json.dump({'segments': segments}, f, indent=2)
+        os.replace(os.path.join(self.path, CUBE_FILE + ".tmp"),
+                   os.path.join(self.path, CUBE_FILE))
+        for name in os.listdir(self.path):
+            if name.startswith("segment-") and not name.endswith(".build") \
+                    and name not in segments:
+                shutil.rmtree(os.path.join(self.path, name),
+                              ignore_errors=True)
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class DailyEnergyCube():
+    """
+    Read-only, memory-mapped daily energy for a fleet, indexed by (system,
+    stream, day), built with EnergyCubeWriter (or the SystemPipeline's
+    energy_cube_path). Performance scores for any set of events are
+    computed by array indexing, so events can be re-scored (e.g. after
+    changing weather_distance_config) without reloading the time series.
+
+    The cube is read from its segments (see EnergyCubeWriter), each system
+    from the latest segment holding it. The arrays are memory-mapped, so
+    worker processes opening the same cube share its pages; pickling a
+    cube (e.g. to send it to a process pool) only sends its path.
+
+    Parameters
+    ----------
+    path: str
+        Directory of the cube.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, CUBE_FILE)) as f:
+            self.segment_names = json.load(f)['segments']
+        self.segments = [_EnergyCubeSegment(os.path.join(path, x))
+                         for x in self.segment_names]
+        self.n_stored_series_days = sum(x.n_series_days
+                                        for x in self.segments)
+        system_id = np.concatenate([np.zeros(0, dtype=np.int64)] + [
+            np.asarray(x.system_id) for x in self.segments])
+        segment = np.repeat(np.arange(len(self.segments)),
+                            [len(x.system_id) for x in self.segments])
+        position = np.concatenate([np.zeros(0, dtype=np.int64)] + [
+            np.arange(len(x.system_id)) for x in self.segments])
+        # The latest segment holding a system wins
+        live = ~pd.Index(system_id[::-1]).duplicated()[::-1]
+        self.system_id = system_id[live]
+        self.system_segment = segment[live]
+        self.system_position = position[live]
+        self.system_index = pd.Index(self.system_id)
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def systemIds(self):
+        """
+        Get the IDs of the systems in the cube.
+
+        Returns
+        -------
+        system_ids: Numpy array
+            System IDs, by segment, then in the order they were added.
+        """
+        return np.asarray(self.system_id)
+
+    def seriesDays(self):
+        """
+        Get the number of stored (stream, day) values of each system.
+
+        Returns
+        -------
+        series_days: Numpy array
+            Stream count times day count, in systemIds() order.
+        """
+        series_days = np.zeros(len(self.system_id), dtype=np.int64)
+        for number, segment in enumerate(self.segments):
+            in_segment = np.flatnonzero(self.system_segment == number)
+            position = self.system_position[in_segment]
+            series_days[in_segment] = \
+                np.asarray(segment.system_n_days)[position] * \
+                np.asarray(segment.system_n_series)[position]
+        return series_days
+
+    def energyTable(self, system_id):
+        """
+        Get a system's daily energy table.
+
+        Parameters
+        ----------
+        system_id: int
+            System ID.
+
+        Returns
+        -------
+        energy_table: pv_performance.DailyEnergyTable
+            The table the system was last added with.
+        """
+        position = self.system_index.get_loc(system_id)
+        return self.segments[self.system_segment[position]].energyTable(
+            self.system_position[position])
+
+    def scoreEvents(self, weather_events, n_days=2):
+        """
+        Compare production around the start of each extreme weather event
+        to the median daily production for that month, for every stream of
+        the event's system. Matches pv_performance.scoreEventPerformance
+        run on each system's data.
+
+        Parameters
+        ----------
+        weather_events: Pandas DataFrame
+            Weather events of any set of systems, containing the
+            'system_id' and 'weather_event_started_on' columns.
+        n_days: int, default 2
+            Number of days in the event window, starting on the day the
+            event starts.
+
+        Returns
+        -------
+        agg_df: Pandas DataFrame
+            One row per (event, stream) with the event columns plus
+            'data_stream' and 'pct_median_output'. Rows are ordered by
+            event, then stream. Events of systems that are not in the cube
+            are left out.
+        """
+        position = self.system_index.get_indexer(weather_events['system_id'])
+        event_segment = np.where(position >= 0, self.system_segment[
+            np.maximum(position, 0)], -1)
+        frames = list()
+        event_positions = list()
+        for number, segment in enumerate(self.segments):
+            in_segment = np.flatnonzero(event_segment == number)
+            agg_df = segment.scoreEvents(weather_events.iloc[in_segment],
+                                         n_days=n_days)
+            if len(agg_df):
+                frames.append(agg_df)
+                # Each event has one row per stream of its system
+                n_series = np.asarray(segment.system_n_series)[
+                    self.system_position[position[in_segment]]]
+                event_positions.append(np.repeat(in_segment, n_series))
+        if len(frames) == 0:
+            return pd.DataFrame()
+        if len(frames) == 1:
+            return frames[0]
+        order = np.argsort(np.concatenate(event_positions), kind='stable')
+        return pd.concat(frames, ignore_index=True).iloc[order].reset_index(
+            drop=True)
+
+
+class _EnergyCubeSegment():
+    """
+    Memory-mapped arrays and tables of one segment of a DailyEnergyCube,
+    holding the systems of one EnergyCubeWriter.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        self.streams = np.asarray(manifest['streams'], dtype=object)
+        self.n_series_days = manifest['n_series_days']
+        lengths = {'energy': manifest['n_series_days'],
+                   'cumulative_energy': (manifest['n_series_days'] +
+                                         manifest['n_series']),
+                   'present': manifest['n_days']}
+        for name, (file_name, dtype) in ARRAY_FILES.items():
+            # Zero-length files can't be memory-mapped
+            if lengths[name] == 0:
+                values = np.zeros(0, dtype=dtype)
+            else:
+                values = np.memmap(os.path.join(path, file_name),
+                                   dtype=dtype, mode='r',
+                                   shape=(lengths[name],))
+            setattr(self, name, values)
+        for name in ['system_id', 'system_first_day', 'system_n_days',
+                     'system_day_offset', 'system_n_series',
+                     'system_series_start', 'series_stream', 'series_offset',
+                     'series_cumulative_offset', 'month_median']:
+            setattr(self, name, np.load(os.path.join(path, name + ".npy"),
+                                        mmap_mode='r'))
+        self.system_index = pd.Index(self.system_id)
+
+    def energyTable(self, position):
+        # Daily energy table of the system at a position in the segment
+        first_day = self.system_first_day[position]
+        n_days = self.system_n_days[position]
+        day_offset = self.system_day_offset[position]
+        present = np.flatnonzero(
+            self.present[day_offset:day_offset + n_days])
+        series = np.arange(self.system_n_series[position]) + \
+            self.system_series_start[position]
+        energy = np.vstack(
+            [np.zeros((0, len(present)))] +
+            [self.energy[offset:offset + n_days][present]
+             for offset in self.series_offset[series]])
+        return DailyEnergyTable(days=first_day + present, energy=energy.T,
+                                streams=list(self.streams[
+                                    self.series_stream[series]]))
+
+    def scoreEvents(self, weather_events, n_days=2):
+        # Scores of the events of the segment's systems, see
+        # DailyEnergyCube.scoreEvents()
+        system_position = self.system_index.get_indexer(
+            weather_events['system_id'])
+        n_series = np.where(system_position >= 0, np.asarray(
+            self.system_n_series)[np.maximum(system_position, 0)], 0)
+        # One row per (event, stream of the event's system)
+        event_position = np.repeat(np.arange(len(weather_events)), n_series)
+        system_position = system_position[event_position]
+        row_start = np.cumsum(n_series) - n_series
+        series = np.asarray(self.system_series_start)[system_position] + \
+            np.arange(len(event_position)) - row_start[event_position]
+        started_on = pd.to_datetime(weather_events[
+            'weather_event_started_on'])
+        event_day = _wallClockDays(started_on)[event_position]
+        event_month = np.asarray(pd.DatetimeIndex(started_on).month)[
+            event_position]
+        # Window sums from the cumulative energy of each series
+        first_day = np.asarray(self.system_first_day)[system_position]
+        series_n_days = np.asarray(self.system_n_days)[system_position]
+        cumulative_offset = np.asarray(self.series_cumulative_offset)[series]
+        lower = np.clip(event_day - first_day, 0, series_n_days)
+        upper = np.clip(event_day + n_days - first_day, 0, series_n_days)
+        window_energy = self.cumulative_energy[cumulative_offset + upper] - \
+            self.cumulative_energy[cumulative_offset + lower]
+        month_median = np.asarray(self.month_median)[series, event_month - 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pct_median_output = window_energy / month_median
+        if len(event_position) == 0:
+            return pd.DataFrame()
+        agg_df = weather_events.iloc[event_position].reset_index(drop=True)
+        agg_df['data_stream'] = self.streams[
+            np.asarray(self.series_stream)[series]]
+        agg_df['pct_median_output'] = pct_median_output
+        return agg_df
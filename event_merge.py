@@ -0,0 +1,123 @@
+"""
+Interval merge engine for combining overlapping or back-to-back weather
+events of the same master category into a single storm.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def _eventDays(timestamps):
+    """
+    Integer day numbers (days since epoch) of timestamps, on their own
+    wall-clock calendar.
+    """
+    timestamps = pd.to_datetime(timestamps)
+    if timestamps.dt.tz is not None:
+        timestamps = timestamps.dt.tz_localize(None)
+    return timestamps.values.astype("datetime64[D]").astype(np.int64)
+
+
+def assignStormIds(weather_events, by=None):
+    """
+    Label weather events with the storm they belong to, in one sweep.
+
+    Events are sorted by (by..., 'weather_event_master', start day). A new
+    storm starts at the first event of each group, or when an event starts
+    more than one day after the latest end day seen so far in the current
+    storm. Events that overlap or fall on adjacent days are chained
+    together, and a chain never crosses a master category (or 'by' group)
+    boundary.
+
+    Parameters
+    ----------
+    weather_events: Pandas DataFrame
+        Weather events containing 'weather_event_master',
+        'start_timestamp', and 'end_timestamp' columns.
+    by: list, default None
+        Extra columns to group by before merging, e.g. ['system_id'].
+
+    Returns
+    -------
+    storm_id: Numpy array
+        Storm label for each event, in the input row order. Labels are
+        consecutive integers starting at 0.
+    """
+    keys = list(by or []) + ['weather_event_master']
+    n_events = len(weather_events)
+    if n_events == 0:
+        return np.array([], dtype=np.int64)
+    start_day = _eventDays(weather_events['start_timestamp'])
+    end_day = np.maximum(_eventDays(weather_events['end_timestamp']),
+                         start_day)
+    key_codes = [pd.factorize(weather_events[key])[0] for key in keys]
+    # np.lexsort sorts by its last key first
+    order = np.lexsort([np.arange(n_events), start_day] + key_codes[::-1])
+    sorted_codes = np.column_stack([codes[order] for codes in key_codes])
+    new_group = np.ones(n_events, dtype=bool)
+    new_group[1:] = np.any(sorted_codes[1:] != sorted_codes[:-1], axis=1)
+    sorted_start = start_day[order]
+    group_number = np.cumsum(new_group) - 1
+    # Latest end day seen so far within each group
+    running_end = pd.Series(end_day[order]).groupby(
+        group_number).cummax().values
+    new_storm = new_group.copy()
+    new_storm[1:] |= sorted_start[1:] > running_end[:-1] + 1
+    storm_id = np.empty(n_events, dtype=np.int64)
+    storm_id[order] = np.cumsum(new_storm) - 1
+    return storm_id
+
+
+def mergeEventIntervals(weather_events, by=None):
+    """
+    Merge overlapping or adjacent-day weather events of the same master
+    category into storms, keeping one representative row per storm.
+
+    The representative row is the event nearest to the system (the first
+    one in input order on ties). Its timestamps are widened to the storm's
+    earliest start and latest end, and its magnitude and damage values are
+    replaced by the storm maximums.
+
+    Parameters
+    ----------
+    weather_events: Pandas DataFrame
+        Weather events containing 'weather_event_master',
+        'start_timestamp', 'end_timestamp', 'magnitude', 'damage_property',
+        'damage_crops', and 'min_distance_to_weather_event_km' columns.
+    by: list, default None
+        Extra columns to group by before merging, e.g. ['system_id'].
+
+    Returns
+    -------
+    storms: Pandas DataFrame
+        One row per storm, with all input columns plus
+        'weather_event_started_on' and 'weather_event_ended_on'. Rows are
+        in the input order of the representative events. Storms without
+        any known distance are dropped.
+    """
+    weather_events = weather_events.reset_index(drop=True)
+    storm_id = assignStormIds(weather_events, by=by)
+    storm_stats = weather_events[[
+        'start_timestamp', 'end_timestamp', 'magnitude', 'damage_property',
+        'damage_crops', 'min_distance_to_weather_event_km']].groupby(
+            storm_id).agg({'start_timestamp': 'min',
+                           'end_timestamp': 'max',
+                           'magnitude': 'max',
+                           'damage_property': 'max',
+                           'damage_crops': 'max',
+                           'min_distance_to_weather_event_km': 'min'})
+    # Representative: nearest event, then first in input order
+    distance = weather_events['min_distance_to_weather_event_km'].values
+    order = np.lexsort([np.arange(len(weather_events)), distance, storm_id])
+    first_in_storm = np.ones(len(order), dtype=bool)
+    first_in_storm[1:] = storm_id[order][1:] != storm_id[order][:-1]
+    representative = np.sort(order[first_in_storm & ~np.isnan(
+        distance[order])])
+    storms = weather_events.iloc[representative].copy()
+    stats = storm_stats.loc[storm_id[representative]]
+    storms['weather_event_started_on'] = stats['start_timestamp'].array
+    storms['weather_event_ended_on'] = stats['end_timestamp'].array
+    storms['magnitude'] = stats['magnitude'].array
+    storms['damage_property'] = stats['damage_property'].array
+    storms['damage_crops'] = stats['damage_crops'].array
+    return storms
@@ -0,0 +1,332 @@
+"""
+Per-stage timing, funnel counts, and profiling hooks for the linking and
+analysis pipeline.
+"""
+
+import os
+import json
+import time
+import logging
+import cProfile
+import functools
+from contextlib import contextmanager
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class LogSink():
+    """
+    Write every stage and count record as a structured (JSON) log line.
+
+    Parameters
+    ----------
+    log: logging.Logger, default None
+        Logger to write to. Defaults to this module's logger.
+    level: int, default logging.INFO
+        Log level of the records.
+    """
+
+    def __init__(self, log=None, level=logging.INFO):
+        self.log = log or logger
+        self.level = level
+
+    def emit(self, record):
+        self.log.log(self.level, json.dumps(record, default=str))
+
+    def close(self, summary):
+        self.log.log(self.level, json.dumps(
+            {'record': 'summary', 'stages': summary['stages'],
+             'funnel': summary['funnel']}, default=str))
+
+
+class JSONSummarySink():
+    """
+    Write the run summary (per stage, per system, and funnel counts) to a
+    JSON file when the instrumentation is closed.
+
+    Parameters
+    ----------
+    path: str
+        Output JSON file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, record):
+        return
+
+    def close(self, summary):
+        with open(self.path, 'w') as f:
+            json.dump(summary, f, indent=2, default=str)
+
+
+class Instrumentation():
+    """
+    Record wall and CPU time per stage and per system, plus row counts at
+    each step of the linking funnel, and pass them to pluggable sinks.
+
+    Parameters
+    ----------
+    sinks: list, default None
+        Objects with emit(record) and close(summary) methods, e.g. LogSink
+        and JSONSummarySink.
+    profile_system_id: int, default None
+        If set, every stage run for this system is profiled.
+    profile_stages: list, default None
+        Stages to profile for fleet-level calls (no system ID), e.g.
+        ['linkData'].
+    profiler: str, default 'cprofile'
+        'cprofile' (writes .prof files, readable with pstats/snakeviz) or
+        'pyinstrument' (writes .html, requires pyinstrument).
+    profile_dir: str, default "./profiles"
+        Directory the profiles are written to.
+    """
+
+    def __init__(self, sinks=None, profile_system_id=None,
+                 profile_stages=None, profiler='cprofile',
+                 profile_dir="./profiles"):
+        self.sinks = list(sinks or [])
+        self.profile_system_id = profile_system_id
+        self.profile_stages = set(profile_stages or [])
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+        self.stage_records = list()
+        self.funnel = dict()
+        self.system_funnel = dict()
+        self._profiling = False
+
+    def _shouldProfile(self, name, system_id):
+        # Profilers can't be nested, the outer stage's profile covers it
+        if self._profiling:
+            return False
+        if system_id is None:
+            return name in self.profile_stages
+        return (self.profile_system_id is not None and
+                str(system_id) == str(self.profile_system_id))
+
+    def _startProfiler(self):
+        if self.profiler == 'pyinstrument':
+            # Optional dependency, only needed when selected
+            import pyinstrument
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        return profiler
+
+    def _dumpProfiler(self, profiler, name, system_id):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        file_stem = os.path.join(
+            self.profile_dir,
+            name if system_id is None else f"{name}_{system_id}")
+        if self.profiler == 'pyinstrument':
+            profiler.stop()
+            with open(file_stem + ".html", 'w') as f:
+                f.write(profiler.output_html())
+        else:
+            profiler.disable()
+            profiler.dump_stats(file_stem + ".prof")
+        return
+
+    def record(self, name, wall_time, cpu_time, system_id=None):
+        """
+        Record the timing of a stage run.
+
+        Parameters
+        ----------
+        name: str
+            Stage name.
+        wall_time: float
+            Wall time, in seconds.
+        cpu_time: float
+            CPU time, in seconds.
+        system_id: int, default None
+            System the stage ran for. None for fleet-level calls.
+
+        Returns
+        -------
+        None.
+
+        """
+        if isinstance(system_id, np.generic):
+            system_id = system_id.item()
+        stage_record = {'record': 'stage', 'stage': name,
+                        'system_id': system_id, 'wall_time_s': wall_time,
+                        'cpu_time_s': cpu_time}
+        self.stage_records.append(stage_record)
+        for sink in self.sinks:
+            sink.emit(stage_record)
+        return
+
+    @contextmanager
+    def stage(self, name, system_id=None):
+        """
+        Time (and optionally profile) a block of code as a stage. Stages
+        can be nested, e.g. cleanUpWeatherData runs inside linkData.
+
+        Parameters
+        ----------
+        name: str
+            Stage name.
+        system_id: int, default None
+            System the stage runs for. None for fleet-level calls.
+        """
+        profiler = None
+        if self._shouldProfile(name, system_id):
+            profiler = self._startProfiler()
+            self._profiling = True
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.process_time() - cpu_start
+            if profiler is not None:
+                self._dumpProfiler(profiler, name, system_id)
+                self._profiling = False
+            self.record(name, wall_time, cpu_time, system_id=system_id)
+
+    def count(self, step, system_ids):
+        """
+        Record the number of rows at a step of the linking funnel.
+
+        Parameters
+        ----------
+        step: str
+            Funnel step, e.g. 'spatial_candidates'.
+        system_ids: array-like
+            System ID of every row at this step.
+
+        Returns
+        -------
+        None.
+
+        """
+        system_ids, counts = np.unique(np.asarray(system_ids),
+                                       return_counts=True)
+        # Counts add up over repeated calls (e.g. incremental linking)
+        self.funnel[step] = self.funnel.get(step, 0) + int(counts.sum())
+        system_funnel = self.system_funnel.setdefault(step, dict())
+        for system_id, n_rows in zip(system_ids.tolist(), counts.tolist()):
+            system_funnel[system_id] = system_funnel.get(system_id, 0) + \
+                n_rows
+        count_record = {'record': 'count', 'step': step,
+                        'rows': int(counts.sum()),
+                        'systems': len(system_ids)}
+        for sink in self.sinks:
+            sink.emit(count_record)
+        return
+
+    def summary(self, top_n=20):
+        """
+        Summarize the recorded stages and funnel counts.
+
+        Parameters
+        ----------
+        top_n: int, default 20
+            Number of slowest systems, and systems with the most
+            candidates, to list.
+
+        Returns
+        -------
+        summary: dict
+            'stages' (calls, total and max wall/CPU time per stage),
+            'funnel' (fleet row counts per step), 'slowest_systems',
+            'largest_funnels', and 'systems' (per-system totals and funnel
+            counts).
+        """
+        stages = dict()
+        systems = dict()
+        for stage_record in self.stage_records:
+            stage = stages.setdefault(stage_record['stage'], {
+                'calls': 0, 'wall_time_s': 0.0, 'cpu_time_s': 0.0,
+                'max_wall_time_s': 0.0})
+            stage['calls'] += 1
+            stage['wall_time_s'] += stage_record['wall_time_s']
+            stage['cpu_time_s'] += stage_record['cpu_time_s']
+            stage['max_wall_time_s'] = max(stage['max_wall_time_s'],
+                                           stage_record['wall_time_s'])
+            if stage_record['system_id'] is not None:
+                system = systems.setdefault(str(stage_record['system_id']),
+                                            {'wall_time_s': 0.0,
+                                             'cpu_time_s': 0.0,
+                                             'stages': dict()})
+                system['wall_time_s'] += stage_record['wall_time_s']
+                system['cpu_time_s'] += stage_record['cpu_time_s']
+                system['stages'][stage_record['stage']] = \
+                    system['stages'].get(stage_record['stage'], 0.0) + \
+                    stage_record['wall_time_s']
+        for step, system_counts in self.system_funnel.items():
+            for system_id, n_rows in system_counts.items():
+                system = systems.setdefault(str(system_id), {
+                    'wall_time_s': 0.0, 'cpu_time_s': 0.0,
+                    'stages': dict()})
+                system.setdefault('funnel', dict())[step] = n_rows
+        first_step = next(iter(self.system_funnel), None)
+        largest_funnels = sorted(
+            systems.items(),
+            key=lambda x: -x[1].get('funnel', {}).get(first_step, 0))
+        slowest = sorted(systems.items(), key=lambda x: -x[1]['wall_time_s'])
+        return {'stages': stages,
+                'funnel': dict(self.funnel),
+                'slowest_systems': [
+                    {'system_id': system_id,
+                     'wall_time_s': system['wall_time_s'],
+                     'stages': system['stages']}
+                    for system_id, system in slowest[:top_n]
+                    if system['wall_time_s'] > 0],
+                'largest_funnels': [
+                    {'system_id': system_id, 'funnel': system['funnel']}
+                    for system_id, system in largest_funnels[:top_n]
+                    if 'funnel' in system],
+                'systems': systems}
+
+    def close(self):
+        """
+        Pass the summary to every sink (e.g. to write the JSON file).
+
+        Returns
+        -------
+        summary: dict
+            See summary().
+        """
+        summary = self.summary()
+        for sink in self.sinks:
+            sink.close(summary)
+        return summary
+
+
+def instrumentedStage(method):
+    """
+    Decorator timing a method as a stage named after it, using the
+    instrumentation of the method's object (self.instrumentation).
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.instrumentation.stage(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def systemIds(system_metadata):
+    """
+    Get the system ID of every system_metadata row, falling back to the row
+    position if there is no 'system_id' column.
+    """
+    if 'system_id' in system_metadata.columns:
+        return system_metadata['system_id'].values
+    return np.arange(len(system_metadata))
+
+
+def eventSystemId(weather_events):
+    """
+    Get the system ID of a per-system weather event frame, or None.
+    """
+    if 'system_id' in weather_events.columns and len(weather_events):
+        return weather_events['system_id'].iloc[0]
+    return None
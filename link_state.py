@@ -0,0 +1,170 @@
+"""
+Saved state of a previous linking run, for incremental re-linking.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+# Bump when the saved files or the linking output change shape
+LINK_STATE_VERSION = 2
+# Distance columns of the saved (system, event) pairs
+DISTANCE_COLUMNS = ['distance_to_weather_event_start_km',
+                    'distance_to_weather_event_end_km',
+                    'min_distance_to_weather_event_km']
+
+
+def configHash(weather_distance_config, master_event_type,
+               geodesic_refinement=True):
+    """
+    Hash everything besides the system metadata and the events that the
+    linking output depends on.
+
+    Parameters
+    ----------
+    weather_distance_config: dict
+        Distance (km) per weather event type.
+    master_event_type: Pandas Series
+        Master category per event type.
+    geodesic_refinement: bool, default True
+        Whether distances near the thresholds are refined.
+
+    Returns
+    -------
+    config_hash: str
+        SHA-256 hex digest.
+    """
+    config = {'version': LINK_STATE_VERSION,
+              'weather_distance_config': list(
+                  weather_distance_config.items()),
+              'master_event_type': sorted(
+                  master_event_type.astype(str).items()),
+              'geodesic_refinement': bool(geodesic_refinement)}
+    return hashlib.sha256(json.dumps(config, default=str).encode()
+                          ).hexdigest()
+
+
+def systemFingerprints(system_metadata):
+    """
+    Hash every system_metadata row, so changed systems can be found.
+
+    Parameters
+    ----------
+    system_metadata: Pandas DataFrame
+        System metadata.
+
+    Returns
+    -------
+    fingerprints: Numpy array
+        One uint64 hash per row.
+    """
+    return pd.util.hash_pandas_object(system_metadata,
+                                      index=False).to_numpy()
+
+
+class LinkState():
+    """
+    Files kept between linking runs: the (system, event) pairs within the
+    max distance and each system's data period, the linked output, a
+    fingerprint of every system row, and a state file with the config hash
+    and the event watermark (max weather_event_id linked).
+
+    Parameters
+    ----------
+    state_dir: str, default "./link_state"
+        Directory holding the state.
+
+    Notes
+    -----
+    Requires pyarrow (or fastparquet) for the Parquet files.
+    """
+
+    def __init__(self, state_dir="./link_state"):
+        self.state_dir = state_dir
+        self.state_file = os.path.join(state_dir, "state.json")
+        self.pairs_file = os.path.join(state_dir, "pairs.parquet")
+        self.links_file = os.path.join(state_dir, "links.parquet")
+        self.fingerprints_file = os.path.join(state_dir,
+                                              "fingerprints.parquet")
+
+    def read(self, config_hash):
+        """
+        Read the saved state.
+
+        Parameters
+        ----------
+        config_hash: str
+            Config hash of this run, see configHash().
+
+        Returns
+        -------
+        state: dict or None
+            'watermark' (max weather_event_id linked, or None), 'pairs',
+            'links', and 'fingerprints' (Pandas DataFrames). None if there
+            is no usable state (missing, or saved with another config).
+        """
+        if not os.path.exists(self.state_file):
+            return None
+        with open(self.state_file) as f:
+            state = json.load(f)
+        if state.get('config_hash') != config_hash:
+            return None
+        state['pairs'] = pd.read_parquet(self.pairs_file)
+        state['links'] = pd.read_parquet(self.links_file)
+        state['fingerprints'] = pd.read_parquet(self.fingerprints_file)
+        return state
+
+    def save(self, config_hash, watermark, pairs, links, fingerprints):
+        """
+        Save the state of a linking run.
+
+        Parameters
+        ----------
+        config_hash: str
+            Config hash of the run.
+        watermark: int
+            Max weather_event_id linked, or None.
+        pairs: Pandas DataFrame
+            (system, event) pairs, with 'system_id', 'weather_event_id', and
+            the distance columns.
+        links: Pandas DataFrame
+            Linked output.
+        fingerprints: Pandas DataFrame
+            'system_id' and 'fingerprint' of every system.
+
+        Returns
+        -------
+        None.
+
+        """
+        os.makedirs(self.state_dir, exist_ok=True)
+        # The state file goes last, so an interrupted save is not used
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+        pairs.to_parquet(self.pairs_file, index=False)
+        links.reset_index(drop=True).to_parquet(self.links_file, index=False)
+        fingerprints.to_parquet(self.fingerprints_file, index=False)
+        if isinstance(watermark, np.generic):
+            watermark = watermark.item()
+        with open(self.state_file, 'w') as f:
+            json.dump({'config_hash': config_hash, 'watermark': watermark},
+                      f, indent=2)
+        return
+
+    def clear(self):
+        """
+        Remove the saved state, so the next run links everything.
+
+        Returns
+        -------
+        None.
+
+        """
+        for path in [self.state_file, self.pairs_file, self.links_file,
+                     self.fingerprints_file]:
+            if os.path.exists(path):
+                os.remove(path)
+        return
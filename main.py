@@ -5,112 +5,162 @@ Created on Fri May 16 09:55:04 2025
 @author: kperry
 """
 
+import logging
 import pandas as pd
-import plotly.express as px
 import weather_event_system_linker as we
+from results_io import ResultStore
+from pipeline import SystemPipeline
+from system_data_fetch import CachedCSVSystemDataSource
+from energy_cube import DailyEnergyCube
+from sharded_linking import ShardedLinkJob
+from instrumentation import Instrumentation, LogSink, JSONSummarySink
 import pvdrdb_tools as pvdrdb
-import glob as glob
-import os
-
-
-# Distances are in KM!!!
-weather_distance_config = {'Flood': 30,
-                            'Coastal Flood': 30,
-                            'Flash Flood': 30,
-                            'Heavy Rain': 10,
-                            'Waterspout': 10,
-                            'Tornado': 5,
-                            'Thunderstorm Wind': 20,
-                            'Marine Thunderstorm Wind': 20,
-                            'Marine Strong Wind': 20,
-                            'High Wind': 20,
-                            'Strong Wind': 20,
-                            'Dust Devil': 10,
-                            'Marine High Wind': 20,
-                            'Funnel Cloud': 10,
-                            'Marine Hail': 10,
-                            'Hail': 10,
-                            "Sleet": 10,
-                            'Lightning': 10,
-                            'Marine Lightning': 10,
-                            'Debris Flow': 10,
-                            'Wildfire': 50,
-                            "Volcanic Ash": 10,
-                            "Dense Smoke": 50,
-                            'Heat': 50,
-                            'Excessive Heat': 50,
-                            "Extreme Cold/Wind Chill": 30,
-                            'Lake-Effect Snow': 30,
-                            'Winter Storm': 30,
-                            'Winter Weather': 30,
-                            "Ice Storm": 30,
-                            "Cold/Wind Chill": 30,
-                            "Blizzard": 30,
-                            'Heavy Snow': 30,
-                            "Frost/Freeze": 30,
-                            "Hurricane": 150,
-                            "Marine Hurricane/Typhoon": 150,
-                            "Hurricane (Typhoon)": 150,
-                            "Tropical Depression": 150,
-                            "Marine Tropical Storm": 150,
-                            "Marine Tropical Depression": 150,
-                            'Tropical Storm': 150,
-                            "Tsunami": 10,
-                           }
+from weather_distance_config import weather_distance_config
 
 
 system_metadata_file = "./metadata/pv_system_metadata.csv"
 LINK_DATA = True
-WRITE_CSV_RESULTS = True
+# Results are written as typed files partitioned by system ID ('parquet' or
+# 'feather'); set WRITE_CSV_RESULTS to also export them as CSV
+RESULTS_FORMAT = 'parquet'
+WRITE_CSV_RESULTS = False
 GENERATE_PLOTS = True
 data_type='PV'
+# Local cache of the weather events table (None to always query the full
+# table from the database)
+WEATHER_CACHE_DIR = "./weather_event_cache"
+# Saved state of the previous linking run: only new or changed systems, and
+# events added since that run, are linked (None to always link everything)
+LINK_STATE_DIR = "./link_state"
+# For fleet-scale runs, link systems and events in lat/lon tiles with worker
+# processes, spilling results to this directory (None links in one
+# process). Workers on other machines sharing the directory can join with
+# 'python sharded_linking.py <dir>'
+SHARDED_LINK_DIR = None
+TILE_SIZE_DEG = 5.0
+LINK_WORKERS = None
+# Worker counts for the plot generator (None uses the CPU count)
+FETCH_WORKERS = 4
+ANALYSIS_WORKERS = None
+# System time series are downloaded (8 at a time, prefetching ahead of the
+# analysis) into this local cache, and only re-downloaded when their ETag
+# changes
+SYSTEM_DATA_CACHE_DIR = "./system_data_cache"
+FETCH_CONCURRENCY = 8
+# Stream each system's AC power file in chunks and keep only the data
+# around its events (plus daily energy sums), instead of loading it all
+STREAM_EVENT_WINDOWS = True
+# The daily energy of every analyzed system is added to (or updated in)
+# this memory-mapped cube. With RESCORE_FROM_ENERGY_CUBE, the linked events
+# (e.g. relinked after a weather_distance_config change) are scored from
+# the cube instead of fetching the time series again
+ENERGY_CUBE_DIR = "./energy_cube"
+RESCORE_FROM_ENERGY_CUBE = False
+# Stage timings and linking funnel counts are logged and summarized here.
+# Set PROFILE_SYSTEM_ID to write cProfile dumps for one system to
+# ./profiles
+RUN_SUMMARY_FILE = "./run_summary.json"
+PROFILE_SYSTEM_ID = None
 
 if __name__ == "__main__":
     # Read in the associated system metadata
     system_metadata = pd.read_csv(system_metadata_file)
+    logging.basicConfig(level=logging.INFO)
+    instrumentation = Instrumentation(
+        sinks=[LogSink(), JSONSummarySink(RUN_SUMMARY_FILE)],
+        profile_system_id=PROFILE_SYSTEM_ID)
     # Connect to database
     db = pvdrdb.PVDRDBQuery()
     db.connectToDB()
-    # Initialize System Linker class
-    sys_linker = we.SystemLinker(db, system_metadata, weather_distance_config)
-    if LINK_DATA:
-        system_weather_event_master = sys_linker.linkData()
-    if WRITE_CSV_RESULTS:
-        system_weather_event_master.to_csv(
-            "system_weather_event_master.csv", index=False)
-    system_weather_event_master = pd.read_csv("system_weather_event_master.csv",
-                                              parse_dates=True)
+    linked_store = ResultStore("./results/system_weather_event_master",
+                               file_format=RESULTS_FORMAT)
+    if LINK_DATA and SHARDED_LINK_DIR is not None:
+        link_job = ShardedLinkJob(SHARDED_LINK_DIR)
+        link_job.prepare(db, system_metadata, weather_distance_config,
+                         tile_size_deg=TILE_SIZE_DEG,
+                         weather_cache_dir=WEATHER_CACHE_DIR)
+        for issue in link_job.run(LINK_WORKERS):
+            print(f"Tile {issue['tile_id']} failed: {issue['error_type']}: "
+                  f"{issue['message']}")
+        # The previous linked results are only replaced once every tile is
+        # linked. Failed tiles can be retried with
+        # 'python sharded_linking.py <dir> --retry-failed'
+        pending_tiles = link_job.pendingTiles()
+        if len(pending_tiles):
+            print(f"{len(pending_tiles)} tiles are not linked, keeping the "
+                  "previous linked results.")
+        else:
+            # Tile results go to the store one tile at a time
+            linked_store.clear()
+            link_job.writeResults(linked_store)
+            if WRITE_CSV_RESULTS:
+                linked_store.toCSV("system_weather_event_master.csv")
+    elif LINK_DATA:
+        # Initialize System Linker class
+        sys_linker = we.SystemLinker(db, system_metadata,
+                                     weather_distance_config,
+                                     weather_cache_dir=WEATHER_CACHE_DIR,
+                                     instrumentation=instrumentation)
+        if LINK_STATE_DIR is not None:
+            system_weather_event_master = sys_linker.linkDataIncremental(
+                LINK_STATE_DIR)
+        else:
+            system_weather_event_master = sys_linker.linkData()
+        linked_store.clear()
+        linked_store.write(system_weather_event_master)
+        if WRITE_CSV_RESULTS:
+            system_weather_event_master.to_csv(
+                "system_weather_event_master.csv", index=False)
+    # Performance results go to a store partitioned by system, one system
+    # at a time
+    if data_type == 'PV' and (RESCORE_FROM_ENERGY_CUBE or GENERATE_PLOTS):
+        performance_store = ResultStore(
+            "./results/system_weather_event_master_performance",
+            file_format=RESULTS_FORMAT)
+        performance_store.clear()
+        writePerformance = performance_store.write
+    ##### RE-SCORING FROM THE SAVED DAILY ENERGY ######
+    if RESCORE_FROM_ENERGY_CUBE and data_type == 'PV':
+        energy_cube = DailyEnergyCube(ENERGY_CUBE_DIR)
+        agg_df = energy_cube.scoreEvents(linked_store.read())
+        if len(agg_df):
+            for _, system_agg_df in agg_df.groupby('system_id', sort=False):
+                writePerformance(system_agg_df.reset_index(drop=True))
     ##### PLOT GENERATOR (HOOKED INTO S3) ######
-    if GENERATE_PLOTS:
+    elif GENERATE_PLOTS:
         if data_type == 'PV':
-            pv_systems = list(system_weather_event_master[
-                'system_id'].drop_duplicates().astype(int))
-            master_agg_df = pd.DataFrame()
-            logger_issue = list()
-            for system_id in pv_systems:
-                try:
-                    # read in the data from the associated S3 bucket
-                    df = pd.read_csv(os.path.join(
-                            "s3://pvdrdb-inbox/Analysis_input/PVDRDB/",
-                            str(system_id) + ".csv"), index_col=0, parse_dates=True,
-                            storage_options={"key": db.aws['key'],
-                                             "secret": db.aws['secret']})
-                    # Resample data to hourly frequency
-                    df = df.resample('60min').mean()
-                    # Get all of the associated AC power streams to plot
-                    ac_power_streams = [x for x in list(df.columns) if 'ac_power' in x]
-                    weather_df_sub = system_weather_event_master[
-                        system_weather_event_master['system_id'] == system_id]
-                    agg_df = sys_linker.examinePVPerformance(
-                        system_ac_power_data=df[ac_power_streams],
-                        weather_events = weather_df_sub)
-                    master_agg_df = pd.concat([master_agg_df, agg_df])
-                    master_agg_df.to_csv("system_weather_event_master_performance.csv")
-                    sys_linker.generatePlotlyGraphic(data_type = 'PV',
-                                                      system_ac_power_data=df[ac_power_streams], 
-                                                      weather_events=weather_df_sub,
-                                                      ac_power_units='kW',
-                                                      subsystem_name=str(system_id))
-                except:
-                    logger_issue.append(system_id)
-                    
\ No newline at end of file
+            pv_systems = [int(x) for x in linked_store.partitionValues()]
+            # Download system time series from the associated S3 bucket
+            # over one pooled session, parse them in a thread pool, and
+            # score/plot them in a process pool
+            data_source = CachedCSVSystemDataSource(
+                "s3://pvdrdb-inbox/Analysis_input/PVDRDB/",
+                storage_options={"key": db.aws['key'],
+                                 "secret": db.aws['secret']},
+                cache_dir=SYSTEM_DATA_CACHE_DIR,
+                max_concurrency=FETCH_CONCURRENCY)
+            # Each system's linked events are read from its own partition
+            pipeline = SystemPipeline(data_source,
+                                      linked_store,
+                                      data_type='PV',
+                                      ac_power_units='kW',
+                                      fetch_workers=FETCH_WORKERS,
+                                      analysis_workers=ANALYSIS_WORKERS,
+                                      instrumentation=instrumentation,
+                                      stream_event_windows=(
+                                          STREAM_EVENT_WINDOWS),
+                                      energy_cube_path=ENERGY_CUBE_DIR)
+            logger_issue = pipeline.run(
+                pv_systems, result_handler=writePerformance)
+            data_source.close()
+            for issue in logger_issue:
+                print(f"System {issue['system_id']} failed at "
+                      f"{issue['stage']}: {issue['error_type']}: "
+                      f"{issue['message']}")
+    # Systems finish in any order, so the CSV export (with each system's
+    # row index, as before) is written from the store by system ID
+    if data_type == 'PV' and (RESCORE_FROM_ENERGY_CUBE or GENERATE_PLOTS) \
+            and WRITE_CSV_RESULTS:
+        performance_store.toCSV("system_weather_event_master_performance.csv",
+                                index=True)
+    instrumentation.close()
@@ -0,0 +1,452 @@
+"""
+Parallel per-system pipeline for PV performance scoring and plotting.
+
+System time series are fetched and parsed in a thread pool (I/O bound),
+and the analysis and figure writing run in a process pool (CPU bound).
+"""
+
+import os
+import time
+import traceback
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                Future, FIRST_COMPLETED, wait)
+import pandas as pd
+from pv_performance import scoreEventPerformance, DailyEnergyTable
+from plot_renderer import renderWeatherEventPlot
+from instrumentation import Instrumentation
+from ac_power_stream import SystemPowerData, readEventWindows
+from energy_cube import EnergyCubeWriter
+
+
+class CSVSystemDataSource():
+    """
+    Reader for per-system time series stored as '<system_id>.csv' under a
+    base path. The base path can be a local directory or any fsspec URL,
+    such as an S3 bucket or a local S3 stand-in (e.g. moto server, passing
+    {"client_kwargs": {"endpoint_url": ...}} in storage_options).
+
+    Parameters
+    ----------
+    base_path: str
+        Directory or URL holding the system CSV files.
+    storage_options: dict, default None
+        Extra options passed through to pd.read_csv for remote paths.
+    """
+
+    def __init__(self, base_path, storage_options=None):
+        self.base_path = base_path
+        self.storage_options = storage_options
+
+    def path(self, system_id):
+        return os.path.join(self.base_path, str(system_id) + ".csv")
+
+    def read(self, system_id):
+        """
+        Read the full time series for a system.
+
+        Parameters
+        ----------
+        system_id: int
+            System ID.
+
+        Returns
+        -------
+        df: Pandas DataFrame
+            Time series with a datetime index.
+        """
+        return pd.read_csv(self.path(system_id), index_col=0,
+                           parse_dates=True,
+                           storage_options=self.storage_options)
+
+    def readEventWindows(self, system_id, weather_events, day_window=14,
+                         frequency='60min'):
+        """
+        Stream a system's AC power columns in chunks, keeping the resampled
+        data around its weather events and the daily energy sums (see
+        ac_power_stream.readEventWindows).
+
+        Returns
+        -------
+        system_power_data: ac_power_stream.SystemPowerData
+            Reduced AC power data.
+        """
+        return readEventWindows(self.path(system_id), weather_events,
+                                day_window=day_window, frequency=frequency,
+                                storage_options=self.storage_options)
+
+
+def prepareSystemData(df, frequency='60min'):
+    """
+    Keep the AC power streams of a system time series and resample them.
+
+    Parameters
+    ----------
+    df: Pandas DataFrame
+        Time series with a datetime index.
+    frequency: str, default '60min'
+        Resampling frequency.
+
+    Returns
+    -------
+    df: Pandas DataFrame
+        Resampled mean of every column containing 'ac_power'.
+    """
+    ac_power_streams = [x for x in list(df.columns) if 'ac_power' in x]
+    return df[ac_power_streams].resample(frequency).mean()
+
+
+def errorRecord(system_id, stage, exception):
+    """
+    Build a structured error record for a failed system.
+    """
+    return {'system_id': system_id,
+            'stage': stage,
+            'error_type': type(exception).__name__,
+            'message': str(exception),
+            'traceback': traceback.format_exc()}
+
+
+def fetchSystem(data_source, system_id, frequency='60min',
+                weather_events=None, day_window=14):
+    """
+    Fetch and prepare a system's AC power data. Run in the I/O thread pool.
+
+    If weather_events is given, the data is streamed and reduced to the
+    event windows with data_source.readEventWindows().
+
+    Returns
+    -------
+    result: tuple
+        (system_id, ac power data, error record, stage records). The ac
+        power data is a data frame, or a SystemPowerData when streaming.
+        Exactly one of the data and the error record is None. The stage
+        records hold the fetch timing (CPU time of the fetching thread),
+        see Instrumentation.record().
+    """
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        if weather_events is not None:
+            df = data_source.readEventWindows(
+                system_id, weather_events, day_window=day_window,
+                frequency=frequency)
+        else:
+            df = prepareSystemData(data_source.read(system_id), frequency)
+        error = None
+    except Exception as e:
+        df = None
+        error = errorRecord(system_id, 'fetch', e)
+    stage_records = [{'stage': 'fetchSystemData', 'system_id': system_id,
+                      'wall_time': time.perf_counter() - wall_start,
+                      'cpu_time': time.thread_time() - cpu_start}]
+    return system_id, df, error, stage_records
+
+
+def analyzeSystem(system_id, system_ac_power_data, weather_events,
+                  data_type='PV', ac_power_units='kW', generate_plots=True,
+                  plot_options=None, profile_options=None):
+    """
+    Score PV performance around each event and write the system's plot.
+    Run in the analysis process pool.
+
+    Parameters
+    ----------
+    system_ac_power_data: Pandas DataFrame or SystemPowerData
+        Resampled AC power data, or its reduced form from streaming (daily
+        energy for the scoring, event windows for the plot).
+    profile_options: dict, default None
+        If set, the stages are profiled: keyword arguments for the worker's
+        Instrumentation ('profile_system_id', 'profiler', 'profile_dir').
+
+    Returns
+    -------
+    result: tuple
+        (system_id, performance data frame, error record, stage records).
+        Exactly one of the data frame and the error record is None. The
+        stage records hold the timing of each stage run in the worker,
+        to replay into the parent's Instrumentation.
+    """
+    # Worker processes keep their own timings, sent back with the result
+    instrumentation = Instrumentation(**(profile_options or {}))
+    if isinstance(system_ac_power_data, SystemPowerData):
+        energy_data = system_ac_power_data.energy_table
+        system_ac_power_data = system_ac_power_data.hourly
+    else:
+        energy_data = system_ac_power_data
+    stage = 'performance'
+    try:
+        with instrumentation.stage('examinePVPerformance',
+                                   system_id=system_id):
+            agg_df = scoreEventPerformance(energy_data, weather_events)
+        if generate_plots:
+            stage = 'plot'
+            with instrumentation.stage('generatePlotlyGraphic',
+                                       system_id=system_id):
+                renderWeatherEventPlot(
+                    data_type=data_type,
+                    system_ac_power_data=system_ac_power_data,
+                    weather_events=weather_events,
+                    ac_power_units=ac_power_units,
+                    subsystem_name=str(system_id),
+                    **(plot_options or {}))
+        error = None
+    except Exception as e:
+        agg_df = None
+        error = errorRecord(system_id, stage, e)
+    stage_records = [{'stage': x['stage'], 'system_id': x['system_id'],
+                      'wall_time': x['wall_time_s'],
+                      'cpu_time': x['cpu_time_s']}
+                     for x in instrumentation.stage_records]
+    return system_id, agg_df, error, stage_records
+
+
+_DONE = object()
+
+
+class _InlineExecutor():
+    """
+    Executor that runs tasks immediately in the calling process, used when
+    the worker count is 0 (e.g. for debugging).
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class SystemPipeline():
+    """
+    Pipeline driver that prefetches system time series with a thread pool
+    and runs the performance analysis and plotting in a process pool.
+
+    Parameters
+    ----------
+    data_source: object
+        Object with a read(system_id) method returning the system's time
+        series, e.g. CSVSystemDataSource. For stream_event_windows, it
+        also needs a readEventWindows() method.
+    system_weather_event_master: Pandas DataFrame or results_io.ResultStore
+        Linked system/weather event data, containing a 'system_id' column.
+        With a ResultStore partitioned by system_id, only each system's own
+        rows are read.
+    data_type: str, default 'PV'
+        'PV' or 'wind', based on the data source being analyzed.
+    ac_power_units: str, default 'kW'
+        Unit of ac power for the systems.
+    fetch_workers: int, default 4
+        Number of threads fetching and parsing system time series.
+    analysis_workers: int, default None
+        Number of processes running the analysis. None uses the CPU count;
+        0 runs the analysis inline in this process.
+    max_in_flight: int, default None
+        Max number of systems being fetched or analyzed at once. Fetching
+        stops while this many systems are pending, which bounds memory.
+        None uses twice the total worker count.
+    generate_plots: bool, default True
+        If True, write a plot for each system.
+    plot_options: dict, default None
+        Extra options passed to plot_renderer.renderWeatherEventPlot, e.g.
+        {'use_webgl': True, 'include_plotlyjs': 'directory'}.
+    instrumentation: instrumentation.Instrumentation, default None
+        If given, the fetch, performance, and plot timings of every system
+        are recorded to it. Its profile_system_id (if set) is profiled in
+        the worker.
+    stream_event_windows: bool, default False
+        If True, each system's file is streamed in chunks and only the
+        data around its events (plus daily energy) is kept, so memory does
+        not grow with the length or sampling rate of the series. Plots
+        then only show the event windows.
+    prefetch_systems: int, default 8
+        If the data source has a prefetch(system_ids) method (e.g.
+        system_data_fetch.CachedCSVSystemDataSource), the files of this
+        many systems past the ones being fetched are downloaded ahead.
+    energy_cube_path: str, default None
+        If set, the daily energy of every fetched system is saved to an
+        energy_cube.DailyEnergyCube there, for re-scoring events later
+        without reloading the time series. Only the fetched systems are
+        written (as a new segment of the cube), the others are kept, and
+        the cube only changes once the run completes.
+    """
+
+    def __init__(self, data_source, system_weather_event_master,
+                 data_type='PV', ac_power_units='kW', fetch_workers=4,
+                 analysis_workers=None, max_in_flight=None,
+                 generate_plots=True, plot_options=None,
+                 instrumentation=None, stream_event_windows=False,
+                 prefetch_systems=8, energy_cube_path=None):
+        self.data_source = data_source
+        self.system_weather_event_master = system_weather_event_master
+        self.data_type = data_type
+        self.ac_power_units = ac_power_units
+        self.fetch_workers = max(int(fetch_workers), 1)
+        if analysis_workers is None:
+            analysis_workers = os.cpu_count() or 1
+        self.analysis_workers = int(analysis_workers)
+        if max_in_flight is None:
+            max_in_flight = 2 * (self.fetch_workers +
+                                 max(self.analysis_workers, 1))
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self.generate_plots = generate_plots
+        self.plot_options = plot_options
+        self.instrumentation = instrumentation
+        self.stream_event_windows = stream_event_windows
+        self.prefetch_systems = max(int(prefetch_systems), 0)
+        self.energy_cube_path = energy_cube_path
+
+    def _recordStages(self, stage_records):
+        if self.instrumentation is None:
+            return
+        for stage_record in stage_records:
+            self.instrumentation.record(stage_record['stage'],
+                                        stage_record['wall_time'],
+                                        stage_record['cpu_time'],
+                                        system_id=stage_record['system_id'])
+        return
+
+    def _profileOptions(self, system_id):
+        if self.instrumentation is None or \
+                self.instrumentation.profile_system_id is None or \
+                str(self.instrumentation.profile_system_id) != str(system_id):
+            return None
+        return {'profile_system_id': system_id,
+                'profiler': self.instrumentation.profiler,
+                'profile_dir': self.instrumentation.profile_dir}
+
+    def _weatherEventReader(self):
+        """
+        Get a function returning the linked weather events of a system.
+        """
+        if hasattr(self.system_weather_event_master, 'read'):
+            return lambda system_id: self.system_weather_event_master.read(
+                system_id)
+        weather_event_groups = {
+            system_id: group for system_id, group in
+            self.system_weather_event_master.groupby('system_id')}
+        no_events = self.system_weather_event_master.iloc[0:0]
+        return lambda system_id: weather_event_groups.get(system_id,
+                                                          no_events)
+
+    def _analysisExecutor(self):
+        if self.analysis_workers == 0:
+            return _InlineExecutor()
+        # The fetch threads (and the fetcher's event loop thread) are
+        # already running, and forking a process with live threads can
+        # deadlock on locks held at fork time, so workers are started
+        # fresh
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        else:
+            context = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(max_workers=self.analysis_workers,
+                                   mp_context=context)
+
+    def run(self, system_ids, result_handler=None):
+        """
+        Run the pipeline over a set of systems.
+
+        Parameters
+        ----------
+        system_ids: list
+            System IDs to process.
+        result_handler: callable, default None
+            Called with each system's performance data frame as soon as it
+            is ready (e.g. ResultStore.write). Results arrive in
+            completion order, not input order.
+
+        Returns
+        -------
+        errors: list of dict
+            One record per failed system, with the 'system_id', 'stage',
+            'error_type', 'message', and 'traceback' of the failure.
+        """
+        read_weather_events = self._weatherEventReader()
+        system_ids = list(system_ids)
+        pending_ids = iter(system_ids)
+        prefetch = getattr(self.data_source, 'prefetch', None)
+        n_submitted = 0
+        energy_cube = None
+        if self.energy_cube_path is not None:
+            energy_cube = EnergyCubeWriter(self.energy_cube_path)
+        errors = list()
+        fetches = dict()
+        analyses = dict()
+        # The run's systems join the cube when it completes, and are
+        # discarded if it fails
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as fetcher, \
+                self._analysisExecutor() as analyzer, \
+                (energy_cube or nullcontext()):
+
+            def fill():
+                nonlocal n_submitted
+                # Only start new fetches while there is room in the pipeline
+                while len(fetches) + len(analyses) < self.max_in_flight:
+                    system_id = next(pending_ids, _DONE)
+                    if system_id is _DONE:
+                        return
+                    n_submitted += 1
+                    if prefetch is not None and self.prefetch_systems:
+                        # Download the next systems' files in the background
+                        prefetch(system_ids[
+                            n_submitted:n_submitted + self.prefetch_systems])
+                    weather_events = read_weather_events(system_id)
+                    future = fetcher.submit(
+                        fetchSystem, self.data_source, system_id,
+                        weather_events=weather_events if
+                        self.stream_event_windows else None,
+                        day_window=(self.plot_options or {}).get(
+                            'day_window', 14))
+                    fetches[future] = (system_id, weather_events)
+
+            fill()
+            while fetches or analyses:
+                done, _ = wait(list(fetches) + list(analyses),
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in fetches:
+                        system_id, weather_events = fetches.pop(future)
+                        system_id, df, error, stage_records = \
+                            future.result()
+                        self._recordStages(stage_records)
+                        if error is not None:
+                            errors.append(error)
+                            continue
+                        if energy_cube is not None:
+                            # The worker scores from the same daily table
+                            if not isinstance(df, SystemPowerData):
+                                df = SystemPowerData(df, DailyEnergyTable(df))
+                            energy_cube.add(system_id, df.energy_table)
+                        analysis = analyzer.submit(
+                            analyzeSystem, system_id, df, weather_events,
+                            data_type=self.data_type,
+                            ac_power_units=self.ac_power_units,
+                            generate_plots=self.generate_plots,
+                            plot_options=self.plot_options,
+                            profile_options=self._profileOptions(system_id))
+                        analyses[analysis] = system_id
+                    else:
+                        system_id = analyses.pop(future)
+                        try:
+                            system_id, agg_df, error, stage_records = \
+                                future.result()
+                            self._recordStages(stage_records)
+                        except Exception as e:
+                            # e.g. a worker process dying
+                            error = errorRecord(system_id, 'worker', e)
+                        if error is not None:
+                            errors.append(error)
+                        elif result_handler is not None:
+                            result_handler(agg_df)
+                fill()
+        return errors
@@ -0,0 +1,199 @@
+"""
+Plotly graphics of system power data around extreme weather events.
+"""
+
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import plotly
+import plotly.graph_objects as go
+
+
+def decimateMinMax(values, n_buckets):
+    """
+    Pick the points to draw for a time series, keeping the min and max of
+    each of n_buckets equal-count buckets, in time order. The line drawn
+    through these points has the same visible envelope as the full series.
+
+    Parameters
+    ----------
+    values: Numpy array
+        Series values, in time order.
+    n_buckets: int
+        Number of buckets.
+
+    Returns
+    -------
+    positions: Numpy array
+        Sorted positions of the points to keep. Buckets that are all NaN
+        keep their first point, so gaps in the data still break the line.
+    """
+    n_values = len(values)
+    if n_values <= 2 * n_buckets:
+        return np.arange(n_values)
+    bucket = np.arange(n_values) * n_buckets // n_values
+    missing = np.isnan(values)
+    # Sort by (bucket, value), NaN last, and take each bucket's first and
+    # last non-NaN entries
+    low_order = np.lexsort([np.where(missing, np.inf, values), bucket])
+    high_order = np.lexsort([np.where(missing, np.inf, -values), bucket])
+    bucket_start = np.searchsorted(bucket, np.arange(n_buckets))
+    positions = np.concatenate([low_order[bucket_start],
+                                high_order[bucket_start]])
+    return np.unique(positions)
+
+
+def writePlotlyBundle(output_dir):
+    """
+    Write the shared plotly.min.js bundle into a plot directory, if it is
+    not there yet. Plots written with include_plotlyjs='directory' load it
+    from their own directory (plotly only copies it for full HTML pages).
+
+    The bundle is written to a temporary file and moved into place, so
+    worker processes writing it at once never leave a partial bundle.
+
+    Returns
+    -------
+    None.
+
+    """
+    bundle_path = os.path.join(output_dir, "plotly.min.js")
+    if os.path.exists(bundle_path):
+        return
+    fd, temp_path = tempfile.mkstemp(dir=output_dir,
+                                     prefix=".plotly.min.js.")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(plotly.offline.get_plotlyjs())
+        os.replace(temp_path, bundle_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return
+
+
+def _eventShapes(weather_events):
+    """
+    Build the shaded event rectangles and their labels as one batch of
+    layout shapes and annotations.
+    """
+    shapes = list()
+    annotations = list()
+    for event_start, event_end, event_type in zip(
+            weather_events['weather_event_started_on'],
+            weather_events['weather_event_ended_on'],
+            weather_events['event_type']):
+        shapes.append(dict(type='rect', xref='x', yref='y domain',
+                           x0=event_start, x1=event_end, y0=0, y1=1,
+                           fillcolor='red', opacity=0.2, line_width=0))
+        annotations.append(dict(text=event_type, showarrow=False,
+                                xref='x', yref='y domain', x=event_end,
+                                y=1, xanchor='right', yanchor='top'))
+    return shapes, annotations
+
+
+def renderWeatherEventPlot(data_type, system_ac_power_data, weather_events,
+                           ac_power_units, subsystem_name, day_window=14,
+                           max_points=2000, use_webgl=False,
+                           include_plotlyjs="cdn", image_format=None,
+                           output_dir="./plots"):
+    """
+    Generate a plotly graphic showing system power data and associated
+    weather events.
+
+    Parameters
+    ----------
+    data_type: Str.
+        'PV' or 'wind', based on the data source being analyzed
+    system_ac_power_data: Pandas Dataframe
+        Pandas dataframe containing datetime index and an ac power column.
+    weather_events: Pandas Dataframe
+        Pandas dataframe that contains the 'event_type', 'start_timestamp',
+        and 'end_timestamp' columns for systems that are present during
+        the weather events.
+    ac_power_units: str
+        Unit of ac power for the system.
+    sybsystem_name: str
+        Subsystem name.
+    day_window: int, default 14
+        Number of days before and after a weather event.
+    max_points: int, default 2000
+        Max number of min/max buckets drawn per stream. Streams with more
+        points are decimated with decimateMinMax(). None keeps every point.
+    use_webgl: bool, default False
+        If True, draw the streams with WebGL (Scattergl) traces.
+    include_plotlyjs: str or bool, default "cdn"
+        Passed to fig.write_html. 'directory' references a single shared
+        plotly.min.js in output_dir (written once by writePlotlyBundle)
+        instead of the CDN.
+    image_format: str, default None
+        If set (e.g. 'png', 'svg'), write a static image in this format
+        instead of HTML. Requires kaleido.
+    output_dir: str, default "./plots"
+        Directory the plot is written to.
+
+    Returns
+    -------
+    None.
+
+    """
+    event_started_on = pd.to_datetime(
+        weather_events['weather_event_started_on'])
+    event_ended_on = pd.to_datetime(weather_events['weather_event_ended_on'])
+    weather_events = weather_events.assign(
+        weather_event_started_on=event_started_on,
+        weather_event_ended_on=event_ended_on)
+    # Get before and after periods for an event, as whole days
+    window_start = pd.Timestamp(event_started_on.min().date() -
+                                pd.Timedelta(days=day_window))
+    window_end = pd.Timestamp(event_ended_on.max().date() +
+                              pd.Timedelta(days=day_window + 1))
+    if isinstance(system_ac_power_data, pd.Series):
+        system_ac_power_data = system_ac_power_data.to_frame()
+    index_tz = getattr(system_ac_power_data.index, 'tz', None)
+    if index_tz is not None:
+        window_start = window_start.tz_localize(index_tz)
+        window_end = window_end.tz_localize(index_tz)
+    sys_data = system_ac_power_data[
+        (system_ac_power_data.index >= window_start) &
+        (system_ac_power_data.index < window_end)]
+    # order by index
+    sys_data = sys_data.sort_index()
+    if data_type == 'wind':
+        operator_name = weather_events["operator_name"].iloc[0]
+        site_name = weather_events["site_name"].iloc[0]
+        title = f"{operator_name} {site_name}, {subsystem_name} AC Power"
+        file_name = f"{operator_name}_{site_name}_{subsystem_name}"
+    else:
+        system_id = weather_events["system_id"].iloc[0]
+        title = f"{system_id} AC Power"
+        file_name = f"{system_id}"
+    # Build the plotly graphic with the (decimated) streams
+    trace_type = go.Scattergl if use_webgl else go.Scatter
+    fig = go.Figure()
+    for column in sys_data.columns:
+        values = sys_data[column].to_numpy(dtype=float)
+        if max_points is not None:
+            positions = decimateMinMax(values, max_points)
+        else:
+            positions = np.arange(len(values))
+        fig.add_trace(trace_type(x=sys_data.index[positions],
+                                 y=values[positions], mode='lines',
+                                 name=str(column)))
+    # Add all of the weather events to the plotly graphic at once
+    shapes, annotations = _eventShapes(weather_events)
+    fig.update_layout(title=title, xaxis_title="Datetime",
+                      yaxis_title=f"AC Power ({ac_power_units})",
+                      legend_title_text="variable", shapes=shapes,
+                      annotations=annotations)
+    if image_format is not None:
+        fig.write_image(os.path.join(
+            output_dir, f"{file_name}_weather_events.{image_format}"))
+    else:
+        if include_plotlyjs == 'directory':
+            writePlotlyBundle(output_dir)
+        fig.write_html(
+            os.path.join(output_dir, f"{file_name}_weather_events.html"),
+            full_html=False, include_plotlyjs=include_plotlyjs)
+    return
@@ -0,0 +1,154 @@
+"""
+Vectorized PV performance scoring around extreme weather events.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def _wallClockDays(timestamps):
+    """
+    Convert timestamps to integer day numbers (days since epoch) on their
+    own wall-clock calendar, matching Timestamp.date().
+    """
+    timestamps = pd.DatetimeIndex(timestamps)
+    if timestamps.tz is not None:
+        timestamps = timestamps.tz_localize(None)
+    return timestamps.values.astype("datetime64[D]").astype(np.int64)
+
+
+class DailyEnergyTable():
+    """
+    Daily energy sums for every AC power stream of a system, held as a 2-D
+    array (days x streams), with the matching median daily energy for each
+    (month, stream).
+
+    Parameters
+    ----------
+    system_ac_power_data: Pandas DataFrame, default None
+        Pandas dataframe containing a datetime index and one column per ac
+        power stream.
+    days: Numpy array, default None
+        Sorted day numbers (days since epoch). With energy and streams,
+        builds the table from precomputed daily sums instead of
+        system_ac_power_data (see ac_power_stream).
+    energy: Numpy array, default None
+        Array (days x streams) of daily energy sums.
+    streams: list, default None
+        Stream names.
+    """
+
+    def __init__(self, system_ac_power_data=None, days=None, energy=None,
+                 streams=None):
+        if system_ac_power_data is not None:
+            streams = list(system_ac_power_data.columns)
+            day_number = _wallClockDays(system_ac_power_data.index)
+            # Only days present in the index are kept, so gaps in the data
+            # do not show up as zero-energy days
+            days, day_position = np.unique(day_number, return_inverse=True)
+            values = system_ac_power_data.to_numpy(dtype=float)
+            energy = np.zeros((len(days), len(streams)))
+            np.add.at(energy, day_position, np.nan_to_num(values))
+        self.streams = list(streams)
+        self.days = np.asarray(days, dtype=np.int64)
+        self.energy = np.asarray(energy, dtype=float).reshape(
+            len(self.days), len(self.streams))
+        # Running total over days, for constant-time window sums
+        self.cumulative_energy = np.vstack([
+            np.zeros((1, len(self.streams))),
+            np.cumsum(self.energy, axis=0)])
+        months = self.days.astype("datetime64[D]").astype(
+            "datetime64[M]").astype(np.int64) % 12 + 1
+        self.month_median = np.full((12, len(self.streams)), np.nan)
+        for month in np.unique(months):
+            self.month_median[month - 1] = np.median(
+                self.energy[months == month], axis=0)
+
+    def windowEnergy(self, first_day, n_days):
+        """
+        Total energy over a window of days for each stream.
+
+        Parameters
+        ----------
+        first_day: Numpy array
+            Day numbers (days since epoch) of the first day of each window.
+        n_days: int
+            Number of days in each window.
+
+        Returns
+        -------
+        energy: Numpy array
+            Array (windows x streams) of energy summed over each window.
+        """
+        lower = np.searchsorted(self.days, first_day, side='left')
+        upper = np.searchsorted(self.days, first_day + n_days, side='left')
+        return self.cumulative_energy[upper] - self.cumulative_energy[lower]
+
+    def monthMedian(self, month):
+        """
+        Median daily energy for each stream, for the given months.
+
+        Parameters
+        ----------
+        month: Numpy array
+            Month of year (1-12) for each lookup.
+
+        Returns
+        -------
+        median: Numpy array
+            Array (lookups x streams) of median daily energy. NaN where
+            there is no data for the month.
+        """
+        return self.month_median[np.asarray(month) - 1]
+
+
+def scoreEventPerformance(system_ac_power_data, weather_events,
+                          n_days=2):
+    """
+    Compare production around the start of each extreme weather event to
+    the median daily production for that month, for every ac power stream
+    in one pass.
+
+    Parameters
+    ----------
+    system_ac_power_data: Pandas DataFrame or DailyEnergyTable
+        Pandas dataframe containing a datetime index and one column per ac
+        power stream, or its daily energy table.
+    weather_events: Pandas DataFrame
+        Weather events containing a 'weather_event_started_on' column.
+    n_days: int, default 2
+        Number of days in the event window, starting on the day the event
+        starts.
+
+    Returns
+    -------
+    agg_df: Pandas DataFrame
+        One row per (event, stream) with the event columns plus
+        'data_stream' and 'pct_median_output'. Rows are ordered by event,
+        then stream.
+    """
+    if isinstance(system_ac_power_data, DailyEnergyTable):
+        energy_table = system_ac_power_data
+        streams = energy_table.streams
+    else:
+        energy_table = None
+        streams = system_ac_power_data.columns
+    if len(weather_events) == 0 or len(streams) == 0:
+        return pd.DataFrame()
+    if energy_table is None:
+        energy_table = DailyEnergyTable(system_ac_power_data)
+    started_on = pd.to_datetime(weather_events['weather_event_started_on'])
+    event_day = _wallClockDays(started_on)
+    event_month = np.asarray(pd.DatetimeIndex(started_on).month)
+    window_energy = energy_table.windowEnergy(event_day, n_days)
+    month_median = energy_table.monthMedian(event_month)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct_median_output = window_energy / month_median
+    n_streams = len(energy_table.streams)
+    agg_df = weather_events.iloc[
+        np.repeat(np.arange(len(weather_events)), n_streams)
+    ].reset_index(drop=True)
+    agg_df['data_stream'] = np.tile(energy_table.streams,
+                                    len(weather_events))
+    agg_df['pct_median_output'] = pct_median_output.ravel()
+    return agg_df
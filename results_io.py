@@ -0,0 +1,265 @@
+"""
+Typed columnar storage for the linked and performance results, partitioned
+by system, and an append-only CSV writer for exporting them.
+"""
+
+import os
+import glob
+import shutil
+import pandas as pd
+
+
+class ResultStore():
+    """
+    Parquet (or Feather) result files partitioned by system, as
+    '<path>/system_id=<system_id>/part-<n>.<format>'. Unlike CSV, the files
+    keep tz-aware timestamps, categoricals, and numeric dtypes, and a single
+    system's rows can be read without loading the rest.
+
+    The store is append-only: write() can be called once per system (e.g.
+    as the SystemPipeline result handler) or once with a whole frame.
+
+    Parameters
+    ----------
+    path: str
+        Directory holding the partitions.
+    file_format: str, default 'parquet'
+        'parquet' or 'feather'. Both require pyarrow.
+    partition_column: str, default 'system_id'
+        Column the rows are partitioned by.
+    """
+
+    def __init__(self, path, file_format='parquet',
+                 partition_column='system_id'):
+        if file_format not in ['parquet', 'feather']:
+            raise ValueError(f"Unknown file format '{file_format}', "
+                             "expected 'parquet' or 'feather'.")
+        self.path = path
+        self.file_format = file_format
+        self.partition_column = partition_column
+        self.n_parts = dict()
+
+    def _partitionDir(self, partition_value):
+        return os.path.join(self.path,
+                            f"{self.partition_column}={partition_value}")
+
+    def _files(self, partition_value=None):
+        if partition_value is None:
+            return [x for value in self.partitionValues()
+                    for x in self._files(value)]
+        return sorted(glob.glob(os.path.join(
+            self._partitionDir(partition_value),
+            f"part-*.{self.file_format}")))
+
+    def clear(self):
+        """
+        Remove every partition from the store.
+
+        Returns
+        -------
+        None.
+
+        """
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        self.n_parts = dict()
+        return
+
+    def write(self, df):
+        """
+        Append rows to the store, one file per partition value.
+
+        Parameters
+        ----------
+        df: Pandas DataFrame
+            Rows to write, containing the partition column. The index is
+            not written.
+
+        Returns
+        -------
+        None.
+
+        """
+        for partition_value, partition in df.groupby(
+                self.partition_column, sort=False, observed=True):
+            partition_dir = self._partitionDir(partition_value)
+            os.makedirs(partition_dir, exist_ok=True)
+            # Continue the part numbering of earlier writes and runs
+            if partition_value not in self.n_parts:
+                self.n_parts[partition_value] = len(
+                    self._files(partition_value))
+            part_path = os.path.join(
+                partition_dir, f"part-{self.n_parts[partition_value]:05d}."
+                f"{self.file_format}")
+            partition = partition.reset_index(drop=True)
+            if self.file_format == 'parquet':
+                partition.to_parquet(part_path, index=False)
+            else:
+                partition.to_feather(part_path)
+            self.n_parts[partition_value] += 1
+        return
+
+    def partitionValues(self):
+        """
+        Get the partition values (e.g. system IDs) in the store.
+
+        Returns
+        -------
+        partition_values: list
+            Partition values, as strings, sorted (numerically for integer
+            values such as system IDs).
+        """
+        prefix = f"{self.partition_column}="
+        return sorted(
+            (os.path.basename(x)[len(prefix):] for x in
+             glob.glob(os.path.join(self.path, prefix + "*"))
+             if len(self._files(os.path.basename(x)[len(prefix):]))),
+            key=_partitionSortKey)
+
+    def read(self, partition_value=None, columns=None, filters=None):
+        """
+        Read rows from the store. Only the files of the requested partition
+        are opened, and for Parquet the filters are pushed down to the
+        row groups.
+
+        Parameters
+        ----------
+        partition_value: int or str, default None
+            Partition (e.g. system ID) to read. None reads every partition.
+        columns: list, default None
+            Columns to read. None reads every column.
+        filters: list, default None
+            Row filters in pyarrow's format, e.g.
+            [('event_type', '==', 'Hail')].
+
+        Returns
+        -------
+        df: Pandas DataFrame
+            Matching rows, by partition (see partitionValues()), then in
+            write order within each partition.
+        """
+        files = self._files(partition_value)
+        frames = list()
+        for file in files:
+            if self.file_format == 'parquet':
+                frame = pd.read_parquet(file, columns=columns,
+                                        filters=filters)
+            else:
+                frame = pd.read_feather(file, columns=columns)
+                if filters is not None:
+                    frame = frame[_filterMask(frame, filters)]
+            frames.append(frame)
+        if len(frames) == 0:
+            return pd.DataFrame(columns=columns)
+        return concatTyped(frames)
+
+    def toCSV(self, csv_path, index=False):
+        """
+        Export the whole store to a single CSV file, one partition at a
+        time, in partitionValues() order.
+
+        Parameters
+        ----------
+        csv_path: str
+            Output CSV file.
+        index: bool, default False
+            If True, write the row index (numbered within each partition).
+
+        Returns
+        -------
+        None.
+
+        """
+        csv_writer = IncrementalCSVWriter(csv_path, index=index)
+        for partition_value in self.partitionValues():
+            csv_writer.write(self.read(partition_value))
+        if csv_writer.columns is None:
+            pd.DataFrame().to_csv(csv_path, index=index)
+        return
+
+
+class IncrementalCSVWriter():
+    """
+    Append-only CSV writer. The first write truncates the file and writes
+    the header; every later write appends rows only, so each system's
+    results are written once rather than rewriting the whole file.
+    """
+
+    def __init__(self, path, index=True):
+        self.path = path
+        self.index = index
+        self.columns = None
+
+    def write(self, df):
+        """
+        Append a data frame to the CSV file.
+
+        Parameters
+        ----------
+        df: Pandas DataFrame
+            Rows to append. Columns are aligned to the columns of the first
+            write.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.columns is None:
+            self.columns = list(df.columns)
+            df.to_csv(self.path, index=self.index, mode='w', header=True)
+        else:
+            df.reindex(columns=self.columns).to_csv(
+                self.path, index=self.index, mode='a', header=False)
+        return
+
+
+def _partitionSortKey(partition_value):
+    """
+    Sort integer partition values numerically, before any other values.
+    """
+    if partition_value.lstrip('-').isdigit():
+        return (0, int(partition_value), partition_value)
+    return (1, 0, partition_value)
+
+
+def _filterMask(df, filters):
+    """
+    Row mask for pyarrow-style (column, op, value) filters, for formats
+    without predicate pushdown.
+    """
+    mask = pd.Series(True, index=df.index)
+    for column, op, value in filters:
+        values = df[column]
+        if op in ['=', '==']:
+            mask &= values == value
+        elif op == '!=':
+            mask &= values != value
+        elif op == '<':
+            mask &= values < value
+        elif op == '<=':
+            mask &= values <= value
+        elif op == '>':
+            mask &= values > value
+        elif op == '>=':
+            mask &= values >= value
+        elif op == 'in':
+            mask &= values.isin(value)
+        elif op == 'not in':
+            mask &= ~values.isin(value)
+        else:
+            raise ValueError(f"Unknown filter operator '{op}'.")
+    return mask.values
+
+
+def concatTyped(frames):
+    """
+    Concatenate frames, keeping categorical columns categorical when the
+    frames have different categories.
+    """
+    df = pd.concat(frames, ignore_index=True)
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype) and \
+                not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    return df
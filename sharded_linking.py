@@ -0,0 +1,626 @@
+"""
+Spatially sharded, out-of-core linking for fleet-scale runs.
+
+Systems are split into lat/lon tiles, and each tile gets the weather events
+within the max configured radius of it (the tile padded by that radius), so
+no boundary matches are lost. The tiles are written to a work directory and
+linked independently by worker processes, which claim them through lock
+files, so workers can run locally or on several machines sharing the
+directory:
+
+python sharded_linking.py <work_dir>
+
+A claim is a lease: the worker linking a tile keeps touching its lock file,
+and a lock left untouched for longer than the job's lease_timeout (e.g. its
+worker was killed) is taken over by the next worker. Failed tiles stay
+claimed, with their error recorded, until they are released for another
+try with:
+
+python sharded_linking.py <work_dir> --retry-failed
+
+The merged output is identical to SystemLinker.linkData() run on the whole
+fleet in one process.
+"""
+
+import os
+import sys
+import json
+import glob
+import shutil
+import time
+import socket
+import argparse
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from weather_event_system_linker import SystemLinker
+from weather_event_store import (iterWeatherEventChunks,
+                                 compactWeatherEvents, concatCompactEvents,
+                                 CATEGORICAL_COLUMNS)
+from spatial_join import EARTH_RADIUS_KM
+from instrumentation import Instrumentation
+
+
+# Tiles are padded a little past the max radius, to cover the geodesic
+# refinement (within ~0.6% of the great-circle distance)
+PADDING_MARGIN = 1.05
+# Tile of the systems without coordinates, which match no events
+NO_COORDINATES_TILE = "none"
+# Seconds without a heartbeat after which a tile's claim can be taken over
+LEASE_TIMEOUT = 600.0
+
+
+def systemTiles(system_metadata, tile_size_deg=5.0):
+    """
+    Get the tile of every system.
+
+    Parameters
+    ----------
+    system_metadata: Pandas DataFrame
+        System metadata, containing 'latitude' and 'longitude' columns.
+    tile_size_deg: float, default 5.0
+        Tile size, in degrees of latitude and longitude.
+
+    Returns
+    -------
+    tile_ids: Numpy array
+        Tile ID ('<lat index>_<lon index>') of every system.
+    """
+    latitude = pd.to_numeric(system_metadata['latitude']).to_numpy(float)
+    longitude = pd.to_numeric(system_metadata['longitude']).to_numpy(float)
+    missing = np.isnan(latitude) | np.isnan(longitude)
+    lat_index = np.floor((np.nan_to_num(latitude) + 90) /
+                         tile_size_deg).astype(np.int64)
+    lon_index = np.floor(((np.nan_to_num(longitude) + 180) % 360) /
+                         tile_size_deg).astype(np.int64)
+    return np.where(missing, NO_COORDINATES_TILE,
+                    np.char.add(np.char.add(lat_index.astype(str), "_"),
+                                lon_index.astype(str)))
+
+
+def tileEventMask(weather_df, tile_id, tile_size_deg, padding_km):
+    """
+    Find the weather events with a start or end point within padding_km of
+    a tile.
+
+    Parameters
+    ----------
+    weather_df: Pandas DataFrame
+        Weather events with the begin/end latitude and longitude columns.
+    tile_id: str
+        Tile ID, see systemTiles().
+    tile_size_deg: float
+        Tile size, in degrees.
+    padding_km: float
+        Padding around the tile, in km.
+
+    Returns
+    -------
+    mask: Numpy array
+        True for the events near the tile.
+    """
+    if tile_id == NO_COORDINATES_TILE:
+        return np.zeros(len(weather_df), dtype=bool)
+    lat_index, lon_index = [int(x) for x in tile_id.split("_")]
+    lat_min = -90 + lat_index * tile_size_deg
+    lat_max = min(lat_min + tile_size_deg, 90)
+    lon_min = -180 + lon_index * tile_size_deg
+    lon_max = min(lon_min + tile_size_deg, 180)
+    # Latitude differs by at most the angular distance, and longitude by
+    # asin(sin(distance) / cos(latitude)) at the system's latitude
+    angle = padding_km / EARTH_RADIUS_KM
+    lat_padding = np.degrees(angle)
+    max_abs_lat = min(max(abs(lat_min - lat_padding),
+                          abs(lat_max + lat_padding)), 90)
+    cos_lat = np.cos(np.radians(max_abs_lat))
+    if cos_lat <= np.sin(angle):
+        lon_padding = 180
+    else:
+        lon_padding = np.degrees(np.arcsin(np.sin(angle) / cos_lat))
+    lon_center = (lon_min + lon_max) / 2
+    lon_half_width = (lon_max - lon_min) / 2 + lon_padding
+
+    def near(latitude, longitude):
+        latitude = latitude.to_numpy(dtype=float)
+        longitude = longitude.to_numpy(dtype=float)
+        lon_offset = np.abs((longitude - lon_center + 180) % 360 - 180)
+        return ((latitude >= lat_min - lat_padding) &
+                (latitude <= lat_max + lat_padding) &
+                (lon_offset <= lon_half_width))
+
+    return (near(weather_df['begin_latitude'], weather_df['begin_longitude'])
+            | near(weather_df['end_latitude'], weather_df['end_longitude']))
+
+
+class _Heartbeat():
+    """
+    Touch a lock file periodically while its tile is linked, so other
+    workers can tell a live claim from one whose worker died.
+    """
+
+    def __init__(self, lock_path, interval):
+        self.lock_path = lock_path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.lock_path)
+            except FileNotFoundError:
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+
+class ShardedLinkJob():
+    """
+    Work directory of a sharded linking run: the tiles (systems and nearby
+    events), the lock files (leases) of the claimed tiles, and the linked
+    output of each finished tile.
+
+    Typical use: prepare() once, then run() (local worker processes) or
+    'python sharded_linking.py <work_dir>' on every machine, then
+    readResults() or writeResults().
+
+    Parameters
+    ----------
+    work_dir: str
+        Work directory. For several machines, a shared file system that
+        supports exclusive file creation (e.g. NFSv3+).
+    """
+
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.job_file = os.path.join(work_dir, "job.json")
+
+    def _path(self, *parts):
+        return os.path.join(self.work_dir, *parts)
+
+    def readJob(self):
+        """
+        Read the job description written by prepare().
+
+        Returns
+        -------
+        job: dict
+            'weather_distance_config', 'geodesic_refinement',
+            'tile_size_deg', 'lease_timeout', 'tiles' (tile ID and
+            system/event counts, largest first), and 'categories'
+            (categories of the weather event columns in a single-process
+            run).
+        """
+        with open(self.job_file) as f:
+            job = json.load(f)
+        job.setdefault('lease_timeout', LEASE_TIMEOUT)
+        return job
+
+    def prepare(self, db, system_metadata, weather_distance_config,
+                tile_size_deg=5.0, weather_cache_dir=None,
+                geodesic_refinement=True, lease_timeout=LEASE_TIMEOUT):
+        """
+        Split the systems into tiles, and stream the weather events from the
+        database (or cache) into the tiles they are near, one chunk at a
+        time. Any previous job in the work directory is removed.
+
+        Parameters
+        ----------
+        db: object
+            Database object with 'dbconn' and 'dbops' attributes.
+        system_metadata: Pandas DataFrame
+            System metadata, with a unique 'system_id' column.
+        weather_distance_config: dict
+            Distance (km) per weather event type.
+        tile_size_deg: float, default 5.0
+            Tile size, in degrees of latitude and longitude.
+        weather_cache_dir: str, default None
+            Weather event cache directory, see WeatherEventStore. None
+            queries the database.
+        geodesic_refinement: bool, default True
+            Passed to linkData().
+        lease_timeout: float, default LEASE_TIMEOUT
+            Seconds without a heartbeat after which a claimed tile is
+            considered abandoned and can be claimed by another worker. The
+            clocks of the machines sharing the work directory must agree
+            to well within this.
+
+        Returns
+        -------
+        tile_ids: list
+            Tile IDs, largest first.
+        """
+        if 'system_id' not in system_metadata.columns or \
+                not system_metadata['system_id'].is_unique:
+            raise ValueError("Sharded linking requires a unique 'system_id' "
+                             "column in system_metadata.")
+        if os.path.isdir(self.work_dir):
+            shutil.rmtree(self.work_dir)
+        for directory in ['tiles', 'locks', 'results', 'done', 'errors']:
+            os.makedirs(self._path(directory))
+        # Merge order of the systems
+        system_metadata[['system_id']].to_parquet(
+            self._path("system_order.parquet"), index=False)
+        tile_ids = systemTiles(system_metadata, tile_size_deg)
+        tiles = dict()
+        for tile_id in pd.unique(tile_ids).tolist():
+            os.makedirs(self._path("tiles", tile_id))
+            tile_systems = system_metadata.iloc[
+                np.flatnonzero(tile_ids == tile_id)]
+            tile_systems.to_parquet(
+                self._path("tiles", tile_id, "systems.parquet"), index=False)
+            tiles[tile_id] = {'tile_id': tile_id,
+                              'n_systems': len(tile_systems),
+                              'n_events': 0}
+        padding_km = max(weather_distance_config.values()) * PADDING_MARGIN
+        categories = {column: list() for column in CATEGORICAL_COLUMNS}
+        chunks = iterWeatherEventChunks(
+            db, list(weather_distance_config.keys()),
+            cache_dir=weather_cache_dir)
+        for chunk_number, chunk in enumerate(chunks):
+            compact_chunk, details = compactWeatherEvents(chunk)
+            # Categories in the order a single-process pull would have
+            for column in categories:
+                if column in compact_chunk.columns:
+                    seen = set(categories[column])
+                    categories[column].extend(
+                        x for x in compact_chunk[column].cat.categories
+                        if x not in seen)
+            for tile_id, tile in tiles.items():
+                mask = tileEventMask(compact_chunk, tile_id, tile_size_deg,
+                                     padding_km)
+                if not np.any(mask):
+                    continue
+                compact_chunk[mask].to_parquet(self._path(
+                    "tiles", tile_id, f"events-{chunk_number:05d}.parquet"),
+                    index=False)
+                details[mask].to_parquet(self._path(
+                    "tiles", tile_id,
+                    f"details-{chunk_number:05d}.parquet"))
+                tile['n_events'] += int(mask.sum())
+        tiles = sorted(tiles.values(),
+                       key=lambda x: -x['n_systems'] * max(x['n_events'], 1))
+        with open(self.job_file, 'w') as f:
+            json.dump({'weather_distance_config': weather_distance_config,
+                       'geodesic_refinement': bool(geodesic_refinement),
+                       'tile_size_deg': tile_size_deg,
+                       'lease_timeout': float(lease_timeout),
+                       'tiles': tiles,
+                       'categories': categories}, f, indent=2, default=str)
+        return [x['tile_id'] for x in tiles]
+
+    def _locks(self, tile_id):
+        # Lock files of a tile as (generation, path), oldest first
+        locks = list()
+        for path in glob.glob(self._path("locks", f"{tile_id}.*.lock")):
+            generation = os.path.basename(path)[len(tile_id) + 1:-5]
+            if generation.isdigit():
+                locks.append((int(generation), path))
+        return sorted(locks)
+
+    def _claim(self, tile_id, worker_id, lease_timeout):
+        """
+        Claim a tile, or take over a claim whose lease expired. Each
+        takeover creates the next lock generation, and exclusive creation
+        succeeds for exactly one worker.
+
+        Returns
+        -------
+        lock_path: str or None
+            Lock file of the claim, None if the tile is claimed by a live
+            worker.
+        """
+        generation = 0
+        locks = self._locks(tile_id)
+        if len(locks):
+            generation, lock_path = locks[-1]
+            try:
+                idle_time = time.time() - os.path.getmtime(lock_path)
+            except FileNotFoundError:
+                return None
+            if idle_time <= lease_timeout:
+                return None
+            generation += 1
+        lock_path = self._path("locks", f"{tile_id}.{generation}.lock")
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, 'w') as f:
+            f.write(worker_id)
+        return lock_path
+
+    def _writeJSON(self, path, record):
+        # Written whole, then moved in place
+        with open(path + ".tmp", 'w') as f:
+            json.dump(record, f, indent=2, default=str)
+        os.replace(path + ".tmp", path)
+        return
+
+    def linkTile(self, tile_id, worker_id=None):
+        """
+        Link a tile's systems to its events and write the output to the
+        work directory.
+
+        Parameters
+        ----------
+        tile_id: str
+            Tile ID.
+        worker_id: str, default None
+            Worker name, recorded with the result.
+
+        Returns
+        -------
+        None.
+
+        """
+        job = self.readJob()
+        tile_dir = self._path("tiles", tile_id)
+        system_metadata = pd.read_parquet(
+            os.path.join(tile_dir, "systems.parquet"))
+        weather_df, _ = concatCompactEvents(
+            pd.read_parquet(x) for x in
+            sorted(glob.glob(os.path.join(tile_dir, "events-*.parquet"))))
+        detail_files = sorted(glob.glob(
+            os.path.join(tile_dir, "details-*.parquet")))
+        if len(detail_files):
+            details = pd.concat(pd.read_parquet(x) for x in detail_files)
+        else:
+            details = concatCompactEvents([])[1]
+        instrumentation = Instrumentation()
+        sys_linker = SystemLinker(None, system_metadata,
+                                  job['weather_distance_config'],
+                                  instrumentation=instrumentation,
+                                  weather_data=(weather_df, details))
+        system_weather_event_master = sys_linker.linkData(
+            geodesic_refinement=job['geodesic_refinement'])
+        result_file = self._path("results", tile_id + ".parquet")
+        system_weather_event_master.to_parquet(result_file + ".tmp",
+                                               index=False)
+        os.replace(result_file + ".tmp", result_file)
+        self._writeJSON(self._path("done", tile_id + ".json"), {
+            'tile_id': tile_id, 'worker_id': worker_id,
+            'n_rows': len(system_weather_event_master),
+            'funnel': instrumentation.funnel,
+            'stages': instrumentation.summary()['stages']})
+        return
+
+    def runWorker(self, worker_id=None):
+        """
+        Claim and link tiles until every tile is claimed. Several workers
+        (processes or machines) can run at once on the same work
+        directory. Tiles claimed by a worker that stopped sending
+        heartbeats for the job's lease_timeout are taken over; failed tiles
+        are skipped (see retryFailed()).
+
+        Parameters
+        ----------
+        worker_id: str, default None
+            Worker name. Defaults to '<hostname>-<pid>'.
+
+        Returns
+        -------
+        n_tiles: int
+            Number of tiles linked by this worker.
+        """
+        if worker_id is None:
+            worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        job = self.readJob()
+        n_tiles = 0
+        for tile in job['tiles']:
+            tile_id = tile['tile_id']
+            if os.path.exists(self._path("done", tile_id + ".json")) or \
+                    os.path.exists(self._path("errors", tile_id + ".json")):
+                continue
+            lock_path = self._claim(tile_id, worker_id, job['lease_timeout'])
+            if lock_path is None:
+                continue
+            try:
+                with _Heartbeat(lock_path, job['lease_timeout'] / 4):
+                    self.linkTile(tile_id, worker_id=worker_id)
+                n_tiles += 1
+            except Exception as e:
+                self._writeJSON(self._path("errors", tile_id + ".json"), {
+                    'tile_id': tile_id, 'worker_id': worker_id,
+                    'error_type': type(e).__name__, 'message': str(e),
+                    'traceback': traceback.format_exc()})
+        return n_tiles
+
+    def run(self, n_workers=None):
+        """
+        Link every tile with local worker processes.
+
+        Parameters
+        ----------
+        n_workers: int, default None
+            Number of worker processes. None uses the CPU count; 0 links
+            the tiles in this process.
+
+        Returns
+        -------
+        errors: list of dict
+            One record per failed tile, see errors().
+        """
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        if n_workers == 0:
+            self.runWorker()
+        else:
+            # prepare() has already started pyarrow's thread pools, and
+            # forking a process with live threads can deadlock on locks
+            # held at fork time, so workers are started fresh
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+            else:
+                context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=n_workers,
+                                     mp_context=context) as pool:
+                workers = [pool.submit(runShardWorker, self.work_dir)
+                           for _ in range(n_workers)]
+                for worker in workers:
+                    worker.result()
+        return self.errors()
+
+    def pendingTiles(self):
+        """
+        Get the tiles that are not linked yet.
+
+        Returns
+        -------
+        tile_ids: list
+            Tile IDs without a result.
+        """
+        return [x['tile_id'] for x in self.readJob()['tiles']
+                if not os.path.exists(self._path("done",
+                                                 x['tile_id'] + ".json"))]
+
+    def errors(self):
+        """
+        Get the failed tiles. A failed tile stays claimed until
+        retryFailed() releases it.
+
+        Returns
+        -------
+        errors: list of dict
+            'tile_id', 'worker_id', 'error_type', 'message', and
+            'traceback' of every failure.
+        """
+        errors = list()
+        for path in sorted(glob.glob(self._path("errors", "*.json"))):
+            with open(path) as f:
+                errors.append(json.load(f))
+        return errors
+
+    def retryFailed(self):
+        """
+        Release the failed tiles (remove their error and lock files), so
+        the next run() or worker links them again.
+
+        Returns
+        -------
+        tile_ids: list
+            Released tile IDs.
+        """
+        tile_ids = list()
+        for error in self.errors():
+            tile_id = error['tile_id']
+            for _, lock_path in self._locks(tile_id):
+                os.remove(lock_path)
+            os.remove(self._path("errors", tile_id + ".json"))
+            tile_ids.append(tile_id)
+        return tile_ids
+
+    def funnel(self):
+        """
+        Sum the linking funnel counts of the tiles (see
+        Instrumentation.count). The spatial candidate counts depend on the
+        tiling; the later steps match a single-process run.
+
+        Returns
+        -------
+        funnel: dict
+            Row count per funnel step.
+        """
+        funnel = dict()
+        for path in glob.glob(self._path("done", "*.json")):
+            with open(path) as f:
+                for step, n_rows in json.load(f)['funnel'].items():
+                    funnel[step] = funnel.get(step, 0) + n_rows
+        return funnel
+
+    def _resultFiles(self):
+        pending = self.pendingTiles()
+        if len(pending):
+            raise ValueError(f"{len(pending)} tiles are not linked yet, "
+                             f"e.g. '{pending[0]}'.")
+        return [self._path("results", x['tile_id'] + ".parquet")
+                for x in self.readJob()['tiles']]
+
+    def readResults(self):
+        """
+        Merge the tile results into the output of a single-process
+        linkData() run: same rows, order, and dtypes.
+
+        Returns
+        -------
+        system_weather_event_master: Pandas DataFrame
+            Linked systems and weather events.
+        """
+        job = self.readJob()
+        frames = [pd.read_parquet(x) for x in self._resultFiles()]
+        if len(frames) == 0:
+            return pd.DataFrame()
+        # Categories as in a single-process run: the pulled events'
+        # categories, and the sorted categories seen in the candidates
+        for column in frames[0].columns:
+            if not isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+                continue
+            if column in job['categories']:
+                categories = job['categories'][column]
+            else:
+                categories = sorted(set().union(
+                    *[x[column].cat.categories for x in frames]))
+            for frame in frames:
+                frame[column] = frame[column].cat.set_categories(categories)
+        system_weather_event_master = pd.concat(frames, ignore_index=True)
+        system_order = pd.read_parquet(self._path("system_order.parquet"))
+        system_position = pd.Index(system_order['system_id']).get_indexer(
+            system_weather_event_master['system_id'])
+        return system_weather_event_master.iloc[
+            np.argsort(system_position, kind='stable')].reset_index(
+                drop=True)
+
+    def writeResults(self, result_store):
+        """
+        Write the tile results to a store partitioned by system, one tile
+        at a time, without merging them in memory. Each system's rows are
+        in the same order as in a single-process run.
+
+        Parameters
+        ----------
+        result_store: results_io.ResultStore
+            Store partitioned by 'system_id'.
+
+        Returns
+        -------
+        None.
+
+        """
+        for result_file in self._resultFiles():
+            tile_results = pd.read_parquet(result_file)
+            if len(tile_results):
+                result_store.write(tile_results)
+        return
+
+
+def runShardWorker(work_dir, worker_id=None):
+    """
+    Run a tile worker on a work directory, see ShardedLinkJob.runWorker().
+    """
+    return ShardedLinkJob(work_dir).runWorker(worker_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Link the tiles of a sharded linking job.")
+    parser.add_argument('work_dir', help="Work directory of the job.")
+    parser.add_argument('--worker-id', default=None)
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="Release the failed tiles before linking, so "
+                        "they are tried again.")
+    args = parser.parse_args()
+    if args.retry_failed:
+        released = ShardedLinkJob(args.work_dir).retryFailed()
+        print(f"Released {len(released)} failed tiles.", file=sys.stderr)
+    n_tiles = runShardWorker(args.work_dir, args.worker_id)
+    print(f"Linked {n_tiles} tiles.", file=sys.stderr)
@@ -0,0 +1,255 @@
+"""
+Spatial join engine for linking systems to nearby extreme weather events.
+"""
+
+import numpy as np
+import pandas as pd
+import geopy.distance
+from instrumentation import systemIds
+
+
+# Mean earth radius, in km
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+
+
+def haversineDistance(latitude_1, longitude_1, latitude_2, longitude_2):
+    """
+    Vectorized great-circle distance between two sets of coordinates.
+
+    Parameters
+    ----------
+    latitude_1: Numpy array or float
+        Latitude(s) of the first set of points, in degrees.
+    longitude_1: Numpy array or float
+        Longitude(s) of the first set of points, in degrees.
+    latitude_2: Numpy array or float
+        Latitude(s) of the second set of points, in degrees.
+    longitude_2: Numpy array or float
+        Longitude(s) of the second set of points, in degrees.
+
+    Returns
+    -------
+    distance: Numpy array
+        Great-circle distance in km. NaN wherever a coordinate is missing.
+    """
+    lat_1 = np.radians(latitude_1)
+    lat_2 = np.radians(latitude_2)
+    d_lat = lat_2 - lat_1
+    d_lon = np.radians(np.asarray(longitude_2) - np.asarray(longitude_1))
+    a = (np.sin(d_lat / 2) ** 2 +
+         np.cos(lat_1) * np.cos(lat_2) * np.sin(d_lon / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class EventSpatialIndex():
+    """
+    Grid bucket index over the begin and end points of weather events.
+
+    Points are bucketed into lat/lon cells at least as large as the search
+    radius, so every point within the radius of a query location falls into
+    one of the query's neighbouring cells.
+    """
+
+    def __init__(self, begin_latitude, begin_longitude,
+                 end_latitude, end_longitude, radius_km):
+        self.radius_km = float(radius_km)
+        self.n_events = len(begin_latitude)
+        self.lat_cell_deg = max(self.radius_km / KM_PER_DEGREE, 1e-6)
+        self.n_lat = int(np.ceil(180 / self.lat_cell_deg)) + 1
+        # Longitude cells divide the globe evenly so indices wrap at +/-180
+        self.n_lon = max(int(np.floor(360 / self.lat_cell_deg)), 1)
+        self.lon_cell_deg = 360 / self.n_lon
+        latitude = np.concatenate([np.asarray(begin_latitude, dtype=float),
+                                   np.asarray(end_latitude, dtype=float)])
+        longitude = np.concatenate([np.asarray(begin_longitude, dtype=float),
+                                    np.asarray(end_longitude, dtype=float)])
+        event_position = np.concatenate([np.arange(self.n_events),
+                                         np.arange(self.n_events)])
+        valid = ~(np.isnan(latitude) | np.isnan(longitude))
+        keys = self._cellKeys(latitude[valid], longitude[valid])
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.event_position = event_position[valid][order]
+
+    def _latIndex(self, latitude):
+        return np.clip(np.floor((latitude + 90) / self.lat_cell_deg),
+                       0, self.n_lat - 1).astype(np.int64)
+
+    def _lonIndex(self, longitude):
+        return (np.floor((longitude + 180) / self.lon_cell_deg)
+                .astype(np.int64) % self.n_lon)
+
+    def _cellKeys(self, latitude, longitude):
+        return self._latIndex(latitude) * self.n_lon + \
+            self._lonIndex(longitude)
+
+    def query(self, latitude, longitude):
+        """
+        Get every (query point, event) pair whose event begin or end point
+        shares a neighbouring grid cell with the query point.
+
+        Parameters
+        ----------
+        latitude: Numpy array
+            Latitudes of the query points (systems), in degrees.
+        longitude: Numpy array
+            Longitudes of the query points (systems), in degrees.
+
+        Returns
+        -------
+        query_position: Numpy array
+            Position of the query point for each candidate pair.
+        event_position: Numpy array
+            Position of the weather event for each candidate pair.
+
+        Notes
+        -----
+        Candidate pairs are unique and sorted by query position, then event
+        position. They still need an exact distance check against the radius.
+        """
+        latitude = np.asarray(latitude, dtype=float)
+        longitude = np.asarray(longitude, dtype=float)
+        valid = np.flatnonzero(~(np.isnan(latitude) | np.isnan(longitude)))
+        empty = np.array([], dtype=np.int64)
+        if len(valid) == 0 or len(self.keys) == 0:
+            return empty, empty
+        latitude = latitude[valid]
+        longitude = longitude[valid]
+        lat_idx = self._latIndex(latitude)
+        lon_idx = self._lonIndex(longitude)
+        # Longitude half-width of the search circle, widest at the edge of
+        # the latitude band closest to the pole
+        angular_radius = self.radius_km / EARTH_RADIUS_KM
+        max_abs_lat = np.minimum(np.abs(latitude) +
+                                 np.degrees(angular_radius), 90)
+        cos_lat = np.cos(np.radians(max_abs_lat))
+        sin_ratio = np.sin(min(angular_radius, np.pi / 2)) / np.maximum(
+            cos_lat, 1e-12)
+        d_lon = np.where(sin_ratio >= 1, 180,
+                         np.degrees(np.arcsin(np.minimum(sin_ratio, 1))))
+        span = np.ceil(d_lon / self.lon_cell_deg).astype(np.int64)
+        full = (2 * span + 1) >= self.n_lon
+        width = np.where(full, self.n_lon, 2 * span + 1)
+        first = np.where(full, 0, lon_idx - span)
+        # Enumerate the 3 x width neighbouring cells for every query point
+        n_cells = 3 * width
+        cell_query = np.repeat(np.arange(len(valid)), n_cells)
+        cell_offset = np.arange(n_cells.sum()) - np.repeat(
+            np.cumsum(n_cells) - n_cells, n_cells)
+        cell_width = width[cell_query]
+        cell_lat = lat_idx[cell_query] + cell_offset // cell_width - 1
+        cell_lon = (first[cell_query] + cell_offset % cell_width) % self.n_lon
+        in_range = (cell_lat >= 0) & (cell_lat < self.n_lat)
+        cell_query = cell_query[in_range]
+        cell_keys = cell_lat[in_range] * self.n_lon + cell_lon[in_range]
+        # Look up each cell's slice of the sorted point keys
+        lo = np.searchsorted(self.keys, cell_keys, side='left')
+        hi = np.searchsorted(self.keys, cell_keys, side='right')
+        counts = hi - lo
+        pair_query = np.repeat(cell_query, counts)
+        pair_point = np.repeat(lo, counts) + np.arange(counts.sum()) - \
+            np.repeat(np.cumsum(counts) - counts, counts)
+        pair_event = self.event_position[pair_point]
+        # A begin and end point can both hit, so drop duplicate pairs
+        pair_key = np.unique(pair_query * self.n_events + pair_event)
+        return (valid[pair_key // self.n_events],
+                pair_key % self.n_events)
+
+
+def spatialJoin(system_metadata, weather_df, weather_distance_config,
+                geodesic_refinement=True, refinement_tolerance=0.01,
+                instrumentation=None):
+    """
+    Find every weather event within the max configured distance of each
+    system, in one batch over the whole fleet.
+
+    Parameters
+    ----------
+    system_metadata: Pandas DataFrame
+        System metadata containing 'latitude' and 'longitude' columns.
+    weather_df: Pandas DataFrame
+        Weather events containing 'event_type', 'begin_latitude',
+        'begin_longitude', 'end_latitude', and 'end_longitude' columns.
+    weather_distance_config: dict
+        Dictionary of event type to the max distance (km) from the system.
+    geodesic_refinement: bool, default True
+        If True, recompute distances with the exact geodesic for pairs whose
+        great-circle distance is close to a distance threshold.
+    refinement_tolerance: float, default 0.01
+        Relative band around each threshold where pairs are refined. The
+        spherical approximation is within ~0.6% of the geodesic.
+    instrumentation: instrumentation.Instrumentation, default None
+        If given, the number of grid cell candidates and of pairs within
+        the max distance are recorded per system.
+
+    Returns
+    -------
+    pairs: Pandas DataFrame
+        One row per (system, event) pair, with 'system_position' and
+        'event_position' (row positions in the inputs) plus the
+        'distance_to_weather_event_start_km',
+        'distance_to_weather_event_end_km', and
+        'min_distance_to_weather_event_km' columns. Sorted by system
+        position, then event position.
+
+    Notes
+    -----
+    The search uses the max radius in the config rather than each event
+    type's own radius, as cleanUpWeatherData() aggregates over every nearby
+    event in a master category before the per-type distance filter is
+    applied in linkData().
+    """
+    max_distance = max(weather_distance_config.values())
+    index = EventSpatialIndex(weather_df['begin_latitude'].values,
+                              weather_df['begin_longitude'].values,
+                              weather_df['end_latitude'].values,
+                              weather_df['end_longitude'].values,
+                              max_distance)
+    system_latitude = system_metadata['latitude'].values.astype(float)
+    system_longitude = system_metadata['longitude'].values.astype(float)
+    system_position, event_position = index.query(system_latitude,
+                                                  system_longitude)
+    if instrumentation is not None:
+        instrumentation.count('spatial_candidates',
+                              systemIds(system_metadata)[system_position])
+    sys_lat = system_latitude[system_position]
+    sys_lon = system_longitude[system_position]
+    begin_lat = weather_df['begin_latitude'].values.astype(float)[
+        event_position]
+    begin_lon = weather_df['begin_longitude'].values.astype(float)[
+        event_position]
+    end_lat = weather_df['end_latitude'].values.astype(float)[event_position]
+    end_lon = weather_df['end_longitude'].values.astype(float)[event_position]
+    start_distance = haversineDistance(sys_lat, sys_lon, begin_lat, begin_lon)
+    end_distance = haversineDistance(sys_lat, sys_lon, end_lat, end_lon)
+    min_distance = np.fmin(start_distance, end_distance)
+    if geodesic_refinement and len(min_distance):
+        type_distance = weather_df['event_type'].map(
+            weather_distance_config).values.astype(float)[event_position]
+        near_threshold = (
+            (np.abs(min_distance - type_distance) <=
+             refinement_tolerance * type_distance) |
+            (np.abs(min_distance - max_distance) <=
+             refinement_tolerance * max_distance))
+        for idx in np.flatnonzero(near_threshold):
+            sys_coords = (sys_lat[idx], sys_lon[idx])
+            if not np.isnan(start_distance[idx]):
+                start_distance[idx] = geopy.distance.geodesic(
+                    sys_coords, (begin_lat[idx], begin_lon[idx])).km
+            if not np.isnan(end_distance[idx]):
+                end_distance[idx] = geopy.distance.geodesic(
+                    sys_coords, (end_lat[idx], end_lon[idx])).km
+        min_distance = np.fmin(start_distance, end_distance)
+    pairs = pd.DataFrame({
+        'system_position': system_position,
+        'event_position': event_position,
+        'distance_to_weather_event_start_km': start_distance,
+        'distance_to_weather_event_end_km': end_distance,
+        'min_distance_to_weather_event_km': min_distance})
+    pairs = pairs[pairs['min_distance_to_weather_event_km'] <= max_distance]
+    if instrumentation is not None:
+        instrumentation.count('within_max_distance',
+                              systemIds(system_metadata)[
+                                  pairs['system_position'].values])
+    return pairs.reset_index(drop=True)
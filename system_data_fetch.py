@@ -0,0 +1,320 @@
+"""
+Async fetching of per-system time series files (e.g. from S3) into a local
+cache, over one shared, pooled filesystem session.
+
+Downloads run on an asyncio event loop in a background thread, with bounded
+concurrency and retries with backoff. Each cached file is stored with the
+ETag of the object it came from, so unchanged files are not downloaded
+again.
+"""
+
+import os
+import json
+import random
+import asyncio
+import threading
+import fsspec
+from fsspec.asyn import AsyncFileSystem
+from pipeline import CSVSystemDataSource
+
+
+def _objectVersion(info):
+    """
+    Get a version string for a remote object: its ETag, or its size and
+    modification time for backends without ETags (e.g. local directories).
+    """
+    for key in ['ETag', 'etag', 'md5']:
+        if info.get(key):
+            return str(info[key]).strip('"')
+    return f"{info.get('size')}-{info.get('mtime', info.get('LastModified'))}"
+
+
+class AsyncFileFetcher():
+    """
+    Fetch files from a directory or fsspec URL into a local cache, with one
+    shared filesystem session (for S3, one pooled aiobotocore client).
+    Async filesystems (s3fs) are called natively, others (local, moto via
+    a mounted directory) in worker threads.
+
+    The public methods are synchronous and thread-safe, so the fetcher can
+    be shared by the SystemPipeline's fetch threads.
+
+    Parameters
+    ----------
+    base_path: str
+        Directory or URL holding the files, e.g.
+        "s3://pvdrdb-inbox/Analysis_input/PVDRDB/".
+    storage_options: dict, default None
+        Options for the fsspec filesystem, e.g. {"key": ..., "secret": ...}
+        or {"client_kwargs": {"endpoint_url": ...}} for a local S3 stand-in
+        such as moto server.
+    cache_dir: str, default "./system_data_cache"
+        Local directory the files are downloaded to.
+    max_concurrency: int, default 8
+        Max number of files downloaded at once.
+    retries: int, default 3
+        Number of retries of a failed download. Missing files are not
+        retried.
+    backoff: float, default 0.5
+        Base delay (s) before a retry, doubled on every attempt, with
+        jitter.
+
+    Notes
+    -----
+    Requires fsspec, plus s3fs for S3 URLs.
+    """
+
+    def __init__(self, base_path, storage_options=None,
+                 cache_dir="./system_data_cache", max_concurrency=8,
+                 retries=3, backoff=0.5):
+        self.base_path = base_path
+        self.storage_options = dict(storage_options or {})
+        self.cache_dir = cache_dir
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.retries = max(int(retries), 0)
+        self.backoff = backoff
+        self.stats = {'downloaded': 0, 'cached': 0, 'retried': 0}
+        # Fetches in flight or not handed out by get() yet
+        self.fetches = dict()
+        self.client = None
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        # The filesystem and its session are created on the fetch loop,
+        # and shared by every download
+        self.fs = self._submit(self._openFilesystem()).result()
+
+    def _submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def _openFilesystem(self):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        protocol = fsspec.utils.get_protocol(self.base_path)
+        fs_class = fsspec.get_filesystem_class(protocol)
+        if issubclass(fs_class, AsyncFileSystem):
+            fs = fs_class(asynchronous=True, loop=self.loop,
+                          **self.storage_options)
+            if hasattr(fs, 'set_session'):
+                # The pooled client, closed by close()
+                self.client = await fs.set_session()
+        else:
+            fs = fs_class(**self.storage_options)
+        return fs
+
+    async def _call(self, method, *args):
+        # Native coroutine for async filesystems, else a worker thread
+        if isinstance(self.fs, AsyncFileSystem):
+            return await getattr(self.fs, '_' + method)(*args)
+        return await asyncio.to_thread(getattr(self.fs, method), *args)
+
+    def remotePath(self, name):
+        return self.base_path.rstrip('/') + '/' + name
+
+    def localPath(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _readVersion(self, name):
+        version_file = self.localPath(name) + ".etag.json"
+        if not (os.path.exists(version_file) and
+                os.path.exists(self.localPath(name))):
+            return None
+        with open(version_file) as f:
+            return json.load(f).get('version')
+
+    def _writeVersion(self, name, version):
+        with open(self.localPath(name) + ".etag.json", 'w') as f:
+            json.dump({'version': version,
+                       'remote_path': self.remotePath(name)}, f)
+        return
+
+    async def _fetch(self, name):
+        remote_path = self.remotePath(name)
+        local_path = self.localPath(name)
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    version = _objectVersion(
+                        await self._call('info', remote_path))
+                    if self._readVersion(name) == version:
+                        self.stats['cached'] += 1
+                        return local_path
+                    # Download next to the cached copy, then swap it in
+                    part_path = local_path + ".part"
+                    await self._call('get_file', remote_path, part_path)
+                    os.replace(part_path, local_path)
+                    self._writeVersion(name, version)
+                    self.stats['downloaded'] += 1
+                    return local_path
+                except FileNotFoundError:
+                    raise
+                except Exception:
+                    if attempt == self.retries:
+                        raise
+                    self.stats['retried'] += 1
+                    await asyncio.sleep(self.backoff * 2 ** attempt *
+                                        (0.5 + random.random()))
+
+    def fetch(self, name):
+        """
+        Start fetching a file, unless it is already fetched or in flight.
+
+        Parameters
+        ----------
+        name: str
+            File name under base_path.
+
+        Returns
+        -------
+        future: concurrent.futures.Future
+            Resolves to the local path of the file.
+        """
+        with self.lock:
+            future = self.fetches.get(name)
+            # Failed fetches are started again
+            if future is None or (future.done() and
+                                  future.exception() is not None):
+                future = self._submit(self._fetch(name))
+                self.fetches[name] = future
+            return future
+
+    def prefetch(self, names):
+        """
+        Start fetching files in the background, in order.
+
+        Parameters
+        ----------
+        names: list
+            File names under base_path.
+
+        Returns
+        -------
+        None.
+
+        """
+        for name in names:
+            self.fetch(name)
+        return
+
+    def get(self, name):
+        """
+        Fetch a file (or wait for its prefetch) and get its local path.
+        The fetch is then forgotten, so a later call checks the file's
+        ETag again.
+
+        Parameters
+        ----------
+        name: str
+            File name under base_path.
+
+        Returns
+        -------
+        local_path: str
+            Path of the cached file.
+        """
+        future = self.fetch(name)
+        try:
+            return future.result()
+        finally:
+            with self.lock:
+                if self.fetches.get(name) is future:
+                    del self.fetches[name]
+
+    async def _close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+        return
+
+    def close(self):
+        """
+        Close the session and stop the fetch loop.
+
+        Returns
+        -------
+        None.
+
+        """
+        if not self.loop.is_running():
+            return
+        self._submit(self._close()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+
+class CachedCSVSystemDataSource(CSVSystemDataSource):
+    """
+    Reader for per-system time series stored as '<system_id>.csv' under a
+    base path (e.g. an S3 bucket), fetched through an AsyncFileFetcher
+    into a local cache and parsed from there. SystemPipeline calls
+    prefetch() with the next systems, so their files download while the
+    current ones are parsed and analyzed.
+
+    Parameters
+    ----------
+    base_path: str
+        Directory or URL holding the system CSV files.
+    storage_options: dict, default None
+        Options for the fsspec filesystem, see AsyncFileFetcher.
+    cache_dir: str, default "./system_data_cache"
+        Local directory the files are downloaded to.
+    max_concurrency: int, default 8
+        Max number of files downloaded at once.
+    retries: int, default 3
+        Number of retries of a failed download.
+    backoff: float, default 0.5
+        Base delay (s) before a retry.
+    """
+
+    def __init__(self, base_path, storage_options=None,
+                 cache_dir="./system_data_cache", max_concurrency=8,
+                 retries=3, backoff=0.5):
+        # Files are parsed from the local cache
+        super().__init__(base_path, storage_options=None)
+        self.fetcher = AsyncFileFetcher(
+            base_path, storage_options=storage_options, cache_dir=cache_dir,
+            max_concurrency=max_concurrency, retries=retries,
+            backoff=backoff)
+
+    def path(self, system_id):
+        return self.fetcher.get(str(system_id) + ".csv")
+
+    def prefetch(self, system_ids):
+        """
+        Start downloading the files of upcoming systems.
+
+        Parameters
+        ----------
+        system_ids: list
+            System IDs, in processing order.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.fetcher.prefetch([str(x) + ".csv" for x in system_ids])
+        return
+
+    def close(self):
+        """
+        Close the fetcher's session.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.fetcher.close()
+        return
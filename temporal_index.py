@@ -0,0 +1,159 @@
+"""
+Sorted start-time index for filtering weather events to a system's data
+period.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def normalizeWeatherTimestamps(weather_df):
+    """
+    Parse the weather event timestamps once, to tz-aware UTC datetime64[ns]
+    columns, and sort the events by start time.
+
+    Parameters
+    ----------
+    weather_df: Pandas DataFrame
+        Weather events containing 'start_timestamp' and 'end_timestamp'
+        columns.
+
+    Returns
+    -------
+    weather_df: Pandas DataFrame
+        Copy of the weather events, sorted by 'start_timestamp'. The
+        original index is kept. Events missing either timestamp can never
+        match a data period, so they are dropped.
+    """
+    weather_df = weather_df.copy()
+    for column in ['start_timestamp', 'end_timestamp']:
+        weather_df[column] = pd.to_datetime(
+            weather_df[column], utc=True).astype("datetime64[ns, UTC]")
+    weather_df = weather_df.dropna(subset=['start_timestamp',
+                                           'end_timestamp'])
+    return weather_df.sort_values('start_timestamp', kind='stable')
+
+
+class EventTimeIndex():
+    """
+    Binary-search index over weather events sorted by start time.
+
+    Each system's data period resolves to a contiguous slice of the sorted
+    events with two searchsorted calls, so events that start outside every
+    data period are dropped before the spatial join. The remaining
+    (system, event) pairs are checked against their own system's period
+    with contains().
+    """
+
+    def __init__(self, start_timestamp, end_timestamp):
+        self.start = self._toNanoseconds(start_timestamp)
+        self.end = self._toNanoseconds(end_timestamp)
+        if np.any(self.start[1:] < self.start[:-1]):
+            raise ValueError("Weather events must be sorted by "
+                             "'start_timestamp'.")
+
+    @staticmethod
+    def _toNanoseconds(timestamps):
+        timestamps = pd.to_datetime(pd.Series(timestamps), utc=True)
+        return timestamps.astype("datetime64[ns, UTC]").dt.tz_convert(
+            None).values.astype(np.int64)
+
+    @staticmethod
+    def _dayBounds(started_on, ended_on):
+        # Events are matched on whole UTC days: start date on or after the
+        # first day of data, end date on or before the last day of data
+        started_on = pd.to_datetime(pd.Series(started_on)).dt.normalize()
+        ended_on = pd.to_datetime(pd.Series(ended_on)).dt.normalize() + \
+            pd.Timedelta(days=1)
+        lower = started_on.astype("datetime64[ns]").values.astype(np.int64)
+        upper = ended_on.astype("datetime64[ns]").values.astype(np.int64)
+        # Missing dates match nothing
+        missing = started_on.isna().values | ended_on.isna().values
+        lower[missing] = np.iinfo(np.int64).max
+        upper[missing] = np.iinfo(np.int64).min
+        return lower, upper
+
+    def window(self, started_on, ended_on):
+        """
+        Get the slice of sorted events that start within each data period.
+
+        Parameters
+        ----------
+        started_on: array-like of datetime
+            First timestamp of data for each system (naive).
+        ended_on: array-like of datetime
+            Last timestamp of data for each system (naive).
+
+        Returns
+        -------
+        lower: Numpy array
+            First event position for each system.
+        upper: Numpy array
+            One past the last event position for each system.
+        """
+        lower, upper = self._dayBounds(started_on, ended_on)
+        return (np.searchsorted(self.start, lower, side='left'),
+                np.searchsorted(self.start, upper, side='left'))
+
+    def contains(self, event_position, started_on, ended_on):
+        """
+        Check whether events fall within the matching system data periods.
+
+        Parameters
+        ----------
+        event_position: Numpy array
+            Positions of the events in the index.
+        started_on: array-like of datetime
+            First timestamp of data for the system paired with each event.
+        ended_on: array-like of datetime
+            Last timestamp of data for the system paired with each event.
+
+        Returns
+        -------
+        mask: Numpy array
+            Boolean mask, True where the event starts on or after the first
+            day of data and ends on or before the last day of data.
+        """
+        lower, upper = self._dayBounds(started_on, ended_on)
+        event_position = np.asarray(event_position)
+        return ((self.start[event_position] >= lower) &
+                (self.end[event_position] < upper))
+
+    def startsWithin(self, started_on, ended_on):
+        """
+        Find the events that start within any of the data periods: the
+        union of the window() slices, merged after sorting them by their
+        first position. For S data periods and k events found this takes
+        O(S log S + S log N + k), however many events start outside every
+        period.
+
+        Parameters
+        ----------
+        started_on: array-like of datetime
+            First timestamp of data for each system (naive).
+        ended_on: array-like of datetime
+            Last timestamp of data for each system (naive).
+
+        Returns
+        -------
+        event_position: Numpy array
+            Sorted positions of the events that start on a day within at
+            least one data period.
+        """
+        lower, upper = self.window(started_on, ended_on)
+        # Empty slices (e.g. missing dates) cover nothing
+        non_empty = upper > lower
+        order = np.argsort(lower[non_empty], kind='stable')
+        lower = lower[non_empty][order]
+        upper = upper[non_empty][order]
+        if len(lower) == 0:
+            return np.array([], dtype=np.int64)
+        # A slice starts a new run of positions unless it overlaps the
+        # runs before it
+        reach = np.maximum.accumulate(upper)
+        run_start = np.concatenate([[True], lower[1:] > reach[:-1]])
+        run_lower = lower[run_start]
+        run_upper = reach[np.concatenate([run_start[1:], [True]])]
+        lengths = run_upper - run_lower
+        return np.arange(lengths.sum(), dtype=np.int64) + np.repeat(
+            run_lower - np.cumsum(lengths) + lengths, lengths)
@@ -0,0 +1,28 @@
+"""
+Shared setup for the regression tests: the repo modules are flat and read
+master-weather-category.csv relative to the repo root.
+"""
+
+import os
+import sys
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(TEST_DIR)
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+os.chdir(REPO_ROOT)
+
+from synthetic import generateSystemMetadata, generateWeatherEvents
+
+
+@pytest.fixture(scope="session")
+def synthetic_fleet():
+    """
+    Synthetic system metadata and weather events, with half of the events
+    placed near systems so they link.
+    """
+    system_metadata = generateSystemMetadata(150, seed=7)
+    weather_events = generateWeatherEvents(
+        3000, system_metadata=system_metadata, seed=7)
+    return system_metadata, weather_events
@@ -0,0 +1,122 @@
+"""
+Check DailyEnergyCube scores against scoreEventPerformance as the cube is
+updated run by run, and that each run only writes the systems it adds.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from energy_cube import DailyEnergyCube, EnergyCubeWriter
+from pv_performance import DailyEnergyTable, scoreEventPerformance
+
+
+def syntheticSystem(system_id, version=0):
+    rng = np.random.default_rng([system_id, version])
+    index = pd.date_range("2019-01-01", periods=rng.integers(200, 500) * 24,
+                          freq="h") + pd.Timedelta(days=int(
+                              rng.integers(0, 60)))
+    n_streams = 1 + system_id % 3
+    data = pd.DataFrame(rng.uniform(0, 5, (len(index), n_streams)),
+                        index=index,
+                        columns=[f"ac_power_{x}" for x in range(n_streams)])
+    # A gap in the data
+    return data.drop(index[1000:1500])
+
+
+def syntheticEvents(system_ids, n_events=20, seed=0):
+    rng = np.random.default_rng(seed)
+    started_on = pd.Timestamp("2019-01-01", tz="UTC") + pd.to_timedelta(
+        rng.integers(0, 600 * 24, n_events * len(system_ids)), unit="h")
+    return pd.DataFrame({
+        'system_id': np.tile(system_ids, n_events),
+        'weather_event_id': np.arange(n_events * len(system_ids)),
+        'weather_event_started_on': started_on})
+
+
+def addSystems(cube_path, systems, **kwargs):
+    with EnergyCubeWriter(cube_path, **kwargs) as writer:
+        for system_id, data in systems.items():
+            writer.add(system_id, DailyEnergyTable(data))
+
+
+def assertScoresMatch(cube_path, systems):
+    weather_events = syntheticEvents(list(systems) + [999])
+    result = DailyEnergyCube(cube_path).scoreEvents(weather_events)
+    expected = pd.concat(
+        [scoreEventPerformance(data, weather_events[
+            weather_events['system_id'] == system_id])
+         for system_id, data in systems.items()]).sort_values(
+             'weather_event_id', kind='stable').reset_index(drop=True)
+    # Rows by event, then stream; events of unknown systems left out
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def segments(cube_path):
+    return sorted(x for x in os.listdir(cube_path) if
+                  x.startswith("segment-"))
+
+
+def test_runs_add_segments(tmp_path):
+    cube_path = str(tmp_path / "energy_cube")
+    systems = {x: syntheticSystem(x) for x in range(6)}
+    addSystems(cube_path, systems)
+    assertScoresMatch(cube_path, systems)
+    first_segment = segments(cube_path)
+    # A run with a changed and a new system only writes those two
+    systems[2] = syntheticSystem(2, version=1)
+    systems[6] = syntheticSystem(6)
+    addSystems(cube_path, {x: systems[x] for x in [2, 6]})
+    cube = DailyEnergyCube(cube_path)
+    assert len(cube.segments) == 2
+    assert list(cube.segments[1].system_id) == [2, 6]
+    assert set(first_segment) < set(segments(cube_path))
+    assert sorted(cube.systemIds()) == list(range(7))
+    np.testing.assert_array_equal(cube.energyTable(2).energy,
+                                  DailyEnergyTable(systems[2]).energy)
+    assertScoresMatch(cube_path, systems)
+
+
+def test_superseded_segments_are_compacted(tmp_path):
+    cube_path = str(tmp_path / "energy_cube")
+    systems = {x: syntheticSystem(x) for x in range(4)}
+    addSystems(cube_path, systems)
+    # Re-adding most of the fleet leaves more superseded than live data
+    for version in range(1, 4):
+        systems.update({x: syntheticSystem(x, version) for x in range(3)})
+        addSystems(cube_path, {x: systems[x] for x in range(3)})
+        cube = DailyEnergyCube(cube_path)
+        assert cube.n_stored_series_days <= 2 * cube.seriesDays().sum()
+        assert segments(cube_path) == sorted(cube.segment_names)
+        assertScoresMatch(cube_path, systems)
+    assert len(DailyEnergyCube(cube_path).segments) < 4
+
+
+def test_failed_run_keeps_the_cube(tmp_path):
+    cube_path = str(tmp_path / "energy_cube")
+    systems = {x: syntheticSystem(x) for x in range(3)}
+    addSystems(cube_path, systems)
+    with pytest.raises(RuntimeError):
+        with EnergyCubeWriter(cube_path) as writer:
+            writer.add(0, DailyEnergyTable(syntheticSystem(0, version=1)))
+            raise RuntimeError("Run failed")
+    with pytest.raises(ValueError):
+        with EnergyCubeWriter(cube_path) as writer:
+            writer.add(1, DailyEnergyTable(systems[1]))
+            writer.add(1, DailyEnergyTable(systems[1]))
+    # No segment or build directory is left behind
+    assert sorted(os.listdir(cube_path)) == ["cube.json"] + \
+        segments(cube_path)
+    assert len(segments(cube_path)) == 1
+    assertScoresMatch(cube_path, systems)
+
+
+def test_rebuild(tmp_path):
+    cube_path = str(tmp_path / "energy_cube")
+    addSystems(cube_path, {x: syntheticSystem(x) for x in range(3)})
+    systems = {5: syntheticSystem(5)}
+    addSystems(cube_path, systems, update=False)
+    cube = DailyEnergyCube(cube_path)
+    assert list(cube.systemIds()) == [5]
+    assert len(segments(cube_path)) == 1
+    assertScoresMatch(cube_path, systems)
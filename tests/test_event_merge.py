@@ -0,0 +1,164 @@
+"""
+Check SystemLinker.cleanUpWeatherData (the interval sweep in event_merge)
+against the original explode-based clean-up, on the bundled linked events
+and on synthetic storms.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import weather_event_system_linker as we
+from weather_distance_config import weather_distance_config
+from weather_event_store import concatCompactEvents
+
+
+OUTPUT_COLUMNS = ['weather_event_id', 'state', 'location', 'event_type',
+                  'begin_latitude', 'begin_longitude', 'end_latitude',
+                  'end_longitude', 'weather_event_started_on',
+                  'weather_event_ended_on', 'magnitude', 'magnitude_type',
+                  'damage_property', 'damage_crops', 'episode_narrative',
+                  'comments', 'distance_to_weather_event_start_km',
+                  'distance_to_weather_event_end_km',
+                  'min_distance_to_weather_event_km', 'weather_event_master']
+
+
+def baselineCleanUp(weather_events):
+    """
+    The clean-up the interval sweep replaced, run on one system's events,
+    with storms no longer chaining across master categories (day_diff is
+    taken within each category).
+    """
+    weather_events = pd.merge(weather_events, we.sub_event_type_df,
+                              on='event_type')
+    weather_events['start_date'] = weather_events['start_timestamp'].dt.date
+    weather_events['end_date'] = weather_events['end_timestamp'].dt.date
+    weather_events["dates"] = weather_events.apply(
+        lambda row: pd.date_range(row["start_date"], row["end_date"]),
+        axis=1)
+    weather_events_exploded = weather_events.explode("dates")
+    weather_events_sub = weather_events_exploded[
+        ['dates', 'weather_event_master']].drop_duplicates()
+    weather_events_sub = weather_events_sub.sort_values(
+        ['weather_event_master', 'dates'])
+    weather_events_sub['day_diff'] = weather_events_sub.groupby(
+        'weather_event_master')['dates'].diff().dt.days
+    weather_events_sub.loc[weather_events_sub['day_diff'] != 1,
+                           'day_diff'] = 0
+    weather_events_sub['weather_event_idx'] = weather_events_sub[
+        'day_diff'].eq(0).cumsum().sub(1)
+    merged = pd.merge(weather_events_exploded, weather_events_sub,
+                      on=['dates', 'weather_event_master'])
+    storm = merged.groupby("weather_event_idx")
+    merged['weather_event_started_on'] = storm['start_timestamp'].transform(
+        "min")
+    merged['weather_event_ended_on'] = storm['end_timestamp'].transform(
+        "max")
+    for column in ['magnitude', 'damage_property', 'damage_crops']:
+        merged['max_' + column] = storm[column].transform("max")
+    merged['nearest_distance'] = storm[
+        'min_distance_to_weather_event_km'].transform("min")
+    merged = merged[merged['min_distance_to_weather_event_km'] ==
+                    merged['nearest_distance']]
+    merged = merged.drop_duplicates(subset='weather_event_idx',
+                                    keep='first')
+    for column in ['magnitude', 'damage_property', 'damage_crops']:
+        merged[column] = merged['max_' + column]
+    return merged[OUTPUT_COLUMNS]
+
+
+def cleanUpPerSystem(weather_events):
+    return pd.concat(
+        [baselineCleanUp(group.drop(columns='system_id')).assign(
+            system_id=system_id)
+         for system_id, group in weather_events.groupby('system_id')],
+        ignore_index=True)
+
+
+def assertSameStorms(result, expected):
+    key = ['system_id', 'weather_event_id']
+    result, expected = [
+        x.assign(weather_event_master=x['weather_event_master'].astype(str))
+        .sort_values(key).reset_index(drop=True)[OUTPUT_COLUMNS + [
+            'system_id']] for x in [result, expected]]
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    return
+
+
+@pytest.fixture(scope="module")
+def linker():
+    # No events to pull, cleanUpWeatherData is given its input directly
+    return we.SystemLinker(None, pd.DataFrame(), weather_distance_config,
+                           weather_data=concatCompactEvents([]))
+
+
+def syntheticCandidates(n_systems=20, n_events=60, seed=0):
+    """
+    Dense, overlapping events of a few categories per system, with tied
+    distances and missing magnitudes.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = n_systems * n_events
+    start = pd.Timestamp("2020-06-01", tz="UTC") + pd.to_timedelta(
+        rng.integers(0, 90 * 24, n_rows), unit="h")
+    duration = pd.to_timedelta(rng.choice([0, 3, 20, 30, 50, 80], n_rows),
+                               unit="h")
+    return pd.DataFrame({
+        'system_id': np.repeat(np.arange(n_systems), n_events),
+        'weather_event_id': rng.permutation(n_rows) + 1000,
+        'state': 'STATE', 'location': 'location',
+        'event_type': rng.choice(['Flood', 'Flash Flood', 'Hail',
+                                  'Marine Hail', 'Thunderstorm Wind',
+                                  'Tornado'], n_rows),
+        'begin_latitude': rng.uniform(30, 45, n_rows),
+        'begin_longitude': rng.uniform(-110, -80, n_rows),
+        'end_latitude': rng.uniform(30, 45, n_rows),
+        'end_longitude': rng.uniform(-110, -80, n_rows),
+        'start_timestamp': start, 'end_timestamp': start + duration,
+        'magnitude': np.where(rng.random(n_rows) < 0.4, np.nan,
+                              rng.integers(40, 80, n_rows)),
+        'magnitude_type': rng.choice(['EG', 'MG'], n_rows),
+        'damage_property': rng.choice([0.0, 1000.0, 5000.0], n_rows),
+        'damage_crops': rng.choice([0.0, 500.0], n_rows),
+        'episode_narrative': 'narrative', 'comments': 'comment',
+        'distance_to_weather_event_start_km': rng.uniform(0, 100, n_rows),
+        'distance_to_weather_event_end_km': rng.uniform(0, 100, n_rows),
+        'min_distance_to_weather_event_km': rng.choice(
+            [5.0, 10.0, 20.0, 40.0], n_rows)})
+
+
+def test_bundled_linked_events(linker):
+    bundled = pd.read_csv("./system_weather_event_master.csv")
+    weather_events = bundled[[x for x in OUTPUT_COLUMNS if x not in [
+        'weather_event_started_on', 'weather_event_ended_on',
+        'weather_event_master']] + ['system_id']].assign(
+            start_timestamp=pd.to_datetime(
+                bundled['weather_event_started_on'], utc=True),
+            end_timestamp=pd.to_datetime(
+                bundled['weather_event_ended_on'], utc=True))
+    result = linker.cleanUpWeatherData(weather_events, by=['system_id'])
+    assertSameStorms(result, cleanUpPerSystem(weather_events))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_synthetic_storms(linker, seed):
+    weather_events = syntheticCandidates(seed=seed)
+    result = linker.cleanUpWeatherData(weather_events, by=['system_id'])
+    expected = cleanUpPerSystem(weather_events)
+    # Events do merge into storms
+    assert len(expected) < len(weather_events)
+    assertSameStorms(result, expected)
+
+
+def test_storms_do_not_cross_categories(linker):
+    # A Flood followed by Hail on the next day: two storms, where the
+    # original shift(1) over all categories chained them into one
+    weather_events = syntheticCandidates(n_systems=1, n_events=2).assign(
+        event_type=['Flood', 'Hail'],
+        start_timestamp=pd.to_datetime(["2020-06-01 12:00",
+                                        "2020-06-02 12:00"], utc=True),
+        end_timestamp=pd.to_datetime(["2020-06-01 18:00",
+                                      "2020-06-02 18:00"], utc=True))
+    result = linker.cleanUpWeatherData(weather_events, by=['system_id'])
+    assert sorted(result['weather_event_master'].astype(str)) == \
+        ['Flood', 'Hail']
+    assertSameStorms(result, cleanUpPerSystem(weather_events))
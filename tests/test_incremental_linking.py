@@ -0,0 +1,90 @@
+"""
+Check SystemLinker.linkDataIncremental against a full linkData() run as
+systems change and events arrive.
+"""
+
+import numpy as np
+import pandas as pd
+import weather_event_system_linker as we
+from synthetic import SyntheticDB
+from weather_distance_config import weather_distance_config
+
+
+def assertSameLinks(result, expected):
+    # Categories can list more values when saved links are reused, the
+    # values themselves must match
+    result, expected = [x.apply(lambda column: column.astype(object) if
+                                isinstance(column.dtype, pd.CategoricalDtype)
+                                else column) for x in [result, expected]]
+    pd.testing.assert_frame_equal(result, expected)
+    return
+
+
+def linkBoth(system_metadata, weather_events, link_state_dir,
+             weather_distance_config=weather_distance_config):
+    expected = we.SystemLinker(SyntheticDB(weather_events), system_metadata,
+                               weather_distance_config).linkData()
+    result = we.SystemLinker(
+        SyntheticDB(weather_events), system_metadata,
+        weather_distance_config).linkDataIncremental(link_state_dir)
+    return result, expected
+
+
+def test_incremental_matches_full_run(synthetic_fleet, tmp_path):
+    system_metadata, weather_events = synthetic_fleet
+    link_state_dir = str(tmp_path / "link_state")
+    # First run, without saved state
+    first_events = weather_events.iloc[:len(weather_events) * 3 // 4]
+    result, expected = linkBoth(system_metadata, first_events,
+                                link_state_dir)
+    assert len(expected)
+    assertSameLinks(result, expected)
+    # A moved system, a changed data period, a dropped system, a new
+    # system, and newly arrived events
+    changed_metadata = system_metadata.copy()
+    changed_metadata.loc[1, 'latitude'] += 0.5
+    changed_metadata.loc[2, 'ended_on'] = changed_metadata.loc[3, 'ended_on']
+    changed_metadata = changed_metadata.drop(index=4)
+    new_system = system_metadata.iloc[[5]].assign(
+        system_id=system_metadata['system_id'].max() + 1,
+        longitude=system_metadata['longitude'].iloc[5] + 0.3)
+    changed_metadata = pd.concat([new_system, changed_metadata],
+                                 ignore_index=True)
+    result, expected = linkBoth(changed_metadata, weather_events,
+                                link_state_dir)
+    assertSameLinks(result, expected)
+    # Nothing changed
+    result, expected = linkBoth(changed_metadata, weather_events,
+                                link_state_dir)
+    assertSameLinks(result, expected)
+    # A distance config change relinks everything
+    changed_config = dict(weather_distance_config)
+    changed_config[next(iter(changed_config))] *= 0.5
+    result, expected = linkBoth(changed_metadata, weather_events,
+                                link_state_dir,
+                                weather_distance_config=changed_config)
+    assertSameLinks(result, expected)
+
+
+def test_storms_merge_across_the_watermark(synthetic_fleet, tmp_path):
+    # A new event on the day after a linked one joins its storm
+    system_metadata, weather_events = synthetic_fleet
+    link_state_dir = str(tmp_path / "link_state")
+    linkBoth(system_metadata, weather_events, link_state_dir)
+    linked = we.SystemLinker(SyntheticDB(weather_events), system_metadata,
+                             weather_distance_config).linkData()
+    storm = linked.iloc[0]
+    event = weather_events[weather_events['weather_event_id'] ==
+                           storm['weather_event_id']]
+    next_day = event.assign(
+        weather_event_id=weather_events['weather_event_id'].max() + 1,
+        start_timestamp=event['end_timestamp'] + pd.Timedelta(days=1),
+        end_timestamp=event['end_timestamp'] + pd.Timedelta(days=1, hours=2),
+        magnitude=np.nan, damage_property=1e9)
+    result, expected = linkBoth(system_metadata,
+                                pd.concat([weather_events, next_day],
+                                          ignore_index=True),
+                                link_state_dir)
+    assert len(expected) == len(linked)
+    assert expected['damage_property'].max() == 1e9
+    assertSameLinks(result, expected)
@@ -0,0 +1,133 @@
+"""
+Check SystemPipeline runs: streaming the event windows scores the same as
+reading whole files, and failing systems come back as error records
+without stopping the run.
+"""
+
+import os
+import pandas as pd
+import pytest
+import weather_event_system_linker as we
+from ac_power_stream import readEventWindows
+from pipeline import CSVSystemDataSource, SystemPipeline
+from results_io import ResultStore
+from synthetic import SyntheticDB, generateACPowerData
+from weather_distance_config import weather_distance_config
+
+
+N_SYSTEMS = 4
+
+
+class ChunkedCSVSystemDataSource(CSVSystemDataSource):
+    """
+    Data source streaming small chunks, so each file is read in several.
+    """
+
+    def readEventWindows(self, system_id, weather_events, day_window=14,
+                         frequency='60min'):
+        return readEventWindows(self.path(system_id), weather_events,
+                                day_window=day_window, frequency=frequency,
+                                chunksize=5000)
+
+
+@pytest.fixture(scope="module")
+def linked_fleet(synthetic_fleet, tmp_path_factory):
+    """
+    Linked events of a few systems, and a directory of their AC power
+    files.
+    """
+    system_metadata, weather_events = synthetic_fleet
+    linked = we.SystemLinker(SyntheticDB(weather_events), system_metadata,
+                             weather_distance_config).linkData()
+    system_ids = list(linked['system_id'].drop_duplicates()[:N_SYSTEMS])
+    linked = linked[linked['system_id'].isin(system_ids)].reset_index(
+        drop=True)
+    source_dir = tmp_path_factory.mktemp("systems")
+    for system_id in system_ids:
+        system = system_metadata[
+            system_metadata['system_id'] == system_id].iloc[0]
+        generateACPowerData(
+            pd.to_datetime(system['started_on'], format="%m/%d/%Y %H:%M"),
+            pd.to_datetime(system['ended_on'], format="%m/%d/%Y %H:%M"),
+            freq='30min', seed=int(system_id)).to_csv(
+                os.path.join(source_dir, f"{system_id}.csv"))
+    return system_ids, linked, str(source_dir)
+
+
+def runPipeline(data_source, linked, system_ids, **kwargs):
+    results = list()
+    errors = SystemPipeline(data_source, linked, generate_plots=False,
+                            **kwargs).run(system_ids,
+                                          result_handler=results.append)
+    if len(results) == 0:
+        return pd.DataFrame(), errors
+    key = ['system_id', 'weather_event_id', 'data_stream']
+    return pd.concat(results).sort_values(key).reset_index(drop=True), \
+        errors
+
+
+@pytest.mark.parametrize("analysis_workers", [0, 2])
+def test_streamed_run_matches_full_read(linked_fleet, analysis_workers):
+    system_ids, linked, source_dir = linked_fleet
+    data_source = ChunkedCSVSystemDataSource(source_dir)
+    expected, errors = runPipeline(data_source, linked, system_ids,
+                                   analysis_workers=0)
+    assert errors == []
+    assert sorted(expected['system_id'].unique()) == sorted(system_ids)
+    assert expected['pct_median_output'].notna().any()
+    result, errors = runPipeline(data_source, linked, system_ids,
+                                 analysis_workers=analysis_workers,
+                                 stream_event_windows=True)
+    assert errors == []
+    pd.testing.assert_frame_equal(result, expected)
+
+
+@pytest.mark.filterwarnings("ignore:Could not infer format")
+@pytest.mark.parametrize("analysis_workers", [0, 1])
+def test_failed_systems_are_error_records(linked_fleet, analysis_workers,
+                                          tmp_path):
+    system_ids, linked, source_dir = linked_fleet
+    data_source = CSVSystemDataSource(source_dir)
+    expected, _ = runPipeline(data_source, linked, system_ids[2:],
+                              analysis_workers=0)
+    # One system without a file, and one whose events can't be scored (in
+    # the worker process, if any)
+    linked_store = ResultStore(str(tmp_path / "linked"))
+    for system_id, system_events in linked.groupby('system_id'):
+        if system_id == system_ids[1]:
+            system_events = system_events.assign(
+                weather_event_started_on="not a date")
+        linked_store.write(system_events)
+    result, errors = runPipeline(data_source, linked_store,
+                                 [-1] + system_ids[1:],
+                                 analysis_workers=analysis_workers)
+    errors = sorted(errors, key=lambda x: x['stage'])
+    assert [(x['system_id'], x['stage']) for x in errors] == \
+        [(-1, 'fetch'), (system_ids[1], 'performance')]
+    assert errors[0]['error_type'] == 'FileNotFoundError'
+    assert all(len(x['message']) and 'Traceback' in x['traceback']
+               for x in errors)
+    # The other systems are still scored
+    pd.testing.assert_frame_equal(result, expected, check_categorical=False)
+
+
+def test_performance_csv_is_in_system_order(linked_fleet, tmp_path):
+    system_ids, linked, source_dir = linked_fleet
+    performance_store = ResultStore(str(tmp_path / "performance"))
+    results = list()
+    errors = SystemPipeline(CSVSystemDataSource(source_dir), linked,
+                            analysis_workers=0, generate_plots=False).run(
+                                system_ids, result_handler=results.append)
+    assert errors == []
+    # Systems finishing in reverse order
+    for agg_df in results[::-1]:
+        performance_store.write(agg_df)
+    csv_path = str(tmp_path / "performance.csv")
+    performance_store.toCSV(csv_path, index=True)
+    expected = pd.concat([x.reset_index(drop=True) for x in sorted(
+        results, key=lambda x: x['system_id'].iloc[0])])
+    result = pd.read_csv(csv_path, index_col=0)
+    assert list(result.index) == list(expected.index)
+    assert list(result['system_id']) == list(expected['system_id'])
+    assert list(result['weather_event_id']) == \
+        list(expected['weather_event_id'])
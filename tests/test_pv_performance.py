@@ -0,0 +1,126 @@
+"""
+Check scoreEventPerformance against the original examinePVPerformance loop,
+and pin its monthly median (the median of daily sums) where the two
+differ.
+"""
+
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+import pytest
+from pv_performance import DailyEnergyTable, scoreEventPerformance
+
+
+def baselineExaminePVPerformance(system_ac_power_data, weather_events):
+    """
+    The original examinePVPerformance, run one stream at a time (it failed
+    on a second stream) and interleaved back to (event, stream) order.
+    """
+    frames = list()
+    for column in system_ac_power_data.columns:
+        ac_power_stream = system_ac_power_data[column]
+        rows = list()
+        for _, row in weather_events.iterrows():
+            extreme_weather_date = pd.to_datetime(
+                row['weather_event_started_on']).date()
+            sum_daily_production = ac_power_stream[
+                (ac_power_stream.index.date >= extreme_weather_date) &
+                (ac_power_stream.index.date <=
+                 (extreme_weather_date + timedelta(days=1)))].sum()
+            month_performance = ac_power_stream[
+                ac_power_stream.index.month == extreme_weather_date.month]
+            month_performance_median = month_performance.groupby(
+                month_performance.index.date).transform("sum").median()
+            row = row.to_dict()
+            row['data_stream'] = column
+            with np.errstate(invalid='ignore'):
+                row['pct_median_output'] = \
+                    sum_daily_production / month_performance_median
+            rows.append(row)
+        frames.append(pd.DataFrame(rows))
+    return pd.concat(frames).sort_index(kind='stable').reset_index(
+        drop=True)
+
+
+def syntheticSystem(seed=0):
+    # Every timestamp present (NaN where the logger dropped out), so every
+    # day has the same number of samples
+    rng = np.random.default_rng(seed)
+    index = pd.date_range("2018-01-01", "2019-12-31 23:45", freq="15min")
+    solar = np.clip(np.sin((index.hour + index.minute / 60 - 6) / 12 *
+                           np.pi), 0, None)
+    data = pd.DataFrame({
+        'ac_power_a': solar * rng.uniform(0.5, 1.0, len(index)) * 5,
+        'ac_power_b': solar * rng.uniform(0.2, 1.0, len(index)) * 3},
+        index=index)
+    data.iloc[5000:9000, 1] = np.nan
+    return data
+
+
+def syntheticEvents(started_on):
+    return pd.DataFrame({
+        'weather_event_id': np.arange(len(started_on)) + 100,
+        'event_type': 'Hail',
+        'weather_event_started_on': pd.to_datetime(started_on, utc=True)})
+
+
+def test_matches_the_original_loop():
+    system_ac_power_data = syntheticSystem()
+    weather_events = syntheticEvents(
+        ["2018-02-03 10:00", "2018-03-01 23:30", "2018-06-30 12:00",
+         "2019-01-15 06:00", "2019-12-31 18:00", "2017-05-01 12:00"])
+    result = scoreEventPerformance(system_ac_power_data, weather_events)
+    expected = baselineExaminePVPerformance(system_ac_power_data,
+                                            weather_events)
+    assert list(result.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False,
+                                  rtol=1e-12)
+
+
+def test_pinned_scores():
+    # Hourly data for June 2020: stream 'a' makes 1 kWh every hour, stream
+    # 'b' makes d kWh spread over day d
+    index = pd.date_range("2020-06-01", "2020-06-30 23:00", freq="h")
+    system_ac_power_data = pd.DataFrame(
+        {'a': 1.0, 'b': index.day / 24.0}, index=index)
+    weather_events = syntheticEvents(["2020-06-10 15:00", "2020-06-30 01:00",
+                                      "2020-05-31 12:00"])
+    result = scoreEventPerformance(system_ac_power_data, weather_events)
+    assert list(result['data_stream']) == ['a', 'b'] * 3
+    # June 10-11 against the median June day (24 kWh, and 15.5 kWh for the
+    # days 1-30); June 30-July 1 only has June 30; May has no data
+    expected = [48 / 24, 21 / 15.5, 24 / 24, 30 / 15.5, np.nan, np.nan]
+    np.testing.assert_allclose(result['pct_median_output'], expected)
+
+
+def test_median_of_daily_sums_with_partial_days():
+    # Days 1-18 only have their morning hours: the median is now taken
+    # over days (18 days of 12 kWh, 12 of 24 kWh), where the original
+    # took it over samples and weighted the full days double
+    index = pd.date_range("2020-06-01", "2020-06-30 23:00", freq="h")
+    index = index[(index.day > 18) | (index.hour < 12)]
+    system_ac_power_data = pd.DataFrame({'a': 1.0}, index=index)
+    weather_events = syntheticEvents(["2020-06-25 12:00"])
+    result = scoreEventPerformance(system_ac_power_data, weather_events)
+    assert DailyEnergyTable(system_ac_power_data).monthMedian([6])[0, 0] \
+        == 12
+    assert result['pct_median_output'].iloc[0] == pytest.approx(48 / 12)
+    expected = baselineExaminePVPerformance(system_ac_power_data,
+                                            weather_events)
+    assert expected['pct_median_output'].iloc[0] == pytest.approx(48 / 24)
+
+
+def test_no_events():
+    result = scoreEventPerformance(syntheticSystem(), syntheticEvents([]))
+    assert len(result) == 0
+
+
+def test_all_nan_stream():
+    system_ac_power_data = syntheticSystem().assign(ac_power_b=np.nan)
+    weather_events = syntheticEvents(["2018-06-30 12:00"])
+    result = scoreEventPerformance(system_ac_power_data, weather_events)
+    expected = baselineExaminePVPerformance(system_ac_power_data,
+                                            weather_events)
+    # No production and a zero median: no score
+    assert np.isnan(result['pct_median_output'].iloc[1])
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
@@ -0,0 +1,92 @@
+"""
+Check ShardedLinkJob against a single-process linkData() run, including
+failed tiles and tiles abandoned by a killed worker.
+"""
+
+import os
+import time
+import pandas as pd
+import pytest
+import weather_event_system_linker as we
+from results_io import ResultStore
+from sharded_linking import ShardedLinkJob
+from synthetic import SyntheticDB
+from weather_distance_config import weather_distance_config
+
+
+@pytest.fixture(scope="module")
+def expected(synthetic_fleet):
+    system_metadata, weather_events = synthetic_fleet
+    return we.SystemLinker(SyntheticDB(weather_events), system_metadata,
+                           weather_distance_config).linkData()
+
+
+def prepareJob(synthetic_fleet, work_dir, **kwargs):
+    system_metadata, weather_events = synthetic_fleet
+    link_job = ShardedLinkJob(str(work_dir))
+    link_job.prepare(SyntheticDB(weather_events), system_metadata,
+                     weather_distance_config, tile_size_deg=4, **kwargs)
+    return link_job
+
+
+@pytest.mark.parametrize("n_workers", [0, 2])
+def test_sharded_matches_full_run(synthetic_fleet, expected, tmp_path,
+                                  n_workers):
+    link_job = prepareJob(synthetic_fleet, tmp_path / "job")
+    # Several tiles, so events are linked across tile boundaries
+    assert len(link_job.readJob()['tiles']) > 2
+    assert link_job.run(n_workers) == []
+    assert len(expected)
+    pd.testing.assert_frame_equal(link_job.readResults(), expected)
+    # The store holds the same rows, by system
+    linked_store = ResultStore(str(tmp_path / "linked"))
+    link_job.writeResults(linked_store)
+    key = ['system_id', 'weather_event_id']
+    pd.testing.assert_frame_equal(
+        linked_store.read().sort_values(key).reset_index(drop=True),
+        expected.sort_values(key).reset_index(drop=True),
+        check_dtype=False, check_categorical=False)
+
+
+def test_failed_tile_is_retried(synthetic_fleet, expected, tmp_path,
+                                monkeypatch):
+    link_job = prepareJob(synthetic_fleet, tmp_path / "job")
+    failing_tile = link_job.readJob()['tiles'][0]['tile_id']
+    linkTile = ShardedLinkJob.linkTile
+
+    def failingLinkTile(self, tile_id, **kwargs):
+        if tile_id == failing_tile:
+            raise RuntimeError("Tile failed")
+        return linkTile(self, tile_id, **kwargs)
+
+    monkeypatch.setattr(ShardedLinkJob, 'linkTile', failingLinkTile)
+    errors = link_job.run(0)
+    assert [x['tile_id'] for x in errors] == [failing_tile]
+    assert link_job.pendingTiles() == [failing_tile]
+    with pytest.raises(ValueError):
+        link_job.readResults()
+    # A failed tile is not picked up again until it is released
+    monkeypatch.setattr(ShardedLinkJob, 'linkTile', linkTile)
+    assert link_job.runWorker() == 0
+    assert link_job.retryFailed() == [failing_tile]
+    assert link_job.run(0) == []
+    pd.testing.assert_frame_equal(link_job.readResults(), expected)
+
+
+def test_abandoned_tile_is_taken_over(synthetic_fleet, expected, tmp_path):
+    link_job = prepareJob(synthetic_fleet, tmp_path / "job",
+                          lease_timeout=60)
+    tiles = [x['tile_id'] for x in link_job.readJob()['tiles']]
+    # A worker killed while linking the first tile, and a live worker
+    # linking the second one
+    abandoned_lock = link_job._claim(tiles[0], "killed-worker", 60)
+    os.utime(abandoned_lock, (time.time() - 120, time.time() - 120))
+    link_job._claim(tiles[1], "live-worker", 60)
+    assert link_job.runWorker() == len(tiles) - 1
+    assert link_job.pendingTiles() == [tiles[1]]
+    # The live worker's lease runs out too
+    for _, lock_path in link_job._locks(tiles[1]):
+        os.utime(lock_path, (time.time() - 120, time.time() - 120))
+    assert link_job.runWorker() == 1
+    assert len(link_job._locks(tiles[1])) == 2
+    pd.testing.assert_frame_equal(link_job.readResults(), expected)
@@ -0,0 +1,189 @@
+"""
+Check the grid spatial join against a brute-force comparison of every
+system with every event, including points near the dateline and the poles,
+and pin the links the old lat/lon box scan missed.
+"""
+
+import numpy as np
+import pandas as pd
+import geopy.distance
+import pytest
+import weather_event_system_linker as we
+from spatial_join import EventSpatialIndex, haversineDistance, spatialJoin
+from synthetic import (SyntheticDB, generateSystemMetadata,
+                       generateWeatherEvents)
+from weather_distance_config import weather_distance_config
+
+
+def randomPoints(rng, n, region):
+    if region == "dateline":
+        latitude = rng.uniform(-70, 70, n)
+        longitude = rng.uniform(177, 183, n)
+        longitude = np.where(longitude > 180, longitude - 360, longitude)
+    elif region == "poles":
+        latitude = rng.choice([-1, 1], n) * rng.uniform(85, 90, n)
+        longitude = rng.uniform(-180, 180, n)
+    else:
+        latitude = rng.uniform(-60, 60, n)
+        longitude = rng.uniform(-180, 180, n)
+    return latitude, longitude
+
+
+def nearbyPoints(rng, latitude, longitude, distance):
+    """
+    Points at the given geodesic distances (km) from random origins, in
+    random directions.
+    """
+    origin = rng.integers(0, len(latitude), len(distance))
+    points = [geopy.distance.geodesic(kilometers=x).destination(
+        (latitude[y], longitude[y]), bearing=rng.uniform(0, 360))
+        for x, y in zip(distance, origin)]
+    return (np.array([x.latitude for x in points]),
+            np.array([x.longitude for x in points]))
+
+
+def randomEvents(rng, system_latitude, system_longitude, n, region):
+    """
+    Events scattered over the region, plus events placed (by geodesic)
+    close to the distance thresholds of random systems.
+    """
+    latitude, longitude = randomPoints(rng, n, region)
+    near = np.flatnonzero(rng.random(n) < 0.5)
+    thresholds = np.array(sorted(set(weather_distance_config.values())))
+    latitude[near], longitude[near] = nearbyPoints(
+        rng, system_latitude, system_longitude,
+        rng.choice(thresholds, len(near)) * rng.uniform(0.97, 1.03,
+                                                        len(near)))
+    end_latitude = np.clip(latitude + rng.normal(0, 0.2, n), -90, 90)
+    end_longitude = (longitude + rng.normal(0, 0.2, n) + 180) % 360 - 180
+    # Some events only have one of their points
+    end_latitude[rng.random(n) < 0.1] = np.nan
+    latitude[rng.random(n) < 0.05] = np.nan
+    return pd.DataFrame({
+        'event_type': rng.choice(list(weather_distance_config), n),
+        'begin_latitude': latitude, 'begin_longitude': longitude,
+        'end_latitude': end_latitude, 'end_longitude': end_longitude})
+
+
+def bruteForcePairs(system_metadata, weather_df, geodesic_refinement,
+                    refinement_tolerance=0.01):
+    """
+    Distances of every (system, event) pair, refined and filtered like
+    spatialJoin, without any index.
+    """
+    max_distance = max(weather_distance_config.values())
+    system_position, event_position = [x.ravel() for x in np.meshgrid(
+        np.arange(len(system_metadata)), np.arange(len(weather_df)),
+        indexing='ij')]
+    sys_lat = system_metadata['latitude'].values[system_position]
+    sys_lon = system_metadata['longitude'].values[system_position]
+    events = weather_df.iloc[event_position]
+    start_distance = haversineDistance(sys_lat, sys_lon,
+                                       events['begin_latitude'].values,
+                                       events['begin_longitude'].values)
+    end_distance = haversineDistance(sys_lat, sys_lon,
+                                     events['end_latitude'].values,
+                                     events['end_longitude'].values)
+    if geodesic_refinement:
+        type_distance = events['event_type'].map(
+            weather_distance_config).values
+        min_distance = np.fmin(start_distance, end_distance)
+        refine = np.flatnonzero(
+            (np.abs(min_distance - type_distance) <=
+             refinement_tolerance * type_distance) |
+            (np.abs(min_distance - max_distance) <=
+             refinement_tolerance * max_distance))
+        for distance, prefix in [(start_distance, 'begin'),
+                                 (end_distance, 'end')]:
+            for idx in refine:
+                if not np.isnan(distance[idx]):
+                    distance[idx] = geopy.distance.geodesic(
+                        (sys_lat[idx], sys_lon[idx]),
+                        (events[prefix + '_latitude'].values[idx],
+                         events[prefix + '_longitude'].values[idx])).km
+    pairs = pd.DataFrame({
+        'system_position': system_position,
+        'event_position': event_position,
+        'distance_to_weather_event_start_km': start_distance,
+        'distance_to_weather_event_end_km': end_distance,
+        'min_distance_to_weather_event_km': np.fmin(start_distance,
+                                                    end_distance)})
+    return pairs[pairs['min_distance_to_weather_event_km'] <=
+                 max_distance].reset_index(drop=True)
+
+
+@pytest.mark.parametrize("region", ["anywhere", "dateline", "poles"])
+@pytest.mark.parametrize("geodesic_refinement", [False, True])
+def test_spatial_join_matches_brute_force(region, geodesic_refinement):
+    rng = np.random.default_rng(["anywhere", "dateline", "poles"].index(
+        region))
+    latitude, longitude = randomPoints(rng, 60, region)
+    latitude[0] = np.nan
+    system_metadata = pd.DataFrame({'latitude': latitude,
+                                    'longitude': longitude})
+    weather_df = randomEvents(rng, latitude[1:], longitude[1:], 800, region)
+    result = spatialJoin(system_metadata, weather_df,
+                         weather_distance_config,
+                         geodesic_refinement=geodesic_refinement)
+    expected = bruteForcePairs(system_metadata, weather_df,
+                               geodesic_refinement)
+    assert len(expected)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("region", ["anywhere", "dateline", "poles"])
+@pytest.mark.parametrize("radius_km", [5, 150, 2500])
+def test_index_candidates_cover_the_radius(region, radius_km):
+    rng = np.random.default_rng(radius_km)
+    latitude, longitude = randomPoints(rng, 40, region)
+    event_latitude, event_longitude = randomPoints(rng, 2000, region)
+    event_latitude[:1000], event_longitude[:1000] = nearbyPoints(
+        rng, latitude, longitude, rng.uniform(0.8, 1.2, 1000) * radius_km)
+    index = EventSpatialIndex(event_latitude, event_longitude,
+                              event_latitude, event_longitude, radius_km)
+    query_position, event_position = index.query(latitude, longitude)
+    candidates = set(zip(query_position, event_position))
+    distance = haversineDistance(latitude[:, None], longitude[:, None],
+                                 event_latitude[None, :],
+                                 event_longitude[None, :])
+    within = set(zip(*np.nonzero(distance <= radius_km)))
+    assert len(within)
+    assert within <= candidates
+
+
+def test_links_east_and_west_of_the_old_box(tmp_path):
+    # The old scan used a box of +/- 150 / 111 degrees in longitude too,
+    # which at 45 degrees north only reaches ~106 km east and west
+    system_metadata = generateSystemMetadata(1, seed=0).assign(
+        latitude=45.0, longitude=-100.0, started_on="1/1/2020 0:00",
+        ended_on="12/31/2020 23:00")
+    offsets = [('Hurricane', 0.5, 0.0),
+               ('Hurricane', 0.0, 1.6),
+               ('Tropical Storm', 0.0, -1.8),
+               ('Hurricane', 0.0, 2.2),
+               ('Tornado', 0.5, 0.0)]
+    weather_events = generateWeatherEvents(len(offsets), seed=0)
+    # A month apart, so no events merge into storms
+    start = pd.Timestamp("2020-02-01 12:00", tz="UTC") + pd.to_timedelta(
+        30 * np.arange(len(offsets)), unit="D")
+    weather_events = weather_events.assign(
+        event_type=[x[0] for x in offsets],
+        begin_latitude=[45.0 + x[1] for x in offsets],
+        begin_longitude=[-100.0 + x[2] for x in offsets],
+        start_timestamp=start, end_timestamp=start + pd.Timedelta(hours=3))
+    weather_events['end_latitude'] = weather_events['begin_latitude']
+    weather_events['end_longitude'] = weather_events['begin_longitude']
+    linked = we.SystemLinker(SyntheticDB(weather_events), system_metadata,
+                             weather_distance_config).linkData()
+    event_ids = weather_events['weather_event_id'].values
+    # North within range, and east/west within range but outside the old
+    # box; too far east, and a Tornado beyond its own 5 km, are not linked
+    assert sorted(linked['weather_event_id']) == list(event_ids[:3])
+    old_box_deg = max(weather_distance_config.values()) / 111
+    assert all(abs(x[2]) >= old_box_deg for x in offsets[1:3])
+    # Great-circle distances, within 0.6% of the geodesic
+    for _, row in linked.iterrows():
+        assert row['min_distance_to_weather_event_km'] == pytest.approx(
+            geopy.distance.geodesic(
+                (45.0, -100.0), (row['begin_latitude'],
+                                 row['begin_longitude'])).km, rel=0.006)
@@ -0,0 +1,113 @@
+"""
+Check AsyncFileFetcher against a local directory and a moto S3 stand-in:
+unchanged files come from the cache, changed files are downloaded again,
+and missing files fail without retries.
+"""
+
+import os
+import socket
+import pytest
+from system_data_fetch import AsyncFileFetcher
+
+
+class LocalRemote():
+    """
+    Local directory standing in for the bucket.
+    """
+
+    def __init__(self, path):
+        self.base_path = str(path)
+        self.storage_options = None
+        os.makedirs(self.base_path, exist_ok=True)
+        self.n_writes = 0
+
+    def write(self, name, data):
+        path = os.path.join(self.base_path, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        # Versions are size and mtime, which a quick rewrite can leave
+        # unchanged
+        self.n_writes += 1
+        os.utime(path, (self.n_writes, self.n_writes))
+
+
+class MotoRemote():
+    """
+    Bucket on a moto server.
+    """
+
+    def __init__(self, endpoint_url):
+        import boto3
+        self.base_path = "s3://fetch-test"
+        self.storage_options = {"key": "testing", "secret": "testing",
+                                "client_kwargs": {
+                                    "endpoint_url": endpoint_url,
+                                    "region_name": "us-east-1"}}
+        self.client = boto3.client(
+            "s3", endpoint_url=endpoint_url, region_name="us-east-1",
+            aws_access_key_id="testing", aws_secret_access_key="testing")
+        self.client.create_bucket(Bucket="fetch-test")
+
+    def write(self, name, data):
+        self.client.put_object(Bucket="fetch-test", Key=name, Body=data)
+
+
+@pytest.fixture(scope="module")
+def moto_endpoint():
+    server_module = pytest.importorskip("moto.server")
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = server_module.ThreadedMotoServer(ip_address="127.0.0.1",
+                                              port=port)
+    server.start()
+    yield f"http://127.0.0.1:{port}"
+    server.stop()
+
+
+@pytest.fixture(params=["local", "moto"])
+def remote(request, tmp_path):
+    if request.param == "local":
+        return LocalRemote(tmp_path / "remote")
+    return MotoRemote(request.getfixturevalue("moto_endpoint"))
+
+
+def test_fetch_uses_the_etag_cache(remote, tmp_path):
+    remote.write("1.csv", b"a,b\n1,2\n")
+    remote.write("2.csv", b"a,b\n3,4\n")
+    with AsyncFileFetcher(remote.base_path, remote.storage_options,
+                          cache_dir=str(tmp_path / "cache")) as fetcher:
+        fetcher.prefetch(["1.csv", "2.csv"])
+        for name in ["1.csv", "2.csv"]:
+            with open(fetcher.get(name), 'rb') as f:
+                assert f.read().startswith(b"a,b\n")
+        assert fetcher.stats['downloaded'] == 2
+        # Fetches are forgotten once handed out
+        assert fetcher.fetches == dict()
+        # Unchanged: served from the cache
+        fetcher.get("1.csv")
+        assert fetcher.stats['downloaded'] == 2
+        assert fetcher.stats['cached'] == 1
+        # Changed: downloaded again
+        remote.write("1.csv", b"a,b\n5,6\n7,8\n")
+        with open(fetcher.get("1.csv"), 'rb') as f:
+            assert f.read() == b"a,b\n5,6\n7,8\n"
+        assert fetcher.stats['downloaded'] == 3
+    # A new fetcher reuses the cached files
+    with AsyncFileFetcher(remote.base_path, remote.storage_options,
+                          cache_dir=str(tmp_path / "cache")) as fetcher:
+        fetcher.get("1.csv")
+        fetcher.get("2.csv")
+        assert fetcher.stats == {'downloaded': 0, 'cached': 2, 'retried': 0}
+
+
+def test_missing_file_is_an_error(remote, tmp_path):
+    remote.write("1.csv", b"a,b\n1,2\n")
+    with AsyncFileFetcher(remote.base_path, remote.storage_options,
+                          cache_dir=str(tmp_path / "cache"),
+                          backoff=0.01) as fetcher:
+        with pytest.raises(FileNotFoundError):
+            fetcher.get("missing.csv")
+        assert fetcher.stats['retried'] == 0
+        assert not os.path.exists(fetcher.localPath("missing.csv"))
+        assert fetcher.fetches == dict()
@@ -0,0 +1,121 @@
+"""
+Check EventTimeIndex against the per-row date comparisons it replaced:
+
+weather_sub[(pd.to_datetime(weather_sub['start_timestamp']).dt.date >=
+             started_on) &
+            (pd.to_datetime(weather_sub['end_timestamp']).dt.date <=
+             ended_on)]
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from temporal_index import EventTimeIndex, normalizeWeatherTimestamps
+
+
+def randomEvents(rng, n):
+    start = pd.Timestamp("2015-01-01", tz="UTC") + pd.to_timedelta(
+        rng.integers(0, 3 * 365 * 24 * 60, n), unit="min")
+    duration = pd.to_timedelta(rng.choice([0, 30, 600, 2880, 8640], n),
+                               unit="min")
+    weather_df = pd.DataFrame({'weather_event_id': np.arange(n),
+                               'start_timestamp': start,
+                               'end_timestamp': start + duration})
+    # Missing timestamps never match
+    weather_df.loc[rng.random(n) < 0.02, 'end_timestamp'] = pd.NaT
+    return normalizeWeatherTimestamps(weather_df).reset_index(drop=True)
+
+
+def randomPeriods(rng, n):
+    started_on = pd.Timestamp("2014-06-01") + pd.to_timedelta(
+        rng.integers(0, 3 * 365 * 24 * 60, n), unit="min")
+    ended_on = started_on + pd.to_timedelta(
+        rng.integers(-30, 400, n), unit="D")
+    started_on = pd.Series(started_on)
+    started_on[rng.random(n) < 0.05] = pd.NaT
+    return started_on, pd.Series(ended_on)
+
+
+def baselineMask(weather_df, started_on, ended_on, check_end=True):
+    # The data period row of the original per-system loop
+    if pd.isna(started_on) or pd.isna(ended_on):
+        return np.zeros(len(weather_df), dtype=bool)
+    mask = pd.to_datetime(weather_df['start_timestamp']).dt.date >= \
+        started_on.date()
+    if check_end:
+        mask &= pd.to_datetime(weather_df['end_timestamp']).dt.date <= \
+            ended_on.date()
+    else:
+        mask &= pd.to_datetime(weather_df['start_timestamp']).dt.date <= \
+            ended_on.date()
+    return mask.values
+
+
+@pytest.fixture(params=range(3))
+def events_and_periods(request):
+    rng = np.random.default_rng(request.param)
+    weather_df = randomEvents(rng, 3000)
+    started_on, ended_on = randomPeriods(rng, 40)
+    index = EventTimeIndex(weather_df['start_timestamp'],
+                           weather_df['end_timestamp'])
+    return index, weather_df, started_on, ended_on
+
+
+def test_window_matches_start_dates(events_and_periods):
+    index, weather_df, started_on, ended_on = events_and_periods
+    lower, upper = index.window(started_on.values, ended_on.values)
+    for system in range(len(started_on)):
+        positions = np.arange(lower[system], max(upper[system],
+                                                 lower[system]))
+        expected = np.flatnonzero(baselineMask(
+            weather_df, started_on[system], ended_on[system],
+            check_end=False))
+        np.testing.assert_array_equal(positions, expected)
+
+
+def test_contains_matches_date_filter(events_and_periods):
+    index, weather_df, started_on, ended_on = events_and_periods
+    for system in range(len(started_on)):
+        positions = np.arange(len(weather_df))
+        mask = index.contains(positions,
+                              np.repeat(started_on.values[system],
+                                        len(positions)),
+                              np.repeat(ended_on.values[system],
+                                        len(positions)))
+        np.testing.assert_array_equal(mask, baselineMask(
+            weather_df, started_on[system], ended_on[system]))
+
+
+def test_starts_within_any_period(events_and_periods):
+    index, weather_df, started_on, ended_on = events_and_periods
+    expected = np.zeros(len(weather_df), dtype=bool)
+    for system in range(len(started_on)):
+        expected |= baselineMask(weather_df, started_on[system],
+                                 ended_on[system], check_end=False)
+    starting_positions = index.startsWithin(started_on.values,
+                                            ended_on.values)
+    np.testing.assert_array_equal(starting_positions,
+                                  np.flatnonzero(expected))
+    # The events matching a period are all among them
+    for system in range(len(started_on)):
+        assert set(np.flatnonzero(baselineMask(
+            weather_df, started_on[system], ended_on[system]))) <= set(
+                starting_positions)
+
+
+def test_starts_within_no_periods():
+    rng = np.random.default_rng(0)
+    weather_df = randomEvents(rng, 100)
+    index = EventTimeIndex(weather_df['start_timestamp'],
+                           weather_df['end_timestamp'])
+    assert len(index.startsWithin([], [])) == 0
+    assert len(index.startsWithin([pd.NaT], [pd.Timestamp("2016-01-01")])) \
+        == 0
+
+
+def test_unsorted_events_are_rejected():
+    with pytest.raises(ValueError):
+        EventTimeIndex(pd.to_datetime(["2020-01-02", "2020-01-01"],
+                                      utc=True),
+                       pd.to_datetime(["2020-01-02", "2020-01-01"],
+                                      utc=True))
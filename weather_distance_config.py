@@ -0,0 +1,48 @@
+"""
+Max distance from a system for each weather event type to be linked to it.
+"""
+
+# Distances are in KM!!!
+weather_distance_config = {'Flood': 30,
+                            'Coastal Flood': 30,
+                            'Flash Flood': 30,
+                            'Heavy Rain': 10,
+                            'Waterspout': 10,
+                            'Tornado': 5,
+                            'Thunderstorm Wind': 20,
+                            'Marine Thunderstorm Wind': 20,
+                            'Marine Strong Wind': 20,
+                            'High Wind': 20,
+                            'Strong Wind': 20,
+                            'Dust Devil': 10,
+                            'Marine High Wind': 20,
+                            'Funnel Cloud': 10,
+                            'Marine Hail': 10,
+                            'Hail': 10,
+                            "Sleet": 10,
+                            'Lightning': 10,
+                            'Marine Lightning': 10,
+                            'Debris Flow': 10,
+                            'Wildfire': 50,
+                            "Volcanic Ash": 10,
+                            "Dense Smoke": 50,
+                            'Heat': 50,
+                            'Excessive Heat': 50,
+                            "Extreme Cold/Wind Chill": 30,
+                            'Lake-Effect Snow': 30,
+                            'Winter Storm': 30,
+                            'Winter Weather': 30,
+                            "Ice Storm": 30,
+                            "Cold/Wind Chill": 30,
+                            "Blizzard": 30,
+                            'Heavy Snow': 30,
+                            "Frost/Freeze": 30,
+                            "Hurricane": 150,
+                            "Marine Hurricane/Typhoon": 150,
+                            "Hurricane (Typhoon)": 150,
+                            "Tropical Depression": 150,
+                            "Marine Tropical Storm": 150,
+                            "Marine Tropical Depression": 150,
+                            'Tropical Storm': 150,
+                            "Tsunami": 10,
+                           }
@@ -0,0 +1,456 @@
+"""
+Local columnar cache of the PVDRDB weather_events table, with incremental
+refresh.
+"""
+
+import os
+import sys
+import json
+import glob
+from urllib.parse import quote
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+
+# Columns of pvdrdb.weather_events used for linking and in the outputs
+WEATHER_EVENT_COLUMNS = ['weather_event_id', 'state', 'location',
+                         'event_type', 'begin_latitude', 'begin_longitude',
+                         'end_latitude', 'end_longitude', 'start_timestamp',
+                         'end_timestamp', 'magnitude', 'magnitude_type',
+                         'damage_property', 'damage_crops',
+                         'episode_narrative', 'comments']
+# Repeated strings, held as categoricals in the working event table
+CATEGORICAL_COLUMNS = ['state', 'location', 'event_type', 'magnitude_type']
+# Held as float64 arrays in the working event table
+COORDINATE_COLUMNS = ['begin_latitude', 'begin_longitude', 'end_latitude',
+                      'end_longitude']
+# Free text, only needed in the final output, so kept in a side table
+NARRATIVE_COLUMNS = ['episode_narrative', 'comments']
+
+
+def _placeholder(connection):
+    """
+    Get the query parameter placeholder for a DB-API connection ('%s' for
+    psycopg2, '?' for sqlite3).
+    """
+    module = sys.modules.get(type(connection).__module__.split('.')[0])
+    paramstyle = getattr(module, 'paramstyle', 'pyformat')
+    return '?' if paramstyle == 'qmark' else '%s'
+
+
+def buildWeatherEventQuery(event_types, columns=WEATHER_EVENT_COLUMNS,
+                           table="pvdrdb.weather_events",
+                           since_weather_event_id=None, placeholder='%s'):
+    """
+    Build the SQL query for weather events, with the event type filter and
+    the column list pushed into the query.
+
+    Parameters
+    ----------
+    event_types: list
+        Event types to pull.
+    columns: list, default WEATHER_EVENT_COLUMNS
+        Columns to pull.
+    table: str, default "pvdrdb.weather_events"
+        Weather events table.
+    since_weather_event_id: int, default None
+        If set, only pull events with a greater weather_event_id.
+    placeholder: str, default '%s'
+        Query parameter placeholder for the DB driver.
+
+    Returns
+    -------
+    sql: str
+        SQL query.
+    params: list
+        Query parameters.
+    """
+    params = list(event_types)
+    sql = (f"select {', '.join(columns)} from {table} where event_type in "
+           f"({', '.join([placeholder] * len(params))})")
+    if since_weather_event_id is not None:
+        sql += f" and weather_event_id > {placeholder}"
+        params.append(int(since_weather_event_id))
+    sql += " order by weather_event_id"
+    return sql, params
+
+
+def streamWeatherEvents(db, event_types, columns=WEATHER_EVENT_COLUMNS,
+                        table="pvdrdb.weather_events",
+                        since_weather_event_id=None, chunk_size=50000):
+    """
+    Stream weather events from the database in chunks.
+
+    A server-side (named) cursor is used when the driver supports one
+    (psycopg2), so the full result set is never held in memory at once.
+    Other drivers fall back to the db object's cursor with fetchmany().
+
+    Parameters
+    ----------
+    db: object
+        Database object with 'dbconn' (DB-API connection) and 'dbops'
+        (cursor) attributes.
+    event_types: list
+        Event types to pull.
+    columns: list, default WEATHER_EVENT_COLUMNS
+        Columns to pull.
+    table: str, default "pvdrdb.weather_events"
+        Weather events table.
+    since_weather_event_id: int, default None
+        If set, only pull events with a greater weather_event_id.
+    chunk_size: int, default 50000
+        Number of rows per chunk.
+
+    Yields
+    ------
+    chunk: Pandas DataFrame
+        Up to chunk_size weather events.
+    """
+    sql, params = buildWeatherEventQuery(
+        event_types, columns=columns, table=table,
+        since_weather_event_id=since_weather_event_id,
+        placeholder=_placeholder(db.dbconn))
+    try:
+        cursor = db.dbconn.cursor(name="weather_event_stream")
+        cursor.itersize = chunk_size
+        server_side = True
+    except TypeError:
+        cursor = db.dbops
+        server_side = False
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield pd.DataFrame(rows, columns=list(columns))
+    finally:
+        if server_side:
+            cursor.close()
+        db.dbconn.commit()
+
+
+def iterWeatherEventChunks(db, event_types, cache_dir=None):
+    """
+    Iterate over the weather events of the given types in chunks, from the
+    local cache (see WeatherEventStore) if cache_dir is set, else straight
+    from the database.
+
+    Parameters
+    ----------
+    db: object
+        Database object with 'dbconn' and 'dbops' attributes.
+    event_types: list
+        Event types to pull.
+    cache_dir: str, default None
+        Weather event cache directory. None queries the database.
+
+    Yields
+    ------
+    chunk: Pandas DataFrame
+        Weather events.
+    """
+    if cache_dir is not None:
+        store = WeatherEventStore(db, event_types, cache_dir=cache_dir)
+        yield from store.iterChunks(refresh=True)
+    else:
+        yield from streamWeatherEvents(db, event_types)
+
+
+def compactWeatherEvents(weather_df):
+    """
+    Split a weather event frame into a compact working table and a side
+    table of the details only needed in the output.
+
+    Parameters
+    ----------
+    weather_df: Pandas DataFrame
+        Weather events, as pulled from the database.
+
+    Returns
+    -------
+    weather_df: Pandas DataFrame
+        Weather events without the NARRATIVE_COLUMNS, with the
+        CATEGORICAL_COLUMNS as categoricals and the COORDINATE_COLUMNS as
+        float64.
+    details: Pandas DataFrame
+        The NARRATIVE_COLUMNS, indexed by weather_event_id.
+    """
+    narrative_columns = [x for x in NARRATIVE_COLUMNS
+                         if x in weather_df.columns]
+    details = weather_df[narrative_columns].set_index(
+        weather_df['weather_event_id'].values)
+    details.index.name = 'weather_event_id'
+    weather_df = weather_df.drop(columns=narrative_columns)
+    for column in CATEGORICAL_COLUMNS:
+        if column in weather_df.columns:
+            weather_df[column] = weather_df[column].astype('category')
+    for column in COORDINATE_COLUMNS:
+        if column in weather_df.columns:
+            weather_df[column] = pd.to_numeric(
+                weather_df[column]).to_numpy(dtype=np.float64)
+    return weather_df, details
+
+
+def concatCompactEvents(chunks, columns=WEATHER_EVENT_COLUMNS):
+    """
+    Compact weather event chunks one at a time (see compactWeatherEvents)
+    and concatenate them, so the full table is never held with object
+    columns.
+
+    Parameters
+    ----------
+    chunks: iterable of Pandas DataFrame
+        Weather event chunks, e.g. from streamWeatherEvents().
+    columns: list, default WEATHER_EVENT_COLUMNS
+        Columns of the chunks, used when there are none.
+
+    Returns
+    -------
+    weather_df: Pandas DataFrame
+        Compact weather events.
+    details: Pandas DataFrame
+        Narratives, indexed by weather_event_id.
+    """
+    compact_chunks = list()
+    detail_chunks = list()
+    for chunk in chunks:
+        compact_chunk, details = compactWeatherEvents(chunk)
+        compact_chunks.append(compact_chunk)
+        detail_chunks.append(details)
+    if len(compact_chunks) == 0:
+        return compactWeatherEvents(pd.DataFrame(columns=columns))
+    categoricals = {
+        column: union_categoricals([x[column] for x in compact_chunks],
+                                   ignore_order=True)
+        for column in CATEGORICAL_COLUMNS
+        if column in compact_chunks[0].columns}
+    weather_df = pd.concat(
+        [x.drop(columns=list(categoricals)) for x in compact_chunks],
+        ignore_index=True)
+    for column, values in categoricals.items():
+        weather_df[column] = values
+    weather_df = weather_df[list(compact_chunks[0].columns)]
+    return weather_df, pd.concat(detail_chunks)
+
+
+def joinEventDetails(weather_events, details):
+    """
+    Join the event narratives back onto weather events by
+    weather_event_id, after the 'damage_crops' column (the position they
+    have in the weather_events table).
+
+    Parameters
+    ----------
+    weather_events: Pandas DataFrame
+        Weather events containing a 'weather_event_id' column.
+    details: Pandas DataFrame
+        Narratives, indexed by weather_event_id.
+
+    Returns
+    -------
+    weather_events: Pandas DataFrame
+        Copy of the weather events with the narrative columns.
+    """
+    weather_events = weather_events.copy()
+    narrative_columns = [x for x in NARRATIVE_COLUMNS if x in details.columns]
+    joined = details.loc[~details.index.duplicated(),
+                         narrative_columns].reindex(
+        weather_events['weather_event_id'].values)
+    if 'damage_crops' in weather_events.columns:
+        insert_at = weather_events.columns.get_loc('damage_crops') + 1
+    else:
+        insert_at = len(weather_events.columns)
+    for offset, column in enumerate(narrative_columns):
+        weather_events.insert(insert_at + offset, column,
+                              joined[column].values)
+    return weather_events
+
+
+class WeatherEventStore():
+    """
+    Local Parquet cache of the weather events table, partitioned by year
+    and event type, with a watermark on the max weather_event_id so later
+    runs only pull newly added events.
+
+    Parameters
+    ----------
+    db: object
+        Database object with 'dbconn' and 'dbops' attributes.
+    event_types: list
+        Event types to cache.
+    cache_dir: str, default "./weather_event_cache"
+        Directory holding the Parquet partitions and the watermark file.
+    columns: list, default WEATHER_EVENT_COLUMNS
+        Columns to cache.
+    table: str, default "pvdrdb.weather_events"
+        Weather events table.
+    chunk_size: int, default 50000
+        Number of rows per streamed chunk.
+
+    Notes
+    -----
+    Requires pyarrow (or fastparquet) for the Parquet files.
+    """
+
+    def __init__(self, db, event_types, cache_dir="./weather_event_cache",
+                 columns=WEATHER_EVENT_COLUMNS,
+                 table="pvdrdb.weather_events", chunk_size=50000):
+        self.db = db
+        self.event_types = sorted(set(event_types))
+        self.cache_dir = cache_dir
+        self.columns = list(columns)
+        self.table = table
+        self.chunk_size = chunk_size
+        self.watermark_file = os.path.join(cache_dir, "_watermark.json")
+
+    def readWatermark(self):
+        """
+        Read the watermark of the cache.
+
+        Returns
+        -------
+        watermark: dict or None
+            Contains 'max_weather_event_id', 'max_start_timestamp',
+            'event_types', 'columns', and 'table'. None if there is no
+            usable cache (missing, or built for other event types/columns).
+        """
+        if not os.path.exists(self.watermark_file):
+            return None
+        with open(self.watermark_file) as f:
+            watermark = json.load(f)
+        if (watermark.get('event_types') != self.event_types or
+                watermark.get('columns') != self.columns or
+                watermark.get('table') != self.table):
+            return None
+        return watermark
+
+    def _writeWatermark(self, max_weather_event_id, max_start_timestamp):
+        watermark = {'max_weather_event_id': max_weather_event_id,
+                     'max_start_timestamp': max_start_timestamp,
+                     'event_types': self.event_types,
+                     'columns': self.columns,
+                     'table': self.table}
+        with open(self.watermark_file, 'w') as f:
+            json.dump(watermark, f, indent=2)
+        return
+
+    def _writePartitions(self, df, part_name):
+        years = df['start_timestamp'].dt.year
+        for (year, event_type), partition in df.groupby(
+                [years.fillna(0).astype(int), 'event_type']):
+            partition_dir = os.path.join(
+                self.cache_dir, f"year={year}",
+                f"event_type={quote(str(event_type), safe='')}")
+            os.makedirs(partition_dir, exist_ok=True)
+            partition.to_parquet(
+                os.path.join(partition_dir, f"{part_name}.parquet"),
+                index=False)
+        return
+
+    def clear(self):
+        """
+        Remove all cached partitions and the watermark.
+
+        Returns
+        -------
+        None.
+
+        """
+        for path in glob.glob(os.path.join(self.cache_dir, "year=*", "*",
+                                           "*.parquet")):
+            os.remove(path)
+        if os.path.exists(self.watermark_file):
+            os.remove(self.watermark_file)
+        return
+
+    def refresh(self):
+        """
+        Pull events newer than the watermark into the cache. If there is no
+        usable cache, the full filtered table is pulled.
+
+        Returns
+        -------
+        n_new: int
+            Number of new events written to the cache.
+        """
+        watermark = self.readWatermark()
+        if watermark is None:
+            self.clear()
+            since_id = None
+            max_start = None
+        else:
+            since_id = watermark['max_weather_event_id']
+            max_start = watermark['max_start_timestamp']
+        os.makedirs(self.cache_dir, exist_ok=True)
+        n_new = 0
+        for chunk in streamWeatherEvents(
+                self.db, self.event_types, columns=self.columns,
+                table=self.table, since_weather_event_id=since_id,
+                chunk_size=self.chunk_size):
+            for column in ['start_timestamp', 'end_timestamp']:
+                if column in chunk.columns:
+                    chunk[column] = pd.to_datetime(chunk[column], utc=True)
+            chunk_max_id = int(chunk['weather_event_id'].max())
+            self._writePartitions(
+                chunk, f"part-{chunk['weather_event_id'].min()}-"
+                f"{chunk_max_id}")
+            since_id = chunk_max_id if since_id is None else max(
+                since_id, chunk_max_id)
+            chunk_max_start = chunk['start_timestamp'].max()
+            if pd.notna(chunk_max_start):
+                max_start = chunk_max_start.isoformat() if max_start is \
+                    None else max(pd.Timestamp(max_start),
+                                  chunk_max_start).isoformat()
+            n_new += len(chunk)
+            # Move the watermark forward after every chunk, so an
+            # interrupted refresh resumes where it stopped
+            self._writeWatermark(since_id, max_start)
+        if self.readWatermark() is None:
+            # Empty result, still record that the cache is complete
+            self._writeWatermark(since_id, max_start)
+        return n_new
+
+    def iterChunks(self, refresh=True):
+        """
+        Iterate over the cached weather events one partition file at a
+        time.
+
+        Parameters
+        ----------
+        refresh: bool, default True
+            If True, pull newly added events into the cache first.
+
+        Yields
+        ------
+        chunk: Pandas DataFrame
+            Cached weather events of one partition file.
+        """
+        if refresh:
+            self.refresh()
+        paths = sorted(glob.glob(os.path.join(self.cache_dir, "year=*", "*",
+                                              "*.parquet")))
+        for path in paths:
+            yield pd.read_parquet(path)[self.columns]
+
+    def load(self, refresh=True):
+        """
+        Load the cached weather events.
+
+        Parameters
+        ----------
+        refresh: bool, default True
+            If True, pull newly added events into the cache first.
+
+        Returns
+        -------
+        weather_df: Pandas DataFrame
+            Cached weather events, ordered by weather_event_id.
+        """
+        chunks = list(self.iterChunks(refresh=refresh))
+        if len(chunks) == 0:
+            return pd.DataFrame(columns=self.columns)
+        weather_df = pd.concat(chunks, ignore_index=True)
+        return weather_df.sort_values('weather_event_id').reset_index(
+            drop=True)
@@ -2,45 +2,92 @@
 System linker class for extreme weather.
 """
 
+import logging
+import numpy as np
 import pandas as pd
-import geopy.distance
-import plotly.express as px
-from datetime import timedelta
+from spatial_join import spatialJoin
+from temporal_index import EventTimeIndex, normalizeWeatherTimestamps
+from pv_performance import scoreEventPerformance
+from plot_renderer import renderWeatherEventPlot
+from event_merge import mergeEventIntervals
+from weather_event_store import (iterWeatherEventChunks,
+                                 concatCompactEvents, joinEventDetails,
+                                 NARRATIVE_COLUMNS)
+from instrumentation import (Instrumentation, instrumentedStage, systemIds,
+                             eventSystemId)
+from link_state import (LinkState, configHash, systemFingerprints,
+                        DISTANCE_COLUMNS)
+from results_io import concatTyped
 
 
+logger = logging.getLogger(__name__)
+
 sub_event_type_df = pd.read_csv("./master-weather-category.csv")
+master_event_type = sub_event_type_df.set_index('event_type')[
+    'weather_event_master']
 
 
 class SystemLinker():
 
-    def __init__(self, db, system_metadata, weather_distance_config):
+    def __init__(self, db, system_metadata, weather_distance_config,
+                 weather_cache_dir=None, instrumentation=None,
+                 weather_data=None):
         self.db = db
         self.system_metadata = system_metadata
+        self.weather_distance_config = weather_distance_config
+        self.weather_cache_dir = weather_cache_dir
+        # Compact (weather_df, weather_details) to use instead of pulling
+        # the events from db, e.g. one tile's events in sharded linking
+        self.weather_data = weather_data
+        # Stage timings and linking funnel counts, passed to the
+        # instrumentation's sinks (see instrumentation.py)
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+        self.instrumentation = instrumentation
         # Pull the associated weather data from the database.
         self.pullWeatherData()
-        self.weather_distance_config = weather_distance_config
         # Subset the data to only include weather event types that
         # we care about (in the config dictionary)
         self.subsetWeatherData()
+        # Parse the event timestamps once and index them by start time
+        self.indexWeatherData()
 
+    @instrumentedStage
     def pullWeatherData(self):
         """
         Pull down the weather data from the associated PVDRDB table, for
-        joining with the associated system data.
+        joining with the associated system data. Only the event types in
+        the weather distance configuration and the columns used downstream
+        are queried, streamed in chunks.
+
+        If weather_cache_dir is set, the events are served from a local
+        Parquet cache, and only events added since the last run are pulled
+        from the database.
+
+        The events are held compactly (categorical strings), and the
+        free-text narratives are kept in a side table
+        (self.weather_details) that is joined back in linkData(). If weather_data was given, those events
+        are used instead.
 
         Returns
         -------
         None.
 
         """
-        sql = "select * from pvdrdb.weather_events"
-        self.db.dbops.execute(sql)
-        self.db.dbconn.commit()
-        self.weather_df = pd.DataFrame(self.db.dbops.fetchall())
-        self.weather_df.columns = [desc[0] for desc in
-                                   self.db.dbops.description]
+        if self.weather_data is not None:
+            self.weather_df, self.weather_details = self.weather_data
+        else:
+            chunks = iterWeatherEventChunks(
+                self.db, list(self.weather_distance_config.keys()),
+                cache_dir=self.weather_cache_dir)
+            # Compact each chunk as it arrives
+            self.weather_df, self.weather_details = concatCompactEvents(
+                chunks)
+        self.weather_df = self.weather_df.sort_values(
+            'weather_event_id', kind='stable').reset_index(drop=True)
         return
 
+    @instrumentedStage
     def subsetWeatherData(self):
         """
         Subset the weather events based on what's in the weather distance
@@ -56,13 +103,163 @@ class SystemLinker():
             weather_events)]
         return
 
-    def linkData(self):
+    @instrumentedStage
+    def indexWeatherData(self):
+        """
+        Normalize the weather event timestamps to tz-aware datetime columns,
+        sort the events by start time, and build the start-time index used
+        to filter events to each system's data period.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.weather_df = normalizeWeatherTimestamps(self.weather_df)
+        self.event_time_index = EventTimeIndex(
+            self.weather_df['start_timestamp'],
+            self.weather_df['end_timestamp'])
+        return
+
+    def getLinkCandidates(self, geodesic_refinement=True,
+                          system_positions=None, event_positions=None):
+        """
+        Get every (system, weather event) pair within the max configured
+        distance of the system and within the system's data period, with
+        the weather event columns.
+
+        Parameters
+        ----------
+        geodesic_refinement: bool, default True
+            If True, distances close to a configured threshold are recomputed
+            with the exact geodesic instead of the great-circle approximation.
+        system_positions: Numpy array, default None
+            Row positions in system_metadata of the systems to link. None
+            links every system.
+        event_positions: Numpy array, default None
+            Row positions in weather_df of the events to link against. None
+            uses every event.
+
+        Returns
+        -------
+        weather_candidates: Pandas DataFrame
+            One row per pair: the weather event columns, the distance
+            columns, and 'system_position' (row position of the system in
+            system_metadata). Sorted by system, then event start time.
+        """
+        return self.candidateRows(self.getLinkPairs(
+            geodesic_refinement=geodesic_refinement,
+            system_positions=system_positions,
+            event_positions=event_positions))
+
+    def getLinkPairs(self, geodesic_refinement=True, system_positions=None,
+                     event_positions=None):
+        """
+        Get every (system, weather event) pair within the max configured
+        distance of the system and within the system's data period.
+
+        Parameters
+        ----------
+        geodesic_refinement: bool, default True
+            If True, distances close to a configured threshold are recomputed
+            with the exact geodesic instead of the great-circle approximation.
+        system_positions: Numpy array, default None
+            Row positions in system_metadata of the systems to link. None
+            links every system.
+        event_positions: Numpy array, default None
+            Row positions in weather_df of the events to link against. None
+            uses every event.
+
+        Returns
+        -------
+        pairs: Pandas DataFrame
+            One row per pair: 'system_position' and 'event_position' (row
+            positions in system_metadata and weather_df) and the distance
+            columns. Sorted by system, then event start time.
+        """
+        if system_positions is None:
+            system_positions = np.arange(len(self.system_metadata))
+        system_positions = np.asarray(system_positions, dtype=np.int64)
+        # Get the data period for every system
+        started_on = pd.to_datetime(self.system_metadata['started_on'],
+                                    format="%m/%d/%Y %H:%M", errors='coerce')
+        ended_on = pd.to_datetime(self.system_metadata['ended_on'],
+                                  format="%m/%d/%Y %H:%M", errors='coerce')
+        for system_position in system_positions[
+                (started_on.isna() | ended_on.isna()).values[
+                    system_positions]]:
+            row = self.system_metadata.iloc[system_position]
+            logger.warning("Could not parse the data period for system row "
+                           "%d: '%s' to '%s'", system_position,
+                           row['started_on'], row['ended_on'])
+        # Only events starting within some system's data period can match
+        starting_positions = self.event_time_index.startsWithin(
+            started_on.values[system_positions],
+            ended_on.values[system_positions])
+        if event_positions is None:
+            event_positions = starting_positions
+        else:
+            event_positions = np.intersect1d(
+                np.asarray(event_positions, dtype=np.int64),
+                starting_positions, assume_unique=True)
+        # Get cases where systems are near weather events, for the whole
+        # fleet at once
+        pairs = spatialJoin(self.system_metadata.iloc[system_positions],
+                            self.weather_df.iloc[event_positions],
+                            self.weather_distance_config,
+                            geodesic_refinement=geodesic_refinement,
+                            instrumentation=self.instrumentation)
+        pairs['system_position'] = system_positions[
+            pairs['system_position'].values]
+        pairs['event_position'] = event_positions[
+            pairs['event_position'].values]
+        # Check if weather events occur during each system's time series
+        # period
+        pairs = pairs[self.event_time_index.contains(
+            pairs['event_position'].values,
+            started_on.values[pairs['system_position'].values],
+            ended_on.values[pairs['system_position'].values])]
+        self.instrumentation.count('within_data_period', systemIds(
+            self.system_metadata)[pairs['system_position'].values])
+        return pairs.reset_index(drop=True)
+
+    def candidateRows(self, pairs):
+        """
+        Build the candidate table from (system, event) pairs.
+
+        Parameters
+        ----------
+        pairs: Pandas DataFrame
+            Pairs with 'system_position' and 'event_position' (row positions
+            in system_metadata and weather_df) and the distance columns.
+
+        Returns
+        -------
+        weather_candidates: Pandas DataFrame
+            One row per pair: the weather event columns, the distance
+            columns, and 'system_position', in the order of the pairs.
+        """
+        distance_columns = ['distance_to_weather_event_start_km',
+                            'distance_to_weather_event_end_km',
+                            'min_distance_to_weather_event_km']
+        # Build one long (system, event) candidate table for the fleet
+        weather_candidates = self.weather_df.iloc[
+            pairs['event_position'].values].reset_index(drop=True)
+        weather_candidates[distance_columns] = pairs[distance_columns].values
+        weather_candidates['system_position'] = pairs[
+            'system_position'].values
+        return weather_candidates
+
+    @instrumentedStage
+    def linkData(self, geodesic_refinement=True):
         """
         Link the data sets for systems and extreme weather.
 
         Parameters
         ----------
-        None.
+        geodesic_refinement: bool, default True
+            If True, distances close to a configured threshold are recomputed
+            with the exact geodesic instead of the great-circle approximation.
 
         Returns
         -------
@@ -75,67 +272,61 @@ class SystemLinker():
         system_metadata_df must contain columns 'latitude', 'longitude',
         'started_on', 'ended_on'.
         """
-        # Select the max degree difference needed based on the max distance
-        # in the weather event config
-        max_deg_distance = max(self.weather_distance_config.values()) / 111
-        system_weather_event_master = pd.DataFrame()
-        # Get cases where systems are near weather events
-        for index, row in self.system_metadata.iterrows():
-            latitude = row['latitude']
-            longitude = row['longitude']
-            try:
-                started_on = pd.to_datetime(
-                    row['started_on'], format="%m/%d/%Y %H:%M").date()
-                ended_on = pd.to_datetime(
-                    row['ended_on'], format="%m/%d/%Y %H:%M").date()
-            except Exception as e:
-                print(e)
-                continue
-            # Get any weather cases within 1 decimal points of system
-            weather_sub = self.weather_df[
-                ((abs(self.weather_df['begin_latitude'] - latitude) <
-                  max_deg_distance) &
-                 (abs(self.weather_df['begin_longitude'] - longitude) <
-                  max_deg_distance))
-                | ((abs(self.weather_df['end_latitude'] - latitude) <
-                    max_deg_distance) &
-                   (abs(self.weather_df['end_longitude'] - longitude) <
-                    max_deg_distance))]
-            # Check if weather events occur during time series period
-            weather_sub = weather_sub[(pd.to_datetime(
-                weather_sub['start_timestamp']).dt.date >= started_on) &
-                (pd.to_datetime(weather_sub['end_timestamp']).dt.date
-                 <= ended_on)]
-            # Get the min distance to the storm event
-            sys_coords = (latitude, longitude)
-            weather_sub['distance_to_weather_event_start_km'] = [
-                geopy.distance.geodesic(sys_coords, (x, y)).km
-                for x, y in zip(weather_sub['begin_latitude'],
-                                weather_sub['begin_longitude'])]
-            weather_sub['distance_to_weather_event_end_km'] = [
-                geopy.distance.geodesic(sys_coords, (x, y)).km
-                for x, y in zip(weather_sub['end_latitude'],
-                                weather_sub['end_longitude'])]
-            weather_sub['min_distance_to_weather_event_km'] = weather_sub[[
-                'distance_to_weather_event_start_km',
-                'distance_to_weather_event_end_km']].min(axis=1)
-            # Remove sites where there are no matching cases
-            if len(weather_sub) != 0:
-                # Clean up the weather dataframe to remove any duplicates
-                weather_sub = self.cleanUpWeatherData(weather_sub)
-                # Filter systems within specified distance of weather event
-                for event_type in self.weather_distance_config:
-                    within_distance = self.weather_distance_config.get(
-                        event_type)
-                    weather_sub_event = weather_sub[weather_sub['event_type']
-                                                    == event_type]
-                    weather_sub_event = weather_sub_event[
-                        weather_sub_event['min_distance_to_weather_event_km']
-                        <= within_distance]
-                    for x, y in row.to_dict().items():
-                        weather_sub_event[x] = y
-                    system_weather_event_master = pd.concat([
-                        system_weather_event_master, weather_sub_event])
+        weather_candidates = self.getLinkCandidates(
+            geodesic_refinement=geodesic_refinement)
+        return self.finalizeLinks(weather_candidates)
+
+    def finalizeLinks(self, weather_candidates):
+        """
+        Turn link candidates into the linked output: merge duplicate events
+        into storms, apply each event type's distance, and add the system
+        metadata and the event narratives.
+
+        Parameters
+        ----------
+        weather_candidates: Pandas DataFrame
+            Link candidates, see getLinkCandidates().
+
+        Returns
+        -------
+        system_weather_events: Pandas DataFrame
+            Pandas dataframe containing the data sets for systems that are
+            present during extreme weather events, ordered by system (as in
+            system_metadata), then by event type (as in the config).
+        """
+        # Merge duplicate events per system in one grouped pass
+        system_weather_event_master = self.cleanUpWeatherData(
+            weather_candidates, by=['system_position'])
+        self.instrumentation.count('after_dedup', systemIds(
+            self.system_metadata)[
+                system_weather_event_master['system_position'].values])
+        # Filter systems within specified distance of weather event
+        within_distance = system_weather_event_master['event_type'].map(
+            self.weather_distance_config)
+        system_weather_event_master = system_weather_event_master[
+            system_weather_event_master['min_distance_to_weather_event_km']
+            <= within_distance.to_numpy(dtype=float)]
+        self.instrumentation.count('within_event_distance', systemIds(
+            self.system_metadata)[
+                system_weather_event_master['system_position'].values])
+        # Order by system, then by event type as listed in the config
+        event_type_order = system_weather_event_master['event_type'].map(
+            {event_type: idx for idx, event_type in
+             enumerate(self.weather_distance_config)})
+        system_weather_event_master = system_weather_event_master.iloc[
+            np.lexsort([event_type_order.to_numpy(dtype=float),
+                        system_weather_event_master[
+                            'system_position'].values])]
+        # Add the system metadata to each event
+        system_rows = self.system_metadata.iloc[
+            system_weather_event_master['system_position'].values]
+        system_weather_event_master = system_weather_event_master.drop(
+            columns='system_position').reset_index(drop=True)
+        # Join the narratives back for the output
+        system_weather_event_master = joinEventDetails(
+            system_weather_event_master, self.weather_details)
+        for column in self.system_metadata.columns:
+            system_weather_event_master[column] = system_rows[column].values
         system_weather_event_master = system_weather_event_master.rename(
             columns={'latitude': 'system_latitude',
                      'longitude': 'system_longitude',
@@ -155,9 +346,144 @@ class SystemLinker():
                 'weather_event_ended_on']).dt.tz_convert(None)).dt.days
         return system_weather_event_master
 
+    @instrumentedStage
+    def linkDataIncremental(self, link_state_dir="./link_state",
+                            geodesic_refinement=True):
+        """
+        Link the systems to the weather events like linkData(), reusing the
+        results of the previous run saved in link_state_dir. New or changed
+        systems (by a fingerprint of their metadata row) are linked against
+        every event, and unchanged systems only against the events added
+        since the previous run (weather_event_id above the saved
+        watermark). Systems with new pairs are re-merged from their saved
+        and new pairs, so storms crossing the watermark are merged as in a
+        full run; the rest keep their saved links.
+
+        Everything is relinked if there is no saved state, or if the
+        distance config, the master categories, or geodesic_refinement
+        changed.
+
+        Parameters
+        ----------
+        link_state_dir: str, default "./link_state"
+            Directory holding the saved state, see link_state.LinkState.
+        geodesic_refinement: bool, default True
+            If True, distances close to a configured threshold are recomputed
+            with the exact geodesic instead of the great-circle approximation.
+
+        Returns
+        -------
+        system_weather_events: Pandas DataFrame
+            Same as linkData().
+
+        Notes
+        -----
+        system_metadata_df must contain a unique 'system_id' column.
+        Events are assumed to be appended with increasing weather_event_id
+        and not edited afterwards, as for the weather event cache.
+        """
+        if 'system_id' not in self.system_metadata.columns or \
+                not self.system_metadata['system_id'].is_unique:
+            raise ValueError("Incremental linking requires a unique "
+                             "'system_id' column in system_metadata.")
+        system_ids = self.system_metadata['system_id'].values
+        event_ids = self.weather_df['weather_event_id'].values
+        link_state = LinkState(link_state_dir)
+        config_hash = configHash(self.weather_distance_config,
+                                 master_event_type, geodesic_refinement)
+        fingerprints = systemFingerprints(self.system_metadata)
+        state = link_state.read(config_hash)
+        # Find the new or changed systems
+        changed = np.ones(len(system_ids), dtype=bool)
+        watermark = None
+        if state is not None:
+            watermark = state['watermark']
+            saved = state['fingerprints']
+            saved_position = pd.Index(saved['system_id']).get_indexer(
+                system_ids)
+            changed = (saved_position < 0) | (
+                saved['fingerprint'].values[np.maximum(saved_position, 0)]
+                != fingerprints)
+        unchanged_positions = np.flatnonzero(~changed)
+        if watermark is None:
+            new_event_positions = np.arange(len(event_ids))
+        else:
+            new_event_positions = np.flatnonzero(event_ids > watermark)
+        pairs = list()
+        if np.any(changed):
+            pairs.append(self.getLinkPairs(
+                geodesic_refinement=geodesic_refinement,
+                system_positions=np.flatnonzero(changed)))
+        # Systems with new pairs need their storms merged again
+        affected = changed.copy()
+        if len(unchanged_positions) and len(new_event_positions):
+            new_pairs = self.getLinkPairs(
+                geodesic_refinement=geodesic_refinement,
+                system_positions=unchanged_positions,
+                event_positions=new_event_positions)
+            affected[new_pairs['system_position'].values] = True
+            pairs.append(new_pairs)
+        # Saved pairs of unchanged systems, mapped to the current positions
+        saved_links = None
+        if state is not None:
+            saved_pairs = state['pairs']
+            saved_pairs['system_position'] = pd.Index(
+                system_ids).get_indexer(saved_pairs['system_id'])
+            saved_pairs['event_position'] = pd.Index(
+                event_ids).get_indexer(saved_pairs['weather_event_id'])
+            saved_pairs = saved_pairs[
+                (saved_pairs['system_position'] >= 0) &
+                (saved_pairs['event_position'] >= 0)]
+            saved_pairs = saved_pairs[
+                ~changed[saved_pairs['system_position'].values]]
+            pairs.append(saved_pairs[['system_position', 'event_position']
+                                     + DISTANCE_COLUMNS])
+            saved_links = state['links']
+        if len(pairs):
+            pairs = pd.concat(pairs, ignore_index=True)
+        else:
+            pairs = self.getLinkPairs(
+                geodesic_refinement=geodesic_refinement,
+                system_positions=[])
+        # Same order as a full run: by system, then event start time
+        pairs = pairs.iloc[np.lexsort([
+            pairs['event_position'].values,
+            pairs['system_position'].values])].reset_index(drop=True)
+        affected_pairs = pairs[affected[pairs['system_position'].values]]
+        system_weather_event_master = self.finalizeLinks(
+            self.candidateRows(affected_pairs))
+        # Keep the saved links of the other systems
+        if saved_links is not None:
+            saved_position = pd.Index(system_ids).get_indexer(
+                saved_links['system_id'])
+            saved_links = saved_links[(saved_position >= 0) & ~affected[
+                np.maximum(saved_position, 0)]]
+            system_weather_event_master = concatTyped(
+                [system_weather_event_master, saved_links])
+            system_position = pd.Index(system_ids).get_indexer(
+                system_weather_event_master['system_id'])
+            system_weather_event_master = system_weather_event_master.iloc[
+                np.argsort(system_position, kind='stable')].reset_index(
+                    drop=True)
+        if len(event_ids):
+            watermark = event_ids.max() if watermark is None else \
+                max(watermark, event_ids.max())
+        link_state.save(
+            config_hash, watermark,
+            pd.DataFrame({'system_id': system_ids[
+                              pairs['system_position'].values],
+                          'weather_event_id': event_ids[
+                              pairs['event_position'].values]}).join(
+                pairs[DISTANCE_COLUMNS]),
+            system_weather_event_master,
+            pd.DataFrame({'system_id': system_ids,
+                          'fingerprint': fingerprints}))
+        return system_weather_event_master
+
     def generatePlotlyGraphic(self, data_type,
                               system_ac_power_data, weather_events,
-                              ac_power_units, subsystem_name, day_window=14):
+                              ac_power_units, subsystem_name, day_window=14,
+                              **render_options):
         """
         Generate a plotly graphic showing system power data and associated
         weather events.
@@ -178,169 +504,90 @@ class SystemLinker():
             Subsystem name.
         day_window: int, default 14
             Number of days before and after a weather event.
+        **render_options
+            Decimation, WebGL, and output options passed to
+            plot_renderer.renderWeatherEventPlot (max_points, use_webgl,
+            include_plotlyjs, image_format, output_dir).
 
         Returns
         -------
         None.
 
         """
-        weather_events['weather_event_started_on'] = pd.to_datetime(weather_events[
-                'weather_event_started_on'])
-        weather_events['weather_event_ended_on'] = pd.to_datetime(weather_events[
-                        'weather_event_ended_on'])
-        min_event_start = weather_events[
-            'weather_event_started_on'].min().date()
-        max_event_end = weather_events[
-            'weather_event_ended_on'].max().date()
-        # Get before and after periods for an event
-        sys_data = system_ac_power_data[
-             (system_ac_power_data.index.date >= (
-                 min_event_start - pd.Timedelta(days=day_window))) &
-             (system_ac_power_data.index.date <= (
-                 max_event_end + pd.Timedelta(days=day_window)))]
-        # order by index
-        sys_data = sys_data.sort_index()
-        if data_type == 'wind':
-            # Build the plotly graphic with the weather events
-            operator_name = weather_events["operator_name"].iloc[0]
-            site_name = weather_events["site_name"].iloc[0]
-            title = f"{operator_name} {site_name}, {subsystem_name} AC Power"
-            fig = px.line(sys_data, y=sys_data,
-                          title=title).update_layout(
-                              xaxis_title="Datetime",
-                              yaxis_title=f"AC Power ({ac_power_units})")
-        else:
-            system_id = weather_events["system_id"].iloc[0]
-            title = f"{system_id} AC Power"
-            fig = px.line(sys_data, y=sys_data.columns,
-                          title=title).update_layout(
-                              xaxis_title="Datetime",
-                              yaxis_title=f"AC Power ({ac_power_units})")
-        # Loop through all of the events and generate the associated vrect's
-        # in the plotly graphic
-        for idx, row in weather_events.iterrows():
-            event_start = pd.to_datetime(row['weather_event_started_on'])
-            event_end = pd.to_datetime(row['weather_event_ended_on'])
-            event_type = row['event_type']
-            # Add lines for event start and end date
-            fig.add_vrect(x0=event_start, x1=event_end,
-                          fillcolor="red",
-                          annotation_text=event_type,
-                          opacity=0.2)
-        if data_type == 'wind':
-            fig.write_html(
-                f"./plots/{operator_name}_{site_name}_{subsystem_name}_weather_events.html",
-                full_html=False, include_plotlyjs="cdn")
-        else:
-            fig.write_html(
-                f"./plots/{system_id}_weather_events.html",
-                full_html=False, include_plotlyjs="cdn")            
+        with self.instrumentation.stage('generatePlotlyGraphic',
+                                        system_id=eventSystemId(
+                                            weather_events)):
+            renderWeatherEventPlot(data_type, system_ac_power_data,
+                                   weather_events, ac_power_units,
+                                   subsystem_name, day_window=day_window,
+                                   **render_options)
         return
 
-    def examinePVPerformance(self,system_ac_power_data, weather_events):
+    def examinePVPerformance(self, system_ac_power_data, weather_events):
         """
-        For PV data, look at the 24 hour period around each extreme
-        weather event, and compare it to non-extreme weather periods.
+        For PV data, look at the 2-day period starting on the day of each
+        extreme weather event, and compare it to the median daily
+        production for the same month across all years.
+
+        Parameters
+        ----------
+        system_ac_power_data: Pandas Dataframe
+            Pandas dataframe containing datetime index and ac power columns.
+        weather_events: Pandas Dataframe
+            Pandas dataframe of weather events linked to the system,
+            containing the 'weather_event_started_on' column.
+
+        Returns
+        -------
+        agg_df: Pandas DataFrame
+            Weather events repeated for every ac power stream, with the
+            'data_stream' and 'pct_median_output' columns added.
+
         """
-        pct_median_output_list = list()
-        for idx, row in weather_events.iterrows():
-            for column in list(system_ac_power_data.columns):
-                ac_power_stream = system_ac_power_data[column]
-                extreme_weather_date = pd.to_datetime(
-                    row['weather_event_started_on']).date()
-                sum_daily_production = ac_power_stream[
-                    (ac_power_stream.index.date >= extreme_weather_date) &
-                    (ac_power_stream.index.date <=
-                     (extreme_weather_date+ timedelta(days=1)))].sum()
-                # Look at the mean for similar dates on different years
-                month_performance =  ac_power_stream[
-                    ac_power_stream.index.month ==
-                    extreme_weather_date.month]
-                month_performance_median = month_performance.groupby(
-                    month_performance.index.date).transform("sum").median()
-                # Look at how the extreme weather performance compares to the
-                # monthly median
-                pct_median_output = sum_daily_production / month_performance_median
-                # append extreme weather event to master list
-                row = row.to_dict()
-                row['data_stream'] = column
-                row['pct_median_output'] = pct_median_output
-                pct_median_output_list.append(row)
-        agg_df = pd.DataFrame(pct_median_output_list)
+        with self.instrumentation.stage('examinePVPerformance',
+                                        system_id=eventSystemId(
+                                            weather_events)):
+            agg_df = scoreEventPerformance(system_ac_power_data,
+                                           weather_events)
         return agg_df
 
-    def cleanUpWeatherData(self, weather_events):
+    @instrumentedStage
+    def cleanUpWeatherData(self, weather_events, by=None):
         """
         Clean up the weather event data to prevent duplicates.
+
+        Events of the same master category that overlap or fall on
+        back-to-back days are merged into one storm, represented by the
+        event nearest to the system (see event_merge.mergeEventIntervals).
+
+        Parameters
+        ----------
+        weather_events: Pandas DataFrame
+            Weather events near a system, with the distance columns.
+        by: list, default None
+            Extra columns to merge events within, e.g. ['system_position']
+            to clean up the events of many systems at once. These columns
+            are kept in the output.
+
+        Returns
+        -------
+        weather_events: Pandas DataFrame
+            One row per storm.
         """
         # Create a master "event" category so we're removing duplicated/similar
-        # categories
-        weather_events = pd.merge(weather_events, sub_event_type_df,
-                                  on='event_type')
-        # Filter weather events down to day/type (aggregation). This will help
-        # with the number of occurrences
-        weather_events['start_date'] = weather_events['start_timestamp'].dt.date
-        weather_events['end_date'] = weather_events['end_timestamp'].dt.date
-        # Explode list of dates
-        weather_events["dates"] = weather_events.apply(lambda row: 
-                                                       pd.date_range(
-                                                           row["start_date"],
-                                                           row["end_date"]),
-                                                       axis=1)
-        weather_events_exploded = weather_events.explode("dates")
-        weather_events_sub = weather_events_exploded[['dates',
-                                                      'weather_event_master'
-                                                      ]].drop_duplicates()
-        # Sort by type and date
-        weather_events_sub = weather_events_sub.sort_values([
-            'weather_event_master', 'dates'])
-        # Isolate events over subsequent days
-        weather_events_sub['day_diff'] =  (weather_events_sub['dates'] -
-                                           weather_events_sub['dates'].shift(1)
-                                           ).dt.days
-        weather_events_sub.loc[weather_events_sub['day_diff'] != 1, 
-                               'day_diff'] = 0
-        weather_events_sub['weather_event_idx'] = weather_events_sub[
-            'day_diff'].eq(0).cumsum().sub(1)
-        # Join data back with original dataframe so we can aggregate data
-        # up by its associated weather_event_idx
-        weather_events_exploded_new = pd.merge(weather_events_exploded, 
-                                               weather_events_sub, 
-                                               on = ['dates', 'weather_event_master'])
-        # Reset the date lengths based on the min and max by index
-        weather_events_exploded_new['weather_event_started_on_agg'] = weather_events_exploded_new.groupby(
-            "weather_event_idx")['start_timestamp'].transform("min")
-        weather_events_exploded_new['weather_event_ended_on_agg'] = weather_events_exploded_new.groupby(
-            "weather_event_idx")['end_timestamp'].transform("max")
-        # Also take max magnitude and damage levels associated with the storm
-        weather_events_exploded_new['max_magnitude'] = weather_events_exploded_new.groupby(
-            "weather_event_idx")['magnitude'].transform("max")
-        weather_events_exploded_new['max_damage_property'] = weather_events_exploded_new.groupby(
-            "weather_event_idx")['damage_property'].transform("max")
-        weather_events_exploded_new['max_damage_crops'] = weather_events_exploded_new.groupby(
-            "weather_event_idx")['damage_crops'].transform("max")                
-        # Take the nearest distance value for each weather index
-        weather_events_exploded_new['nearest_distance'] = weather_events_exploded_new.groupby(
-            "weather_event_idx")['min_distance_to_weather_event_km'].transform("min")        
-        weather_events_exploded_new = weather_events_exploded_new[
-            weather_events_exploded_new['min_distance_to_weather_event_km'] ==
-            weather_events_exploded_new['nearest_distance']].drop_duplicates()
-        # Take first occurance of weather event index        
-        weather_events_exploded_new.drop_duplicates(
-            subset='weather_event_idx', keep='first', inplace=True)
-        # Update the columns based on the aggregated storm values
-        weather_events_exploded_new['weather_event_started_on'] = \
-            weather_events_exploded_new['weather_event_started_on_agg']          
-        weather_events_exploded_new['weather_event_ended_on'] = \
-            weather_events_exploded_new['weather_event_ended_on_agg']
-        weather_events_exploded_new['magnitude'] = \
-            weather_events_exploded_new['max_magnitude']            
-        weather_events_exploded_new['damage_property'] = \
-            weather_events_exploded_new['max_damage_property']
-        weather_events_exploded_new['damage_crops'] = \
-            weather_events_exploded_new['max_damage_crops']
+        # categories (event types without a master category are dropped)
+        weather_event_master = weather_events['event_type'].map(
+            master_event_type)
+        weather_events = weather_events[weather_event_master.notna().values]
+        weather_events = weather_events.assign(
+            weather_event_master=weather_event_master[
+                weather_event_master.notna()].astype('category').values)
+        # Merge the events into storms, and take the storm's span, max
+        # magnitude and damage levels, and nearest distance
+        weather_events_merged = mergeEventIntervals(weather_events, by=by)
         # Clean up the data frame
-        weather_events_exploded_new = weather_events_exploded_new[[
+        weather_events_merged = weather_events_merged[[
+            x for x in [
                'weather_event_id', 'state',
                'location', 'event_type', 'begin_latitude', 'begin_longitude',
                'end_latitude', 'end_longitude', 
@@ -350,5 +597,7 @@ class SystemLinker():
                'comments', 'distance_to_weather_event_start_km',
                'distance_to_weather_event_end_km',
                'min_distance_to_weather_event_km',
-               'weather_event_master']]
-        return weather_events_exploded_new
+               'weather_event_master'] + list(by or [])
+            # The narratives are only present if they weren't split out
+            if x not in NARRATIVE_COLUMNS or x in weather_events.columns]]
+        return weather_events_merged